@@ -3,24 +3,70 @@ API REST para conectar Next.js con AS400 DB2
 Usa JT400 (Open Source IBM Toolbox para Java) via JayDeBeAPI
 """
 
-from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import Optional, List, Dict, Any
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import decimal_encoder, jsonable_encoder
+from starlette.datastructures import Headers, MutableHeaders
+from typing import Optional, List, Dict, Any, Sequence, Tuple, Callable
 import jaydebeapi
+import jpype
 import os
 import json
+from decimal import Decimal
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import logging
 import time
 import signal
+import sqlite3
+import functools
+import re
+import base64
+import hashlib
+import math
+import zlib
+import asyncio
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager, asynccontextmanager
 from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
+try:
+    import orjson  # opcional: serialización JSON rápida (ver JSON_BACKEND)
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # opcional: Accept: application/msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli  # opcional: Content-Encoding br (si no, solo gzip)
+except ImportError:
+    brotli = None
+
+try:
+    import pyarrow as pa  # opcional: Accept: application/vnd.apache.arrow.stream
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+try:
+    import numpy as np  # opcional: simplificación de recorridos vectorizada (simplify=<metros>)
+except ImportError:
+    np = None
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Instante de arranque del proceso (para medir el tiempo hasta estar listo)
+PROCESS_STARTED_AT = time.monotonic()
+# Identifica este arranque del proceso (los tokens `since` de un proceso anterior no son válidos)
+PROCESS_EPOCH = int(time.time() * 1000)
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -30,54 +76,449 @@ if sys.stdout.encoding != 'utf-8':
     logger.warning(f"⚠️ stdout encoding es {sys.stdout.encoding}, no UTF-8")
 os.environ['PYTHONIOENCODING'] = 'utf-8'
 
-# 🔥 CACHÉ SIMPLE para evitar consultas repetitivas a AS400
-# Cache de últimas posiciones con TTL de 30 segundos
-CACHE = {
-    'latest_positions': {
-        'data': None,
-        'timestamp': None,
-        'ttl_seconds': 30  # Cache válido por 30 segundos
-    }
+# 🔥 CACHÉ DE RESPUESTAS para evitar consultas repetitivas a AS400
+# Caché TTL + LRU con clave = endpoint + todos sus parámetros, acotado por memoria.
+# TTL por endpoint (segundos), configurable con CACHE_TTL_<NOMBRE> (ej: CACHE_TTL_LATEST_POSITIONS=20)
+CACHE_TTLS = {
+    # Posiciones en vivo: TTL corto
+    'latest_positions': 30,
+    'coordinates': 15,
+    'all_coordinates': 30,
+    # Pedidos/servicios del día: cambian seguido
+    'pedidos_servicios': 15,
+    'pedidos_servicios_pendientes': 15,
+    'pedidos_servicios_batch': 15,
+    'pedidos_servicios_pendientes_batch': 15,
+    # Datos de referencia y detalles: TTL largo
+    'empresas_fleteras': 3600,
+    'moviles_por_empresa': 600,
+    'pedido_detalle': 300,
+    'servicio_detalle': 300,
+    # Detalles por ID individual (LRU compartido por /pedidos-detalle y /servicios-detalle)
+    'pedido_item': 300,
+    'servicio_item': 300,
+    # Cuerpos ya serializados/comprimidos de /latest-positions (la clave incluye la versión)
+    'encoded_bodies': 120,
+    # Tiles del mapa (/latest-positions con zoom): la clave incluye la versión de los datos
+    'viewport_tiles': 120,
 }
+for _name in CACHE_TTLS:
+    _env_ttl = os.getenv(f'CACHE_TTL_{_name.upper()}')
+    if _env_ttl:
+        CACHE_TTLS[_name] = float(_env_ttl)
 
-def get_cached_data(cache_key: str):
-    """Obtener datos del cache si son recientes"""
-    if cache_key not in CACHE:
-        return None
-    
-    cache_entry = CACHE[cache_key]
-    if cache_entry['data'] is None or cache_entry['timestamp'] is None:
-        return None
+CACHE_MAX_BYTES = int(float(os.getenv('CACHE_MAX_MB', '64')) * 1024 * 1024)
+
+
+def _estimate_size(value: Any, _depth: int = 0) -> int:
+    """Tamaño aproximado en memoria; en listas grandes muestrea y extrapola"""
+    size = sys.getsizeof(value)
+    if _depth > 4:
+        return size
+    if isinstance(value, dict):
+        size += sum(_estimate_size(k, _depth + 1) + _estimate_size(v, _depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple)) and value:
+        sample = value[:20]
+        sample_size = sum(_estimate_size(v, _depth + 1) for v in sample)
+        size += sample_size * len(value) // len(sample)
+    return size
+
+
+class CacheEntry:
+    __slots__ = ('value', 'created_at', 'expires_at', 'size')
+
+    def __init__(self, value: Any, ttl: float, size: int):
+        self.value = value
+        self.created_at = time.monotonic()
+        self.expires_at = self.created_at + ttl
+        self.size = size
+
+
+class TTLCache:
+    """
+    Caché TTL con evicción LRU cuando se supera max_bytes.
     
-    # Verificar si el cache expiró
-    elapsed = (datetime.now() - cache_entry['timestamp']).total_seconds()
-    if elapsed > cache_entry['ttl_seconds']:
-        logger.info(f"💨 Cache expirado para {cache_key} (edad: {elapsed:.1f}s)")
-        return None
+    Las claves son tuplas (namespace, ...) y las estadísticas se llevan por namespace.
+    Se usa desde el event loop y desde threads, así que todo pasa por un lock.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[Any, CacheEntry]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, namespace: str, counter: str):
+        ns = self._stats.setdefault(namespace, {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'sets': 0})
+        ns[counter] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def get(self, key) -> Optional[Tuple[Any, float]]:
+        """(valor, edad en segundos) o None si no está o expiró"""
+        namespace = key[0]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(namespace, 'misses')
+                return None
+            now = time.monotonic()
+            if now >= entry.expires_at:
+                self._remove(key)
+                self._count(namespace, 'expired')
+                self._count(namespace, 'misses')
+                return None
+            self._entries.move_to_end(key)
+            self._count(namespace, 'hits')
+            return entry.value, now - entry.created_at
+
+    def set(self, key, value: Any, ttl: float):
+        if ttl <= 0:
+            return
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            logger.warning(f"⚠️ Respuesta de {size} bytes no entra en el caché ({key[0]})")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(value, ttl, size)
+            self._bytes += size
+            self._count(key[0], 'sets')
+            while self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._count(oldest_key[0], 'evictions')
+
+    def invalidate(self, namespace: Optional[str] = None):
+        with self._lock:
+            for key in [k for k in self._entries if namespace is None or k[0] == namespace]:
+                self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            namespaces = {}
+            for namespace, counters in self._stats.items():
+                lookups = counters['hits'] + counters['misses']
+                namespaces[namespace] = {
+                    **counters,
+                    'hit_rate': round(counters['hits'] / lookups, 4) if lookups else None,
+                    'ttl_seconds': CACHE_TTLS.get(namespace),
+                }
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'namespaces': namespaces,
+            }
+
+
+RESPONSE_CACHE = TTLCache(CACHE_MAX_BYTES)
+
+
+def cached_route(namespace: str, when: Optional[Callable[[Dict[str, Any]], bool]] = None):
+    """
+    Decorador para endpoints: cachea la respuesta con clave = namespace + todos los parámetros.
     
-    logger.info(f"✨ Cache HIT para {cache_key} (edad: {elapsed:.1f}s)")
-    return cache_entry['data']
+    Va debajo de @app.get(...). Solo se cachean respuestas exitosas (las excepciones no).
+    Si la respuesta tiene el campo "cached", los hits lo devuelven en True.
+    `when(kwargs)` permite saltear el caché para requests que se resuelven por otra vía.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if when is not None and not when(kwargs):
+                return await fn(*args, **kwargs)
+            params = tuple(sorted(
+                (k, v) for k, v in kwargs.items()
+                if v is None or isinstance(v, (str, int, float, bool))
+            ))
+            key = (namespace, params)
+            hit = RESPONSE_CACHE.get(key)
+            if hit is not None:
+                value, age = hit
+                logger.info(f"✨ Cache HIT para {namespace} (edad: {age:.1f}s)")
+                if isinstance(value, dict) and 'cached' in value:
+                    return {**value, 'cached': True}
+                return value
+            
+            value = await fn(*args, **kwargs)
+            RESPONSE_CACHE.set(key, value, CACHE_TTLS[namespace])
+            return value
+        return wrapper
+    return decorator
+
+# ⚡ BACKEND JSON: orjson si está instalado (JSON_BACKEND=auto), o forzado con
+# JSON_BACKEND=orjson|json. Ambos producen los mismos bytes para nuestros payloads.
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto').lower()
+if JSON_BACKEND not in ('auto', 'orjson', 'json'):
+    logger.warning(f"⚠️ JSON_BACKEND={JSON_BACKEND} desconocido, se usa auto")
+    JSON_BACKEND = 'auto'
+if JSON_BACKEND != 'json' and orjson is None:
+    if JSON_BACKEND == 'orjson':
+        logger.warning("⚠️ JSON_BACKEND=orjson pero orjson no está instalado, se usa json")
+    JSON_BACKEND = 'json'
+elif JSON_BACKEND == 'auto':
+    JSON_BACKEND = 'orjson'
+logger.info(f"⚡ Backend JSON: {JSON_BACKEND}")
 
-def set_cached_data(cache_key: str, data: Any):
-    """Guardar datos en cache"""
-    CACHE[cache_key]['data'] = data
-    CACHE[cache_key]['timestamp'] = datetime.now()
-    logger.info(f"💾 Cache actualizado para {cache_key}")
 
 # 🔧 ENCODING FIX: Respuesta JSON con charset=utf-8 explícito y ensure_ascii=False
 # para que ñ, á, é, í, ó, ú se serialicen correctamente (no como \u00f1 etc.)
+def _dumps_stdlib(content: Any) -> bytes:
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+        default=str,
+    ).encode("utf-8")
+
+
+if orjson is not None:
+    # Fechas y dataclasses pasan por default=str como en json.dumps (orjson usaría ISO 'T');
+    # claves no-string se convierten a string como en json.dumps
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+
+
+def _has_non_finite(value: Any) -> bool:
+    """True si hay algún float NaN/Infinity dentro de dicts/listas/tuplas."""
+    cls = value.__class__
+    if cls is float:
+        return value - value != 0
+    if cls is dict:
+        values = value.values()
+    elif cls is list or cls is tuple:
+        values = value
+    else:
+        return False
+    for v in values:
+        c = v.__class__
+        if c is float:
+            if v - v != 0:
+                return True
+        elif (c is dict or c is list or c is tuple) and _has_non_finite(v):
+            return True
+    return False
+
+
+def _dumps_orjson(content: Any) -> bytes:
+    """
+    orjson escribe NaN/Infinity como null en vez de rechazarlos: si la salida tiene algún
+    null se revisan los floats del payload (centroides, clusters, espejo SQLite...) y se
+    lanza el mismo ValueError que json.dumps(allow_nan=False).
+    """
+    try:
+        body = orjson.dumps(content, default=str, option=_ORJSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        # Enteros de más de 64 bits, surrogates, etc.: mismo resultado/error que json.dumps
+        return _dumps_stdlib(content)
+    if b"null" in body and _has_non_finite(content):
+        raise ValueError("Out of range float values are not JSON compliant")
+    return body
+
+
+# Serialización JSON compacta en UTF-8 (la usan las respuestas y el stream SSE)
+dumps_json: Callable[[Any], bytes] = _dumps_orjson if JSON_BACKEND == 'orjson' else _dumps_stdlib
+
+
 class UTF8JSONResponse(JSONResponse):
     media_type = "application/json; charset=utf-8"
     
     def render(self, content: Any) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=None,
-            separators=(",", ":"),
-            default=str,
-        ).encode("utf-8")
+        return dumps_json(content)
+
+
+# 🗜️ COMPRESIÓN: gzip (y brotli si está instalado) negociado por Accept-Encoding, solo para
+# cuerpos de al menos minimum_size bytes. No se comprimen los streams SSE ni las respuestas
+# que ya traen Content-Encoding (cuerpos precomprimidos de /latest-positions).
+COMPRESSION_CONFIG = {
+    'enabled': os.getenv('COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'minimum_size': int(os.getenv('COMPRESSION_MIN_SIZE', '1024')),
+    'gzip_level': int(os.getenv('COMPRESSION_GZIP_LEVEL', '6')),
+    'brotli_quality': int(os.getenv('COMPRESSION_BROTLI_QUALITY', '5')),
+    # Los cuerpos cacheados se comprimen una vez por versión: se puede usar el nivel máximo
+    'precompressed_gzip_level': int(os.getenv('COMPRESSION_PRECOMPRESSED_GZIP_LEVEL', '9')),
+    'precompressed_brotli_quality': int(os.getenv('COMPRESSION_PRECOMPRESSED_BROTLI_QUALITY', '9')),
+}
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> str:
+    """'br', 'gzip' o 'identity' según Accept-Encoding (br solo si brotli está instalado)"""
+    if not accept_encoding or not COMPRESSION_CONFIG['enabled']:
+        return 'identity'
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, *coding_params = [p.strip() for p in part.split(';')]
+        quality = 1.0
+        for param in coding_params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.lower()] = quality
+    wildcard = accepted.get('*', 0.0)
+    if brotli is not None and accepted.get('br', wildcard) > 0:
+        return 'br'
+    if accepted.get('gzip', wildcard) > 0:
+        return 'gzip'
+    return 'identity'
+
+
+class StreamCompressor:
+    """Compresor incremental: cada chunk se emite completo (flush) para no demorar streams"""
+
+    def __init__(self, encoding: str, precompressed: bool = False):
+        self.encoding = encoding
+        if encoding == 'br':
+            key = 'precompressed_brotli_quality' if precompressed else 'brotli_quality'
+            self._compressor = brotli.Compressor(quality=COMPRESSION_CONFIG[key])
+        else:
+            key = 'precompressed_gzip_level' if precompressed else 'gzip_level'
+            self._compressor = zlib.compressobj(COMPRESSION_CONFIG[key], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.finish()
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+def compress_body(body: bytes, encoding: str, precompressed: bool = False) -> bytes:
+    return StreamCompressor(encoding, precompressed).finish(body)
+
+
+class CompressionMiddleware:
+    """Middleware ASGI de compresión (respuestas completas y streaming)"""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get('accept-encoding'))
+        if encoding == 'identity':
+            await self.app(scope, receive, send)
+            return
+        
+        start_message = None
+        compressor: Optional[StreamCompressor] = None
+        passthrough = False
+        
+        async def compressing_send(message):
+            nonlocal start_message, compressor, passthrough
+            if message['type'] == 'http.response.start':
+                start_message = message
+                return
+            if message['type'] != 'http.response.body' or passthrough:
+                await send(message)
+                return
+            
+            body = message.get('body', b"")
+            more_body = message.get('more_body', False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start_message['headers'])
+                if ('content-encoding' in headers
+                        or headers.get('content-type', '').startswith('text/event-stream')
+                        or start_message['status'] in (204, 304)
+                        or (not more_body and len(body) < self.minimum_size)):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                
+                compressor = StreamCompressor(encoding)
+                headers['Content-Encoding'] = encoding
+                headers.add_vary_header('Accept-Encoding')
+                if more_body:
+                    del headers['Content-Length']
+                    body = compressor.compress(body)
+                else:
+                    body = compressor.finish(body)
+                    headers['Content-Length'] = str(len(body))
+                await send(start_message)
+                await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+                return
+            
+            body = compressor.compress(body) if more_body else compressor.finish(body)
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+        
+        await self.app(scope, receive, compressing_send)
+
+
+def precompressed_json(request: Request, response: Response, key: Tuple[Any, ...], build: Callable[[], Dict[str, Any]]) -> Response:
+    """
+    Respuesta JSON cuyo cuerpo se serializa (y comprime por encoding) una sola vez por `key`.
+    
+    `key` debe identificar el cuerpo completo (versión de los datos + parámetros); los
+    headers del `response` inyectado (Age, ETag, ...) se copian a la respuesta.
+    """
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    hit = RESPONSE_CACHE.get(('encoded_bodies', key, 'identity'))
+    if hit is not None:
+        body = hit[0]
+    else:
+        body = dumps_json(jsonable_encoder(build()))
+        RESPONSE_CACHE.set(('encoded_bodies', key, 'identity'), body, CACHE_TTLS['encoded_bodies'])
+    
+    headers = {k: v for k, v in response.headers.items() if k not in ('content-length', 'vary')}
+    headers['Vary'] = 'Accept, Accept-Encoding'
+    if encoding != 'identity' and len(body) >= COMPRESSION_CONFIG['minimum_size']:
+        hit = RESPONSE_CACHE.get(('encoded_bodies', key, encoding))
+        if hit is not None:
+            body = hit[0]
+        else:
+            body = compress_body(body, encoding, precompressed=True)
+            RESPONSE_CACHE.set(('encoded_bodies', key, encoding), body, CACHE_TTLS['encoded_bodies'])
+        headers['Content-Encoding'] = encoding
+    return Response(content=body, media_type=UTF8JSONResponse.media_type, headers=headers)
+
+
+async def _pool_eviction_loop():
+    """Tarea de fondo: cerrar periódicamente las conexiones ociosas del pool"""
+    while True:
+        await asyncio.sleep(POOL_CONFIG['eviction_interval'])
+        try:
+            await run_db(DB_POOL.evict_idle)
+        except Exception as e:
+            logger.error(f"❌ Error en evicción del pool AS400: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Ciclo de vida de la app: el pool de conexiones vive mientras vive el proceso"""
+    # El warm-up corre en segundo plano para que /health y /ready respondan mientras tanto
+    if WARMUP_CONFIG['enabled']:
+        tasks = [asyncio.create_task(_warmup_loop())]
+    else:
+        STARTUP_STATE.update(ready=True, phase='ready', startup_seconds=round(time.monotonic() - PROCESS_STARTED_AT, 3))
+        tasks = []
+    tasks.append(asyncio.create_task(_pool_eviction_loop()))
+    tasks.append(asyncio.create_task(FLEET_SNAPSHOT.run()))
+    if LIVE_POSITIONS.enabled:
+        tasks.append(asyncio.create_task(LIVE_POSITIONS.run()))
+    if HISTORY_MIRROR.enabled:
+        tasks.append(asyncio.create_task(HISTORY_MIRROR.run()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await run_db(DB_POOL.close)
+        DB_EXECUTOR.shutdown()
+        DB_CURSOR_EXECUTOR.shutdown()
 
 
 app = FastAPI(
@@ -85,6 +526,7 @@ app = FastAPI(
     description="API REST para consultar datos de tracking de vehículos desde AS400 DB2",
     version="1.0.0",
     default_response_class=UTF8JSONResponse,
+    lifespan=lifespan,
 )
 
 # Middleware deshabilitado temporalmente para diagnosticar
@@ -108,6 +550,8 @@ app = FastAPI(
 #     
 #     return response
 
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_CONFIG['minimum_size'])
+
 # Configurar CORS para permitir requests desde Next.js
 app.add_middleware(
     CORSMiddleware,
@@ -137,12 +581,48 @@ AS400_CONFIG = {
 # Path al driver JT400
 JT400_JAR = os.getenv('JT400_JAR_PATH', './jt400.jar')
 
+# ☕ JAVA_HOME: en Windows se fuerza Java 21 por defecto para evitar crashes con JPype + Python 3.13.
+# Se puede sobreescribir con AS400_JAVA_HOME o JAVA_HOME (Docker/Linux usan el JDK del sistema).
+JAVA_HOME = (
+    os.getenv('AS400_JAVA_HOME')
+    or os.getenv('JAVA_HOME')
+    or (r'C:\Program Files\Java\jdk-21' if os.name == 'nt' else None)
+)
+if JAVA_HOME:
+    os.environ['JAVA_HOME'] = JAVA_HOME
+
+
+_JVM_LOCK = threading.Lock()
+
+
+def boot_jvm():
+    """
+    Arrancar la JVM y cargar el driver JT400 (idempotente).
+    
+    Usa los mismos argumentos que JayDeBeAPI, que al encontrar la JVM ya iniciada
+    simplemente la reutiliza en cada connect().
+    """
+    with _JVM_LOCK:
+        if not jpype.isJVMStarted():
+            logger.info(f"☕ Iniciando JVM (JAVA_HOME: {os.environ.get('JAVA_HOME', 'default del sistema')})")
+            class_path = [JT400_JAR]
+            if os.getenv('CLASSPATH'):
+                class_path.extend(os.environ['CLASSPATH'].split(os.pathsep))
+            jpype.startJVM(
+                jpype.getDefaultJVMPath(),
+                f"-Djava.class.path={os.pathsep.join(class_path)}",
+                ignoreUnrecognized=True,
+                convertStrings=True,
+            )
+        # Registrar el driver en DriverManager (carga las clases de JT400)
+        jpype.JClass(AS400_CONFIG['driver'])
+
 
 def _connect_to_db():
     """Función auxiliar para conectar (se ejecutará en thread)"""
-    # Forzar Java 21 para evitar crashes con JPype + Python 3.13
-    os.environ['JAVA_HOME'] = r'C:\Program Files\Java\jdk-21'
-    logger.info(f"☕ Usando JAVA_HOME: {os.environ['JAVA_HOME']}")
+    # Si llega un request antes de que termine el warm-up, evitar que JayDeBeAPI
+    # arranque la JVM en paralelo desde otro thread
+    boot_jvm()
     
     # 🔧 ENCODING FIX: Pasar propiedades de conexión para forzar traducción de caracteres
     # Estas propiedades complementan las del JDBC URL y aseguran la conversión EBCDIC → UTF-8
@@ -167,7 +647,9 @@ def get_db_connection(timeout_seconds=10):
     try:
         logger.info(f"🔵 Intentando conectar a AS400: {AS400_CONFIG['url']} (timeout: {timeout_seconds}s)")
         
-        with ThreadPoolExecutor(max_workers=1) as executor:
+        # No usar "with": el shutdown implícito esperaría al connect colgado y el timeout no serviría
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
             future = executor.submit(_connect_to_db)
             try:
                 conn = future.result(timeout=timeout_seconds)
@@ -179,6 +661,8 @@ def get_db_connection(timeout_seconds=10):
                     status_code=504,
                     detail=f"Timeout conectando a AS400 después de {timeout_seconds}s. Verifica que AS400 está accesible."
                 )
+        finally:
+            executor.shutdown(wait=False)
     
     except HTTPException:
         raise
@@ -190,523 +674,3530 @@ def get_db_connection(timeout_seconds=10):
         )
 
 
-def execute_query(query: str) -> List[Dict[str, Any]]:
-    """Ejecutar query y retornar resultados como lista de diccionarios"""
-    conn = None
-    cursor = None
-    
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        logger.info(f"🔍 Ejecutando query: {query[:100]}...")
-        cursor.execute(query)
-        
-        # Obtener nombres de columnas
-        columns = [desc[0].lower() for desc in cursor.description]
-        
-        # Convertir filas a diccionarios
-        results = []
-        for row in cursor.fetchall():
-            row_dict = {}
-            for i, value in enumerate(row):
-                col_name = columns[i]
-                
-                # Convertir tipos de datos
-                if isinstance(value, datetime):
-                    row_dict[col_name] = value.isoformat()
-                elif value is None:
-                    row_dict[col_name] = None
-                elif isinstance(value, (bytes, bytearray)):
-                    # 🔧 ENCODING FIX: JayDeBeAPI puede devolver bytes para campos CHAR/VARCHAR
-                    # de AS400 con CCSID 65535. Intentar decodificar con múltiples encodings.
-                    try:
-                        row_dict[col_name] = value.decode('utf-8')
-                    except UnicodeDecodeError:
-                        try:
-                            row_dict[col_name] = value.decode('latin-1')
-                        except UnicodeDecodeError:
-                            try:
-                                row_dict[col_name] = value.decode('cp1252')
-                            except UnicodeDecodeError:
-                                row_dict[col_name] = value.decode('utf-8', errors='replace')
-                                logger.warning(f"⚠️ Encoding fallback (replace) para columna {col_name}")
-                elif isinstance(value, str):
-                    row_dict[col_name] = value
-                else:
-                    row_dict[col_name] = value
-            
-            results.append(row_dict)
-        
-        logger.info(f"✅ Query exitoso: {len(results)} filas retornadas")
-        return results
-    
-    except Exception as e:
-        logger.error(f"❌ Error en query: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error ejecutando query: {str(e)}"
-        )
-    
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+# 🏊 POOL DE CONEXIONES: el sign-on de AS400 cuesta más que la mayoría de las queries,
+# así que las conexiones se reutilizan entre requests en lugar de abrir/cerrar cada vez.
+POOL_CONFIG = {
+    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '8')),
+    'borrow_timeout': float(os.getenv('DB_POOL_BORROW_TIMEOUT', '15')),
+    'idle_timeout': float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300')),
+    'eviction_interval': float(os.getenv('DB_POOL_EVICTION_INTERVAL', '60')),
+    'connect_timeout': float(os.getenv('DB_CONNECT_TIMEOUT', '10')),
+    'validation_query': 'SELECT 1 FROM SYSIBM.SYSDUMMY1',
+}
 
 
-@app.get("/")
-async def root():
-    """Endpoint raíz - información de la API"""
-    print("🌐 ROOT ENDPOINT LLAMADO!", flush=True)
-    logger.info("Root endpoint llamado")
-    return {
-        "api": "TrackMovil AS400 API",
-        "version": "1.0.0",
-        "status": "running",
-        "endpoints": {
-            "latest-positions": "/latest-positions?startDate=2025-10-14 (última posición de TODOS los móviles)",
-            "latest-positions-filtered": "/latest-positions?startDate=2025-10-14&movilIds=693,251,337 (última posición de móviles específicos)",
-            "coordinates": "/coordinates?movilId=693&startDate=2025-10-14 (última coordenada de UN móvil)",
-            "coordinates-history": "/coordinates?movilId=693&startDate=2025-10-14&limit=100 (historial de UN móvil)",
-            "all-coordinates": "/all-coordinates?startDate=2025-10-14 (historial de TODOS los móviles)",
-            "health": "/health",
-            "test-db": "/test-db (prueba conexión AS400)",
-            "docs": "/docs"
-        }
-    }
+# 📑 CACHÉ DE PREPARED STATEMENTS: las queries usan parameter markers (?) en lugar de
+# valores embebidos, así el texto del statement es estable y cada conexión puede
+# reutilizar el PreparedStatement (y DB2 el plan de acceso) entre requests.
+STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '32'))
 
+STATEMENT_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+}
+_STATEMENT_CACHE_LOCK = threading.Lock()
 
-@app.get("/ping")
-async def ping():
-    """Endpoint ultra simple para verificar que la API responde"""
-    print("🏓 PING RECIBIDO!", flush=True)
-    logger.info("🏓 PING recibido")
-    return {"status": "ok", "message": "pong", "timestamp": datetime.now().isoformat()}
 
+def _count_statement_cache(counter: str):
+    with _STATEMENT_CACHE_LOCK:
+        STATEMENT_CACHE_STATS[counter] += 1
 
-@app.get("/coordinates-mock")
-async def get_coordinates_mock(
-    movilId: int = Query(..., description="ID del vehículo"),
-    startDate: str = Query("2025-10-14", description="Fecha inicial"),
-    limit: int = Query(10, description="Límite de registros")
-):
-    """Endpoint de prueba que devuelve datos simulados (NO consulta AS400)"""
-    logger.info(f"📥 MOCK Request: movilId={movilId}, startDate={startDate}, limit={limit}")
-    
-    # Datos de prueba para verificar que la comunicación funciona
-    mock_data = [
-        {
-            "identificador": movilId,
-            "origen": "GPS",
-            "coordx": -34.9011 + (i * 0.001),
-            "coordy": -56.1645 + (i * 0.001),
-            "fechainslog": f"{startDate}T{10+i}:30:00",
-            "auxin2": "TEST",
-            "distrecorrida": 10.5 + i
+
+def statement_cache_stats() -> Dict[str, Any]:
+    with _STATEMENT_CACHE_LOCK:
+        lookups = STATEMENT_CACHE_STATS['hits'] + STATEMENT_CACHE_STATS['misses']
+        return {
+            'capacity_per_connection': STATEMENT_CACHE_SIZE,
+            **STATEMENT_CACHE_STATS,
+            'hit_rate': round(STATEMENT_CACHE_STATS['hits'] / lookups, 4) if lookups else None,
         }
-        for i in range(min(limit, 10))
-    ]
+
+
+class CachedStatementCursor(jaydebeapi.Cursor):
+    """
+    Cursor JayDeBeAPI que toma el PreparedStatement del caché de la conexión.
     
-    return {
-        "success": True,
-        "movilId": movilId,
-        "startDate": startDate,
-        "count": len(mock_data),
-        "data": mock_data,
-        "note": "DATOS DE PRUEBA - No son datos reales de AS400"
-    }
+    Igual que jaydebeapi.Cursor salvo que al cerrar (o re-ejecutar) solo cierra el
+    ResultSet: el statement queda vivo en el caché para el próximo request.
+    """
 
+    def __init__(self, pooled: 'PooledConnection'):
+        super().__init__(pooled.conn, pooled.conn._converters)
+        self._pooled = pooled
 
-@app.get("/health")
-async def health_check():
-    """Verificar estado de la API"""
-    return {
-        "status": "healthy",
-        "api": "running",
-        "timestamp": datetime.now().isoformat(),
-        "message": "API is running. Use /test-db to test AS400 connection"
-    }
+    def execute(self, operation, parameters=None):
+        if self._connection._closed:
+            raise jaydebeapi.Error()
+        if not parameters:
+            parameters = ()
+        self._close_last()
+        self._prep = self._pooled.prepare(operation)
+        self._set_stmt_parms(self._prep, parameters)
+        try:
+            is_rs = self._prep.execute()
+        except Exception:
+            # Un statement que falló puede haber quedado inválido: no reutilizarlo
+            self._pooled.forget(operation)
+            self._prep = None
+            jaydebeapi._handle_sql_exception()
+        if is_rs:
+            self._rs = self._prep.getResultSet()
+            self._meta = self._rs.getMetaData()
+            self.rowcount = -1
+        else:
+            self.rowcount = self._prep.getUpdateCount()
 
+    def _close_last(self):
+        if self._rs:
+            self._rs.close()
+        self._rs = None
+        self._prep = None
+        self._meta = None
+        self._description = None
 
-@app.get("/test-db")
-async def test_database():
-    """Probar conexión con AS400 (puede tardar)"""
-    try:
-        logger.info("🔍 Intentando conectar a AS400...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM SYSIBM.SYSDUMMY1")
-        cursor.fetchone()
-        cursor.close()
-        conn.close()
+
+class PooledConnection:
+    """Conexión JayDeBeAPI con la metadata que necesita el pool y su caché LRU de statements"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+        self.statements = OrderedDict()  # texto SQL → java.sql.PreparedStatement
+
+    def cursor(self) -> CachedStatementCursor:
+        return CachedStatementCursor(self)
+
+    def prepare(self, sql: str):
+        """PreparedStatement para `sql`, reutilizado si ya se preparó en esta conexión"""
+        stmt = self.statements.get(sql)
+        if stmt is not None:
+            self.statements.move_to_end(sql)
+            _count_statement_cache('hits')
+            return stmt
         
-        return {
-            "status": "success",
-            "database": "connected",
-            "host": AS400_CONFIG['url'],
-            "timestamp": datetime.now().isoformat()
-        }
-    
-    except Exception as e:
-        logger.error(f"❌ Error de conexión: {str(e)}")
-        return {
-            "status": "error",
-            "database": "disconnected",
-            "error": str(e),
-            "timestamp": datetime.now().isoformat()
-        }
+        _count_statement_cache('misses')
+        stmt = self.conn.jconn.prepareStatement(sql)
+        self.statements[sql] = stmt
+        if len(self.statements) > STATEMENT_CACHE_SIZE:
+            _, oldest = self.statements.popitem(last=False)
+            _count_statement_cache('evictions')
+            self._close_statement(oldest)
+        return stmt
 
+    def forget(self, sql: str):
+        stmt = self.statements.pop(sql, None)
+        if stmt is not None:
+            self._close_statement(stmt)
 
-@app.get("/empresas-fleteras")
-async def get_empresas_fleteras():
+    @staticmethod
+    def _close_statement(stmt):
+        try:
+            stmt.close()
+        except Exception:
+            pass
+
+    def close(self):
+        for stmt in self.statements.values():
+            self._close_statement(stmt)
+        self.statements.clear()
+        try:
+            self.conn.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Error cerrando conexión AS400: {str(e)}")
+
+
+class ConnectionPool:
     """
-    Obtener lista de todas las empresas fleteras
+    Pool acotado de conexiones JT400.
     
-    Returns:
-        Lista de empresas con EFLID, EFLNOM (nombre), EFLESTADO
+    - min_size conexiones se mantienen abiertas aunque estén ociosas
+    - max_size es el tope de conexiones simultáneas contra el AS400
+    - acquire() espera hasta borrow_timeout si el pool está agotado (→ 503)
+    - cada conexión se valida al prestarla; si falla se descarta y se reconecta
+    - las conexiones ociosas más de idle_timeout se cierran (respetando min_size)
     """
-    try:
-        logger.info("📋 Obteniendo empresas fleteras...")
+
+    def __init__(self, connect, min_size, max_size, borrow_timeout, idle_timeout, validation_query):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.borrow_timeout = borrow_timeout
+        self.idle_timeout = idle_timeout
+        self.validation_query = validation_query
+        self._idle = deque()
+        self._size = 0  # conexiones abiertas + en proceso de apertura
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats_counters = {
+            'created': 0,
+            'borrowed': 0,
+            'validation_failures': 0,
+            'discarded': 0,
+            'evicted': 0,
+            'borrow_timeouts': 0,
+            'connect_errors': 0,
+        }
+
+    def _open(self) -> PooledConnection:
+        """Abrir una conexión nueva (el slot ya fue reservado en _size)"""
+        try:
+            pooled = PooledConnection(self._connect())
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self.stats_counters['connect_errors'] += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats_counters['created'] += 1
+        return pooled
+
+    def _validate(self, pooled: PooledConnection) -> bool:
+        cursor = None
+        try:
+            cursor = pooled.cursor()
+            cursor.execute(self.validation_query)
+            cursor.fetchone()
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Conexión AS400 inválida, se descarta: {str(e)}")
+            return False
+        finally:
+            if cursor:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    def _discard(self, pooled: PooledConnection):
+        pooled.close()
+        with self._cond:
+            self._size -= 1
+            self.stats_counters['discarded'] += 1
+            self._cond.notify()
+
+    def acquire(self, timeout: Optional[float] = None) -> PooledConnection:
+        """Pedir prestada una conexión validada"""
+        timeout = self.borrow_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
         
-        query = """
-            SELECT EFLID, EFLNOM, EFLESTADO 
-            FROM GXCALDTA.EFLETERA 
-            ORDER BY EFLNOM
+        while True:
+            pooled = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise HTTPException(status_code=503, detail="Pool de conexiones AS400 cerrado")
+                    if self._idle:
+                        pooled = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats_counters['borrow_timeouts'] += 1
+                        logger.error(f"⏱️ Pool AS400 agotado: {self.max_size} conexiones en uso durante {timeout}s")
+                        raise HTTPException(
+                            status_code=503,
+                            detail=f"Pool de conexiones AS400 agotado ({self.max_size} en uso). Reintente en unos segundos."
+                        )
+                    self._cond.wait(remaining)
+            
+            if pooled is None:
+                # Slot reservado: abrir conexión nueva (recién creada, no hace falta validar)
+                pooled = self._open()
+            elif not self._validate(pooled):
+                with self._cond:
+                    self.stats_counters['validation_failures'] += 1
+                self._discard(pooled)
+                continue
+            
+            pooled.uses += 1
+            with self._cond:
+                self.stats_counters['borrowed'] += 1
+            return pooled
+
+    def release(self, pooled: PooledConnection, broken: bool = False):
+        """Devolver la conexión al pool (o descartarla si quedó rota)"""
+        if broken or self._closed:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
         """
+        Context manager para usar una conexión del pool:
         
-        results = execute_query(query)
+            with DB_POOL.connection() as conn:
+                cursor = conn.cursor()  # reutiliza PreparedStatements de la conexión
         
-        # Procesar resultados para limpiar espacios en CHAR fields
-        for row in results:
-            if 'eflnom' in row and row['eflnom']:
-                row['eflnom'] = str(row['eflnom']).strip()
-            if 'eflestado' in row and row['eflestado']:
-                row['eflestado'] = str(row['eflestado']).strip()
-        
-        logger.info(f"✅ {len(results)} empresas fleteras encontradas")
-        
-        return {
-            "success": True,
-            "count": len(results),
-            "data": results,
-            "timestamp": datetime.now().isoformat()
-        }
-    
-    except Exception as e:
-        logger.error(f"❌ Error obteniendo empresas fleteras: {str(e)}")
+        Si el bloque lanza una excepción se revalida la conexión; si no responde se descarta
+        y el próximo acquire abrirá una nueva (reconnect-on-failure).
+        """
+        pooled = self.acquire(timeout)
+        broken = False
+        try:
+            yield pooled
+        except HTTPException:
+            raise
+        except Exception:
+            broken = not self._validate(pooled)
+            raise
+        finally:
+            self.release(pooled, broken=broken)
+
+    def fill(self, count: Optional[int] = None):
+        """Abrir conexiones hasta tener al menos `count` (default: min_size)"""
+        target = min(self.min_size if count is None else count, self.max_size)
+        while True:
+            with self._cond:
+                if self._closed or self._size >= target:
+                    return
+                self._size += 1
+            pooled = self._open()
+            self.release(pooled)
+
+    def evict_idle(self):
+        """Cerrar conexiones ociosas vencidas, manteniendo min_size abiertas"""
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            # _idle es LIFO: las más viejas quedan a la izquierda
+            while self._idle and self._size - len(expired) > self.min_size:
+                if now - self._idle[0].last_used < self.idle_timeout:
+                    break
+                expired.append(self._idle.popleft())
+            self._size -= len(expired)
+            self.stats_counters['evicted'] += len(expired)
+        for pooled in expired:
+            pooled.close()
+        if expired:
+            logger.info(f"🧹 Pool AS400: {len(expired)} conexiones ociosas cerradas")
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            pooled.close()
+        logger.info(f"🔌 Pool AS400 cerrado ({len(idle)} conexiones)")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                **self.stats_counters,
+            }
+
+
+DB_POOL = ConnectionPool(
+    connect=lambda: get_db_connection(POOL_CONFIG['connect_timeout']),
+    min_size=POOL_CONFIG['min_size'],
+    max_size=POOL_CONFIG['max_size'],
+    borrow_timeout=POOL_CONFIG['borrow_timeout'],
+    idle_timeout=POOL_CONFIG['idle_timeout'],
+    validation_query=POOL_CONFIG['validation_query'],
+)
+
+
+# 🧵 EXECUTOR DE BASE DE DATOS: JayDeBeAPI es bloqueante, así que todo el trabajo contra
+# AS400 corre en un pool de threads dedicado y acotado. El event loop de uvicorn queda libre
+# (/ping y /health responden aunque haya una query lenta) y los requests concurrentes
+# solapan sus round trips en lugar de serializarse.
+# Los cursores abiertos (streaming) leen y cierran en un executor aparte, con un worker por
+# conexión del pool: si todos los workers principales están esperando una conexión en
+# DB_POOL.acquire(), quien ya tiene una igual puede avanzar y devolverla.
+DB_EXECUTOR_CONFIG = {
+    'workers': int(os.getenv('DB_EXECUTOR_WORKERS', str(POOL_CONFIG['max_size']))),
+}
+
+_DB_THREAD_STATE = threading.local()
+
+
+def _attach_jvm_thread():
+    """Adjuntar el thread actual a la JVM una sola vez (los workers del executor son persistentes)"""
+    if getattr(_DB_THREAD_STATE, 'jvm_attached', False) or not jpype.isJVMStarted():
+        return
+    if not jpype.isThreadAttachedToJVM():
+        # Daemon: la JVM no espera a estos threads al apagarse
+        jpype.java.lang.Thread.attachAsDaemon()
+        jpype.java.lang.Thread.currentThread().setContextClassLoader(
+            jpype.java.lang.ClassLoader.getSystemClassLoader()
+        )
+    _DB_THREAD_STATE.jvm_attached = True
+
+
+class DBExecutor:
+    """ThreadPoolExecutor dedicado a AS400 con métricas de cola y tiempo de espera"""
+
+    def __init__(self, workers: int, thread_name_prefix: str = 'as400-db'):
+        self.workers = max(workers, 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=1000)  # segundos en cola de los últimos trabajos
+        self.counters = {
+            'queued': 0,
+            'running': 0,
+            'max_queued': 0,
+            'completed': 0,
+            'failed': 0,
+            'cancelled': 0,
+        }
+
+    async def run(self, fn, *args, **kwargs):
+        """Ejecutar fn(*args, **kwargs) en un worker y esperar el resultado sin bloquear el event loop"""
+        submitted = time.monotonic()
+        with self._lock:
+            self.counters['queued'] += 1
+            self.counters['max_queued'] = max(self.counters['max_queued'], self.counters['queued'])
+        
+        def job():
+            started = time.monotonic()
+            with self._lock:
+                self.counters['queued'] -= 1
+                self.counters['running'] += 1
+                self._waits.append(started - submitted)
+            try:
+                _attach_jvm_thread()
+                result = fn(*args, **kwargs)
+            except BaseException:
+                with self._lock:
+                    self.counters['failed'] += 1
+                raise
+            finally:
+                with self._lock:
+                    self.counters['running'] -= 1
+            with self._lock:
+                self.counters['completed'] += 1
+            return result
+        
+        future = self._executor.submit(job)
+        
+        def on_done(f):
+            # Cancelado antes de empezar (cliente desconectado): sacarlo de la cola
+            if f.cancelled():
+                with self._lock:
+                    self.counters['queued'] -= 1
+                    self.counters['cancelled'] += 1
+        
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            counters = dict(self.counters)
+        
+        def pct(p):
+            return round(waits[min(int(len(waits) * p), len(waits) - 1)] * 1000, 1) if waits else None
+        
+        return {
+            'workers': self.workers,
+            **counters,
+            'wait_ms': {
+                'avg': round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+                'p50': pct(0.50),
+                'p95': pct(0.95),
+                'max': round(waits[-1] * 1000, 1) if waits else None,
+                'samples': len(waits),
+            },
+        }
+
+
+DB_EXECUTOR = DBExecutor(DB_EXECUTOR_CONFIG['workers'])
+DB_CURSOR_EXECUTOR = DBExecutor(POOL_CONFIG['max_size'], thread_name_prefix='as400-cursor')
+
+
+async def run_db(fn, *args, **kwargs):
+    """Atajo para correr trabajo bloqueante de AS400 en el executor dedicado"""
+    return await DB_EXECUTOR.run(fn, *args, **kwargs)
+
+
+async def run_db_cursor(fn, *args, **kwargs):
+    """Como run_db, para trabajo sobre una conexión ya prestada (no llama a DB_POOL.acquire)"""
+    return await DB_CURSOR_EXECUTOR.run(fn, *args, **kwargs)
+
+
+# 🛬 SINGLE-FLIGHT: si llegan varios requests idénticos mientras la query sigue en vuelo
+# (típico cuando vence el caché y todas las pestañas del dashboard pollean a la vez),
+# solo el primero va a AS400 y el resto espera el mismo resultado.
+class SingleFlight:
+    """Coalescer llamadas idénticas concurrentes a AS400 (se usa desde el event loop)"""
+
+    def __init__(self):
+        self._in_flight: Dict[Any, asyncio.Future] = {}
+        self.counters = {
+            'executed': 0,
+            'coalesced': 0,
+        }
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self._in_flight.get(key)
+        if future is None:
+            self.counters['executed'] += 1
+            future = asyncio.ensure_future(run_db(fn, *args, **kwargs))
+            self._in_flight[key] = future
+            
+            def on_done(f):
+                if self._in_flight.get(key) is f:
+                    del self._in_flight[key]
+                # Evitar "exception was never retrieved" si todos los que esperaban se cancelaron
+                if not f.cancelled():
+                    f.exception()
+            
+            future.add_done_callback(on_done)
+        else:
+            self.counters['coalesced'] += 1
+        # shield: si un cliente se desconecta no se cancela la query de los demás
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.counters['executed'] + self.counters['coalesced']
+        return {
+            **self.counters,
+            'in_flight': len(self._in_flight),
+            'coalesce_rate': round(self.counters['coalesced'] / total, 4) if total else None,
+        }
+
+
+DB_SINGLE_FLIGHT = SingleFlight()
+
+
+async def query_db(fn, query: str, params: Sequence[Any] = (), **kwargs):
+    """
+    Ejecutar fn(query, params, **kwargs) en el executor de DB, coalesciendo requests idénticos.
+    
+    El resultado se comparte entre todos los requests coalescidos: tratarlo como solo lectura.
+    """
+    key = (fn.__name__, ' '.join(query.split()), tuple(params), tuple(sorted(kwargs.items())))
+    return await DB_SINGLE_FLIGHT.do(key, fn, query, params, **kwargs)
+
+
+# Aridades fijas para listas IN (...): cada cantidad de IDs se redondea al bucket siguiente
+# para que haya pocos textos de statement distintos (y pocos planes) por query
+IN_LIST_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def in_list_params(values: List[Any]) -> Tuple[str, List[Any]]:
+    """
+    Parameter markers para un IN (...) con aridad fija.
+    
+    Retorna ("?,?,?,?", valores) rellenando con el último valor repetido, lo que no
+    cambia el resultado del IN. Ej: [7, 8, 9] → ("?,?,?,?", [7, 8, 9, 9])
+    """
+    values = list(values)
+    if not values:
+        raise ValueError("in_list_params requiere al menos un valor")
+    n = len(values)
+    bucket = next((b for b in IN_LIST_BUCKETS if b >= n), None)
+    if bucket is None:
+        largest = IN_LIST_BUCKETS[-1]
+        bucket = -(-n // largest) * largest
+    values.extend([values[-1]] * (bucket - n))
+    return ",".join("?" * bucket), values
+
+
+def decode_bytes(value: bytes, col_name: str) -> str:
+    """
+    🔧 ENCODING FIX: JayDeBeAPI puede devolver bytes para campos CHAR/VARCHAR
+    de AS400 con CCSID 65535. Intentar decodificar con múltiples encodings.
+    """
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        try:
+            return value.decode('latin-1')
+        except UnicodeDecodeError:
+            try:
+                return value.decode('cp1252')
+            except UnicodeDecodeError:
+                logger.warning(f"⚠️ Encoding fallback (replace) para columna {col_name}")
+                return value.decode('utf-8', errors='replace')
+
+
+# 🔤 CODEC POR COLUMNA: en lugar de probar utf-8 → latin-1 → cp1252 con excepciones en cada
+# valor, se aprende el codec que funciona para cada (tabla, columna) con el primer valor no-ASCII
+# y luego se usa directo. Las columnas latin-1 se re-validan (valores sospechosos y uno cada N)
+# por si hay datos mezclados; una columna mezclada vuelve a la cadena completa y queda en /metrics.
+ENCODING_CONFIG = {
+    'revalidate_every': int(os.getenv('ENCODING_REVALIDATE_EVERY', '64')),
+}
+
+
+class ColumnCodec:
+    """Codec aprendido para una columna (los contadores son aproximados bajo concurrencia)"""
+
+    __slots__ = ('source', 'column', 'codec', 'mixed', 'values', 'non_ascii', 'fallbacks', 'revalidations')
+
+    def __init__(self, source: str, column: str):
+        self.source = source
+        self.column = column
+        self.codec: Optional[str] = None
+        self.mixed = False
+        self.values = 0
+        self.non_ascii = 0
+        self.fallbacks = 0
+        self.revalidations = 0
+
+    def decode(self, value: bytes) -> str:
+        self.values += 1
+        if value.isascii():
+            return value.decode('ascii')
+        self.non_ascii += 1
+        
+        codec = self.codec
+        if codec == 'utf-8':
+            try:
+                return value.decode('utf-8')
+            except UnicodeDecodeError:
+                self._mark_mixed('latin-1')
+        elif codec == 'latin-1':
+            # Los acentos y la ñ en utf-8 empiezan con 0xC2/0xC3: esos valores (y uno de cada N)
+            # se re-validan; si también son utf-8 válido la columna tiene datos mezclados
+            if (b'\xc3' not in value and b'\xc2' not in value
+                    and self.non_ascii % ENCODING_CONFIG['revalidate_every']):
+                return value.decode('latin-1')
+            self.revalidations += 1
+            try:
+                text = value.decode('utf-8')
+            except UnicodeDecodeError:
+                return value.decode('latin-1')
+            self._mark_mixed('utf-8')
+            return text
+        elif not self.mixed:
+            # Primer valor no-ASCII: mismo orden que decode_bytes (latin-1 nunca falla)
+            try:
+                text = value.decode('utf-8')
+                self.codec = 'utf-8'
+            except UnicodeDecodeError:
+                text = value.decode('latin-1')
+                self.codec = 'latin-1'
+            logger.info(f"🔤 Codec aprendido para {self.source}.{self.column}: {self.codec}")
+            return text
+        
+        self.fallbacks += 1
+        return decode_bytes(value, self.column)
+
+    def _mark_mixed(self, seen: str):
+        if not self.mixed:
+            logger.warning(f"⚠️ Columna {self.source}.{self.column} con encodings mezclados ({self.codec} y {seen}): se usa la cadena completa")
+        self.mixed = True
+        self.codec = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'codec': self.codec or ('mixed' if self.mixed else None),
+            'values': self.values,
+            'non_ascii': self.non_ascii,
+            'fallbacks': self.fallbacks,
+            'fallback_rate': round(self.fallbacks / self.non_ascii, 4) if self.non_ascii else 0.0,
+            'revalidations': self.revalidations,
+        }
+
+
+class CodecRegistry:
+    """ColumnCodec por (tabla, columna), compartido entre result sets y threads"""
+
+    def __init__(self):
+        self._codecs: Dict[Tuple[str, str], ColumnCodec] = {}
+        self._lock = threading.Lock()
+
+    def get(self, source: str, column: str) -> ColumnCodec:
+        key = (source, column)
+        codec = self._codecs.get(key)
+        if codec is None:
+            with self._lock:
+                codec = self._codecs.setdefault(key, ColumnCodec(source, column))
+        return codec
+
+    def stats(self) -> Dict[str, Any]:
+        columns = {f"{c.source}.{c.column}": c.stats() for c in list(self._codecs.values())}
+        return {
+            'columns': columns,
+            'mixed_columns': sorted(name for name, st in columns.items() if st['codec'] == 'mixed'),
+            'total_fallbacks': sum(st['fallbacks'] for st in columns.values()),
+        }
+
+
+CODEC_REGISTRY = CodecRegistry()
+
+_QUERY_SOURCE_RE = re.compile(r'\bFROM\s+([\w.]+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def query_source(query: str) -> str:
+    """
+    Tabla principal de un query (primer FROM), usada como clave del codec por columna.
+    Las columnas que vienen de un JOIN o de un UNION se declaran con `sources`.
+    """
+    match = _QUERY_SOURCE_RE.search(query)
+    return match.group(1).upper() if match else '?'
+
+
+def convert_value(value: Any, codec: ColumnCodec, strip: bool = False) -> Any:
+    """Conversión genérica de un valor (columnas sin tipo conocido en cursor.description)"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        value = codec.decode(bytes(value))
+    if strip and isinstance(value, str):
+        return value.strip()
+    return value
+
+
+class RowConverter:
+    """
+    Plan de conversión de filas armado UNA vez por result set a partir de cursor.description.
+    
+    Cada columna recibe un conversor según su tipo JDBC (o ninguno si el valor ya es
+    serializable) y cada fila se arma con un único dict(zip(...)), sin la cadena de
+    isinstance por valor. Con strip=True se recortan los espacios de los CHAR.
+    Los bytes se decodifican con el codec aprendido para (source, columna); `sources`
+    son pares (columna, tabla) para las columnas que no vienen de `source`.
+    """
+
+    # Filas que se inspeccionan para detectar columnas de texto que el driver entrega como bytes
+    PROBE_ROWS = 32
+
+    def __init__(
+        self,
+        description: Sequence[Sequence[Any]],
+        strip: bool = False,
+        source: str = '?',
+        sources: Sequence[Tuple[str, str]] = ()
+    ):
+        self.columns = [desc[0].lower() for desc in description]
+        column_sources = dict(sources)
+        self.codecs = [CODEC_REGISTRY.get(column_sources.get(col, source), col) for col in self.columns]
+        self.strip = strip
+        self.converters: List[Tuple[int, Callable[[Any], Any]]] = []
+        self._unprobed: List[int] = []
+        for i, desc in enumerate(description):
+            converter = self._converter_for(desc[1], self.codecs[i], strip)
+            if converter is not None:
+                self.converters.append((i, converter))
+            elif desc[1] is jaydebeapi.STRING or desc[1] is jaydebeapi.TEXT:
+                self._unprobed.append(i)
+
+    @staticmethod
+    def _converter_for(type_code: Any, codec: ColumnCodec, strip: bool) -> Optional[Callable[[Any], Any]]:
+        if type_code is jaydebeapi.NUMBER or type_code is jaydebeapi.FLOAT or type_code is jaydebeapi.DECIMAL:
+            return None
+        if type_code is jaydebeapi.STRING or type_code is jaydebeapi.TEXT:
+            if not strip:
+                return None
+            return lambda v: v.strip() if type(v) is str else convert_value(v, codec, strip)
+        if type_code is jaydebeapi.DATETIME or type_code is jaydebeapi.DATE or type_code is jaydebeapi.TIME:
+            # Los conversores de jaydebeapi ya entregan TIMESTAMP/DATE/TIME como str
+            return None
+        if type_code is jaydebeapi.BINARY:
+            return lambda v: codec.decode(bytes(v)) if isinstance(v, (bytes, bytearray)) else v
+        return lambda v: convert_value(v, codec, strip)
+
+    def _probe(self, rows: Sequence[Sequence[Any]]):
+        """
+        El driver entrega siempre la misma clase Java por columna: si una columna CHAR sin
+        conversor llega como bytes (CCSID 65535), se le agrega el decodificador.
+        """
+        for i in self._unprobed:
+            if any(isinstance(row[i], (bytes, bytearray)) for row in rows[:self.PROBE_ROWS]):
+                codec = self.codecs[i]
+                self.converters.append((i, lambda v, codec=codec: convert_value(v, codec, self.strip)))
+        self._unprobed = []
+
+    def __call__(self, row: Sequence[Any]) -> Dict[str, Any]:
+        if not self.converters:
+            return dict(zip(self.columns, row))
+        values = list(row)
+        for i, converter in self.converters:
+            value = values[i]
+            if value is not None:
+                values[i] = converter(value)
+        return dict(zip(self.columns, values))
+
+    def convert_all(self, rows: Sequence[Sequence[Any]]) -> List[Dict[str, Any]]:
+        if self._unprobed and rows:
+            self._probe(rows)
+        columns = self.columns
+        if not self.converters:
+            return [dict(zip(columns, row)) for row in rows]
+        return [self(row) for row in rows]
+
+    def convert_columns(self, rows: Sequence[Sequence[Any]]) -> List[List[Any]]:
+        """Un array por columna (en el orden de self.columns), sin armar diccionarios"""
+        if not rows:
+            return [[] for _ in self.columns]
+        if self._unprobed:
+            self._probe(rows)
+        arrays = [list(values) for values in zip(*rows)]
+        for i, converter in self.converters:
+            arrays[i] = [converter(v) if v is not None else None for v in arrays[i]]
+        return arrays
+
+
+def _fetch_all(
+    query: str,
+    params: Sequence[Any],
+    strip: bool = False,
+    sources: Sequence[Tuple[str, str]] = ()
+) -> Tuple[RowConverter, List[Sequence[Any]]]:
+    """Ejecutar query y retornar (plan de conversión, filas sin convertir)"""
+    with DB_POOL.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            logger.info(f"🔍 Ejecutando query: {' '.join(query.split())[:100]}... params={list(params)[:10]}")
+            cursor.execute(query, params)
+            
+            # Plan de conversión por columna (una vez por result set)
+            converter = RowConverter(cursor.description, strip=strip, source=query_source(query), sources=sources)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    return converter, rows
+
+
+def execute_query(
+    query: str,
+    params: Sequence[Any] = (),
+    strip: bool = False,
+    sources: Sequence[Tuple[str, str]] = ()
+) -> List[Dict[str, Any]]:
+    """
+    Ejecutar query (con parameter markers opcionales) y retornar resultados como lista de diccionarios.
+    Con strip=True se recortan los espacios de las columnas de texto (campos CHAR de AS400).
+    `sources`: pares (columna, tabla) de las columnas que no vienen del primer FROM (ver query_source).
+    """
+    try:
+        converter, rows = _fetch_all(query, params, strip, sources)
+        
+        # Convertir filas a diccionarios
+        results = converter.convert_all(rows)
+        
+        logger.info(f"✅ Query exitoso: {len(results)} filas retornadas")
+        return results
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error en query: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error ejecutando query: {str(e)}"
+        )
+
+
+def execute_query_columnar(query: str, params: Sequence[Any] = ()) -> Tuple[List[str], List[List[Any]]]:
+    """Ejecutar query y retornar (columnas, un array por columna) para format=columnar"""
+    try:
+        converter, rows = _fetch_all(query, params)
+        arrays = converter.convert_columns(rows)
+        logger.info(f"✅ Query exitoso (columnar): {len(rows)} filas retornadas")
+        return converter.columns, arrays
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error en query: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error ejecutando query: {str(e)}"
+        )
+
+
+def fetch_raw(query: str, params: Sequence[Any] = (), one: bool = False) -> Tuple[List[str], Any]:
+    """
+    Ejecutar query y retornar (columnas, filas) sin convertir.
+    Con one=True retorna solo la primera fila (o None).
+    """
+    with DB_POOL.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, params)
+            columns = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchone() if one else cursor.fetchall()
+        finally:
+            cursor.close()
+    return columns, rows
+
+
+# 🌊 STREAMING: para historiales grandes las filas se leen con fetchmany y cada chunk se
+# convierte y se escribe al cliente apenas llega, sin armar la lista completa en memoria.
+STREAM_FETCH_SIZE = int(os.getenv('DB_STREAM_FETCH_SIZE', '500'))
+
+
+class RowStream:
+    """
+    Cursor abierto sobre una conexión del pool, leído por chunks.
+    
+    open()/fetch()/close() son bloqueantes: open() vía run_db, fetch()/close() vía
+    run_db_cursor; la conexión queda prestada hasta close().
+    """
+
+    def __init__(self, query: str, params: Sequence[Any] = (), chunk_size: int = STREAM_FETCH_SIZE, max_rows: Optional[int] = None):
+        self.query = query
+        self.params = params
+        self.chunk_size = chunk_size
+        self.max_rows = max_rows
+        self.truncated = False
+        self.converter: Optional[RowConverter] = None
+        self.rows_sent = 0
+        self._pooled: Optional[PooledConnection] = None
+        self._cursor = None
+
+    def open(self):
+        self._pooled = DB_POOL.acquire()
+        try:
+            logger.info(f"🌊 Streaming query: {' '.join(self.query.split())[:100]}... params={list(self.params)[:10]}")
+            self._cursor = self._pooled.cursor()
+            self._cursor.execute(self.query, self.params)
+            self.converter = RowConverter(self._cursor.description, source=query_source(self.query))
+        except Exception:
+            self.close(broken=True)
+            raise
+
+    def fetch(self) -> List[Dict[str, Any]]:
+        if self.truncated:
+            return []
+        rows = self._cursor.fetchmany(self.chunk_size)
+        if self.max_rows is not None and self.rows_sent + len(rows) > self.max_rows:
+            # El query trae max_rows + 1 filas: la sobrante indica que se cortó el resultado
+            rows = rows[:self.max_rows - self.rows_sent]
+            self.truncated = True
+        self.rows_sent += len(rows)
+        return self.converter.convert_all(rows)
+
+    def close(self, broken: bool = False):
+        if self._pooled is None:
+            return
+        try:
+            if self._cursor is not None:
+                self._cursor.close()
+        except Exception:
+            broken = True
+        if broken:
+            broken = not DB_POOL._validate(self._pooled)
+        DB_POOL.release(self._pooled, broken=broken)
+        self._pooled = None
+
+
+def check_format(format: str, allowed: Sequence[str]) -> str:
+    """Validar el parámetro format (400 si no es uno de `allowed`)"""
+    if format not in allowed:
+        raise HTTPException(status_code=400, detail=f"format inválido. Use {' | '.join(allowed)}")
+    return format
+
+
+def stream_mode(format: str, stream: bool) -> Optional[str]:
+    """'json' / 'ndjson' si el request pide respuesta streaming, None si no (400 si el formato no existe)"""
+    check_format(format, ('json', 'ndjson', 'columnar'))
+    if format == 'columnar' and stream:
+        raise HTTPException(status_code=400, detail="format=columnar no admite stream=true")
+    if format == 'ndjson':
+        return 'ndjson'
+    return 'json' if stream else None
+
+
+def _is_buffered_request(kwargs: Dict[str, Any]) -> bool:
+    return not kwargs.get('stream') and kwargs.get('format', 'json') != 'ndjson'
+
+
+def to_columnar(payload: Dict[str, Any], columns: List[str]) -> Dict[str, Any]:
+    """
+    format=columnar: "data" pasa de una lista de filas a un array por columna
+    (en el orden de "columns"), sin repetir los nombres en cada fila.
+    """
+    rows = payload['data']
+    return {
+        **payload,
+        "format": "columnar",
+        "columns": columns,
+        "data": [[row.get(col) for row in rows] for col in columns]
+    }
+
+
+# 📦 FORMATOS BINARIOS: los endpoints de datos negocian el formato por Accept.
+# MessagePack codifica el mismo payload que el JSON; Arrow IPC se arma columna por columna
+# desde el result set (format=columnar), sin la lista intermedia de diccionarios.
+MEDIA_JSON = 'application/json'
+MEDIA_MSGPACK = 'application/msgpack'
+MEDIA_ARROW = 'application/vnd.apache.arrow.stream'
+MEDIA_TYPE_ALIASES = {
+    'application/x-msgpack': MEDIA_MSGPACK,
+    'application/vnd.msgpack': MEDIA_MSGPACK,
+}
+
+
+def available_media_types() -> List[str]:
+    media_types = [MEDIA_JSON]
+    if msgpack is not None:
+        media_types.append(MEDIA_MSGPACK)
+    if pa is not None:
+        media_types.append(MEDIA_ARROW)
+    return media_types
+
+
+def negotiate_media_type(accept: Optional[str]) -> str:
+    """Elegir el formato de respuesta según Accept (406 si ninguno de los aceptados está disponible)"""
+    if not accept:
+        return MEDIA_JSON
+    available = available_media_types()
+    candidates = []
+    for position, part in enumerate(accept.split(',')):
+        media_type, *media_params = [p.strip() for p in part.split(';')]
+        quality = 1.0
+        for param in media_params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, MEDIA_TYPE_ALIASES.get(media_type.lower(), media_type.lower())))
+    for _, _, media_type in sorted(candidates):
+        if media_type in ('*/*', 'application/*'):
+            return MEDIA_JSON
+        if media_type in available:
+            return media_type
+    raise HTTPException(
+        status_code=406,
+        detail=f"Ningún formato aceptado está disponible. Disponibles: {', '.join(available)}"
+    )
+
+
+def _msgpack_default(value: Any) -> Any:
+    # Mismos valores que ve el cliente JSON (jsonable_encoder): Decimal → número, fechas → ISO
+    if isinstance(value, Decimal):
+        return decimal_encoder(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_msgpack(payload: Any) -> bytes:
+    return msgpack.packb(payload, default=_msgpack_default, use_bin_type=True)
+
+
+def _arrow_array(values: List[Any]) -> Any:
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columna con tipos mezclados: se envía como texto
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def encode_arrow(columns: List[str], arrays: List[List[Any]], metadata: Optional[Dict[str, Any]] = None) -> bytes:
+    """Un record batch Arrow (formato IPC stream) con una columna por array"""
+    batch = pa.record_batch(
+        [_arrow_array(values) for values in arrays],
+        names=columns
+    )
+    if metadata:
+        batch = batch.replace_schema_metadata({k: str(v) for k, v in metadata.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def negotiated_route(fn):
+    """
+    Decorador para endpoints de datos (va entre @app.get y @cached_route): respeta Accept.
+    
+    JSON sigue el camino normal de FastAPI. Para Arrow se fuerza format=columnar (el caché
+    de respuestas guarda el payload, no los bytes) y los escalares del payload viajan como
+    metadata del schema. El endpoint debe recibir `request: Request` y `response: Response`.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        request: Request = kwargs['request']
+        response: Response = kwargs['response']
+        media_type = negotiate_media_type(request.headers.get('accept'))
+        request.state.media_type = media_type
+        response.headers['Vary'] = 'Accept'
+        
+        if media_type != MEDIA_JSON:
+            if kwargs.get('stream') or kwargs.get('format') == 'ndjson':
+                raise HTTPException(status_code=400, detail="stream/ndjson solo están disponibles en JSON")
+            if media_type == MEDIA_ARROW:
+                kwargs['format'] = 'columnar'
+        
+        value = await fn(*args, **kwargs)
+        if media_type == MEDIA_JSON or not isinstance(value, dict):
+            if isinstance(value, Response):
+                vary = [v.strip().lower() for v in value.headers.get('vary', '').split(',')]
+                if 'accept' not in vary:
+                    value.headers.add_vary_header('Accept')
+            return value
+        
+        if media_type == MEDIA_MSGPACK:
+            content = encode_msgpack(value)
+        else:
+            metadata = {k: v for k, v in value.items() if k not in ('data', 'columns') and not isinstance(v, (list, dict))}
+            content = encode_arrow(value['columns'], value['data'], metadata)
+        headers = {k: v for k, v in response.headers.items() if k != 'content-length'}
+        return Response(content=content, media_type=media_type, headers=headers)
+    return wrapper
+
+
+async def streaming_query_response(
+    query: str,
+    params: Sequence[Any],
+    envelope: Dict[str, Any],
+    mode: str,
+    max_rows: Optional[int] = None
+) -> StreamingResponse:
+    """
+    Respuesta streaming del resultado de `query`.
+    
+    json: el objeto `envelope` + "data" como array escrito por fragmentos ("count" va al final,
+    y "truncated" si se pasó max_rows). ndjson: una fila JSON por línea.
+    El query se ejecuta antes de responder, así los errores de AS400 siguen siendo un 500.
+    La conexión se pide dentro del generador: si la respuesta nunca se llega a enviar
+    (cliente desconectado), el finalizador del generador la devuelve al pool.
+    """
+    rows = RowStream(query, params, max_rows=max_rows)
+    
+    async def body():
+        await run_db(rows.open)
+        broken = False
+        try:
+            # Primer yield vacío: lo consume streaming_query_response para saber que el query corrió
+            yield b""
+            if mode == 'json':
+                yield dumps_json(envelope)[:-1] + b',"data":['
+            first = True
+            while True:
+                chunk = await run_db_cursor(rows.fetch)
+                if not chunk:
+                    break
+                if mode == 'ndjson':
+                    yield b"".join(dumps_json(row) + b"\n" for row in chunk)
+                else:
+                    yield (b"" if first else b",") + b",".join(dumps_json(row) for row in chunk)
+                first = False
+            if mode == 'json':
+                tail = {"count": rows.rows_sent}
+                if max_rows is not None:
+                    tail["truncated"] = rows.truncated
+                yield b"]," + dumps_json(tail)[1:]
+            if rows.truncated:
+                logger.warning(f"⚠️ Streaming truncado en {max_rows} filas")
+            logger.info(f"✅ Streaming terminado: {rows.rows_sent} filas")
+        except Exception as e:
+            # Con los headers ya enviados solo queda cortar el stream (el cliente ve JSON incompleto)
+            broken = True
+            logger.error(f"❌ Error durante streaming: {str(e)}")
+            raise
+        finally:
+            await asyncio.shield(run_db_cursor(rows.close, broken))
+    
+    stream = body()
+    try:
+        await stream.__anext__()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error en query streaming: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error ejecutando query: {str(e)}")
+    
+    media_type = "application/x-ndjson; charset=utf-8" if mode == 'ndjson' else UTF8JSONResponse.media_type
+    return StreamingResponse(stream, media_type=media_type)
+
+
+# 🔥 WARM-UP: al arrancar se inicia la JVM, se carga el driver, se abren las conexiones
+# mínimas del pool y se ejecuta una vez cada query "enlatada" para que el AS400 tenga
+# los planes de acceso listos. /ready responde 503 hasta que termina.
+WARMUP_CONFIG = {
+    'enabled': os.getenv('AS400_WARMUP', 'true').lower() in ('1', 'true', 'yes'),
+    'retry_max_delay': float(os.getenv('AS400_WARMUP_RETRY_MAX_DELAY', '60')),
+}
+
+STARTUP_STATE = {
+    'ready': False,
+    'phase': 'starting',
+    'attempts': 0,
+    'last_error': None,
+    'jvm_boot_seconds': None,
+    'pool_fill_seconds': None,
+    'warmup_seconds': None,
+    'startup_seconds': None,
+    'queries': {},
+}
+
+
+def _warmup_queries() -> List[tuple]:
+    """Queries representativas de cada endpoint: (nombre, sql, parámetros)"""
+    hoy = datetime.now().strftime('%Y-%m-%d')
+    manana = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    return [
+        ('empresas-fleteras', EMPRESAS_FLETERAS_QUERY, ()),
+        ('moviles-por-empresa', MOVILES_POR_EMPRESA_QUERY, (0,)),
+        ('latest-positions', *build_latest_positions_query(f"{hoy} 00:00:00")),
+        ('coordinates', *build_coordinates_query(0, f"{hoy} 00:00:00", 1)),
+        ('all-coordinates', *build_all_coordinates_query(f"{hoy} 00:00:00", 1, [0])),
+        ('pedidos-servicios', PEDIDOS_SERVICIOS_QUERY,
+         (f"{hoy} 00:00:00", f"{hoy} 23:59:59", 0) * 2),
+        ('pedidos-servicios-pendientes', PEDIDOS_SERVICIOS_PENDIENTES_QUERY,
+         (f"{hoy} 00:00:00", f"{manana} 00:00:00", 0) * 2),
+        ('pedido-detalle', PEDIDO_DETALLE_QUERY, (0,)),
+        ('servicio-detalle', SERVICIO_DETALLE_QUERY, (0,)),
+    ]
+
+
+def run_warmup():
+    """Fase de arranque completa (bloqueante, se ejecuta en un thread)"""
+    STARTUP_STATE['phase'] = 'jvm'
+    t0 = time.monotonic()
+    boot_jvm()
+    STARTUP_STATE['jvm_boot_seconds'] = round(time.monotonic() - t0, 3)
+    logger.info(f"☕ JVM y driver JT400 listos en {STARTUP_STATE['jvm_boot_seconds']}s")
+    
+    STARTUP_STATE['phase'] = 'pool'
+    t0 = time.monotonic()
+    DB_POOL.fill()
+    STARTUP_STATE['pool_fill_seconds'] = round(time.monotonic() - t0, 3)
+    logger.info(f"🏊 Pool AS400 precargado en {STARTUP_STATE['pool_fill_seconds']}s: {DB_POOL.stats()}")
+    
+    STARTUP_STATE['phase'] = 'queries'
+    t_warmup = time.monotonic()
+    for name, sql, params in _warmup_queries():
+        t0 = time.monotonic()
+        try:
+            fetch_raw(sql, params, one=True)
+            STARTUP_STATE['queries'][name] = round(time.monotonic() - t0, 3)
+        except Exception as e:
+            # Una query que falla no bloquea el arranque: el endpoint reportará el error real
+            STARTUP_STATE['queries'][name] = None
+            logger.warning(f"⚠️ Warm-up de {name} falló: {str(e)}")
+    STARTUP_STATE['warmup_seconds'] = round(time.monotonic() - t_warmup, 3)
+
+
+async def _warmup_loop():
+    """Ejecutar el warm-up reintentando con backoff hasta que AS400 responda"""
+    delay = 5.0
+    while True:
+        STARTUP_STATE['attempts'] += 1
+        try:
+            await run_db(run_warmup)
+            break
+        except Exception as e:
+            STARTUP_STATE['last_error'] = str(e)
+            logger.error(f"❌ Warm-up AS400 falló (intento {STARTUP_STATE['attempts']}), reintento en {delay:.0f}s: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_CONFIG['retry_max_delay'])
+    
+    STARTUP_STATE['ready'] = True
+    STARTUP_STATE['phase'] = 'ready'
+    STARTUP_STATE['last_error'] = None
+    STARTUP_STATE['startup_seconds'] = round(time.monotonic() - PROCESS_STARTED_AT, 3)
+    logger.info(
+        f"📈 Arranque completo: startup={STARTUP_STATE['startup_seconds']}s "
+        f"jvm={STARTUP_STATE['jvm_boot_seconds']}s pool={STARTUP_STATE['pool_fill_seconds']}s "
+        f"warmup={STARTUP_STATE['warmup_seconds']}s queries={STARTUP_STATE['queries']}"
+    )
+
+
+@app.get("/")
+async def root():
+    """Endpoint raíz - información de la API"""
+    print("🌐 ROOT ENDPOINT LLAMADO!", flush=True)
+    logger.info("Root endpoint llamado")
+    return {
+        "api": "TrackMovil AS400 API",
+        "version": "1.0.0",
+        "status": "running",
+        "endpoints": {
+            "latest-positions": "/latest-positions?startDate=2025-10-14 (última posición de TODOS los móviles)",
+            "latest-positions-delta": "/latest-positions?startDate=2025-10-14&since=<token> (solo móviles que cambiaron desde la respuesta anterior)",
+            "latest-positions-filtered": "/latest-positions?startDate=2025-10-14&movilIds=693,251,337 (última posición de móviles específicos)",
+            "coordinates": "/coordinates?movilId=693&startDate=2025-10-14 (última coordenada de UN móvil)",
+            "coordinates-history": "/coordinates?movilId=693&startDate=2025-10-14&limit=100 (historial de UN móvil)",
+            "all-coordinates": "/all-coordinates?startDate=2025-10-14 (historial de TODOS los móviles)",
+            "all-coordinates-columnar": "/all-coordinates?startDate=2025-10-14&format=columnar (un array por columna, también en /coordinates y /latest-positions)",
+            "all-coordinates-simplified": "/all-coordinates?startDate=2025-10-14&simplify=15 (recorridos simplificados a 15 m, conserva entregas)",
+            "coordinates-bucket": "/coordinates?movilId=693&startDate=2025-10-14&limit=1000&bucket=1m&bucketMode=centroid (un punto por minuto)",
+            "all-coordinates-stream": "/all-coordinates?startDate=2025-10-14&format=ndjson (historial por streaming, también stream=true)",
+            "latest-positions-viewport": "/latest-positions?startDate=2025-10-14&bbox=-56.3,-34.95,-56.0,-34.8&zoom=11 (zona visible del mapa, clusters con zoom bajo)",
+            "moviles-near": "/moviles-near?lat=-34.9011&lng=-56.1645&radius=3000&k=5 (móviles más cercanos a un punto, desde memoria)",
+            "stream-positions": "/stream/positions?empresaIds=103 (SSE: snapshot al conectar y luego solo cambios)",
+            "pedidos-servicios-batch": "/pedidos-servicios?movilIds=693,251&fecha_desde=2025-10-14 (pedidos/servicios de varios móviles agrupados, también empresaIds=103)",
+            "pedidos-servicios-pendientes-batch": "/pedidos-servicios-pendientes?empresaIds=103 (pendientes de varios móviles agrupados)",
+            "pedidos-detalle": "/pedidos-detalle?ids=1001,1002 (detalle de varios pedidos en una consulta, también /servicios-detalle)",
+            "health": "/health",
+            "ready": "/ready (503 hasta terminar el warm-up de AS400)",
+            "test-db": "/test-db (prueba conexión AS400)",
+            "metrics": "/metrics (estadísticas internas: arranque, pool, cachés, executor, single-flight)",
+            "docs": "/docs"
+        }
+    }
+
+
+@app.get("/ping")
+async def ping():
+    """Endpoint ultra simple para verificar que la API responde"""
+    print("🏓 PING RECIBIDO!", flush=True)
+    logger.info("🏓 PING recibido")
+    return {"status": "ok", "message": "pong", "timestamp": datetime.now().isoformat()}
+
+
+@app.get("/coordinates-mock")
+async def get_coordinates_mock(
+    movilId: int = Query(..., description="ID del vehículo"),
+    startDate: str = Query("2025-10-14", description="Fecha inicial"),
+    limit: int = Query(10, description="Límite de registros")
+):
+    """Endpoint de prueba que devuelve datos simulados (NO consulta AS400)"""
+    logger.info(f"📥 MOCK Request: movilId={movilId}, startDate={startDate}, limit={limit}")
+    
+    # Datos de prueba para verificar que la comunicación funciona
+    mock_data = [
+        {
+            "identificador": movilId,
+            "origen": "GPS",
+            "coordx": -34.9011 + (i * 0.001),
+            "coordy": -56.1645 + (i * 0.001),
+            "fechainslog": f"{startDate}T{10+i}:30:00",
+            "auxin2": "TEST",
+            "distrecorrida": 10.5 + i
+        }
+        for i in range(min(limit, 10))
+    ]
+    
+    return {
+        "success": True,
+        "movilId": movilId,
+        "startDate": startDate,
+        "count": len(mock_data),
+        "data": mock_data,
+        "note": "DATOS DE PRUEBA - No son datos reales de AS400"
+    }
+
+
+@app.get("/health")
+async def health_check():
+    """Verificar estado de la API"""
+    return {
+        "status": "healthy",
+        "api": "running",
+        "timestamp": datetime.now().isoformat(),
+        "message": "API is running. Use /test-db to test AS400 connection"
+    }
+
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 200 solo cuando terminó el warm-up (JVM, driver, pool y queries)"""
+    body = {
+        "ready": STARTUP_STATE['ready'],
+        "phase": STARTUP_STATE['phase'],
+        "attempts": STARTUP_STATE['attempts'],
+        "error": STARTUP_STATE['last_error'],
+        "timestamp": datetime.now().isoformat()
+    }
+    return UTF8JSONResponse(status_code=200 if STARTUP_STATE['ready'] else 503, content=body)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Estadísticas internas del servicio (arranque, pool AS400, cachés, executor de DB, single-flight)"""
+    return {
+        "startup": STARTUP_STATE,
+        "pool": DB_POOL.stats(),
+        "statement_cache": statement_cache_stats(),
+        "encoding": CODEC_REGISTRY.stats(),
+        "db_executor": DB_EXECUTOR.stats(),
+        "db_cursor_executor": DB_CURSOR_EXECUTOR.stats(),
+        "single_flight": DB_SINGLE_FLIGHT.stats(),
+        "response_cache": RESPONSE_CACHE.stats(),
+        "fleet_snapshot": FLEET_SNAPSHOT.stats(),
+        "live_positions": LIVE_POSITIONS.stats(),
+        "position_stream": POSITION_HUB.stats(),
+        "spatial_index": MOVIL_GRID.stats(),
+        "history_mirror": HISTORY_MIRROR.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+@app.get("/test-db")
+async def test_database():
+    """Probar conexión con AS400 (puede tardar)"""
+    try:
+        logger.info("🔍 Intentando conectar a AS400...")
+        await run_db(fetch_raw, POOL_CONFIG['validation_query'], one=True)
+        
+        return {
+            "status": "success",
+            "database": "connected",
+            "host": AS400_CONFIG['url'],
+            "pool": DB_POOL.stats(),
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except Exception as e:
+        logger.error(f"❌ Error de conexión: {str(e)}")
+        return {
+            "status": "error",
+            "database": "disconnected",
+            "error": str(e),
+            "timestamp": datetime.now().isoformat()
+        }
+
+
+EMPRESAS_FLETERAS_QUERY = """
+    SELECT EFLID, EFLNOM, EFLESTADO 
+    FROM GXCALDTA.EFLETERA 
+    ORDER BY EFLNOM
+"""
+
+
+@app.get("/empresas-fleteras")
+@cached_route('empresas_fleteras')
+async def get_empresas_fleteras():
+    """
+    Obtener lista de todas las empresas fleteras
+    
+    Returns:
+        Lista de empresas con EFLID, EFLNOM (nombre), EFLESTADO
+    """
+    try:
+        logger.info("📋 Obteniendo empresas fleteras...")
+        
+        # strip=True: limpiar espacios en CHAR fields
+        results = await query_db(execute_query, EMPRESAS_FLETERAS_QUERY, strip=True)
+        
+        logger.info(f"✅ {len(results)} empresas fleteras encontradas")
+        
+        return {
+            "success": True,
+            "count": len(results),
+            "data": results,
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo empresas fleteras: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/moviles-por-empresa")
-async def get_moviles_por_empresa(
-    empresaId: int = Query(..., description="ID de la empresa fletera (EFLID)")
-):
-    """
-    Obtener móviles de una empresa fletera específica
-    
-    Args:
-        empresaId: ID de la empresa fletera
-        
-    Returns:
-        Lista de móviles con MOVID, EFLID, MOVESTCOD
-    """
-    try:
-        logger.info(f"🚗 Obteniendo móviles de empresa {empresaId}...")
-        
-        query = f"""
-            SELECT MOVID, EFLID, MOVESTCOD 
-            FROM GXCALDTA.MOVILES 
-            WHERE EFLID = {empresaId}
-            ORDER BY MOVID
-        """
-        
-        results = execute_query(query)
-        
-        # Procesar resultados para limpiar espacios
-        for row in results:
-            if 'movestcod' in row and row['movestcod']:
-                row['movestcod'] = str(row['movestcod']).strip()
-        
-        logger.info(f"✅ {len(results)} móviles encontrados para empresa {empresaId}")
-        
-        return {
+MOVILES_POR_EMPRESA_QUERY = """
+    SELECT MOVID, EFLID, MOVESTCOD 
+    FROM GXCALDTA.MOVILES 
+    WHERE EFLID = ?
+    ORDER BY MOVID
+"""
+
+
+@app.get("/moviles-por-empresa")
+@cached_route('moviles_por_empresa')
+async def get_moviles_por_empresa(
+    empresaId: int = Query(..., description="ID de la empresa fletera (EFLID)")
+):
+    """
+    Obtener móviles de una empresa fletera específica
+    
+    Args:
+        empresaId: ID de la empresa fletera
+        
+    Returns:
+        Lista de móviles con MOVID, EFLID, MOVESTCOD
+    """
+    try:
+        logger.info(f"🚗 Obteniendo móviles de empresa {empresaId}...")
+        
+        # strip=True: limpiar espacios en CHAR fields
+        results = await query_db(execute_query, MOVILES_POR_EMPRESA_QUERY, (empresaId,), strip=True)
+        
+        logger.info(f"✅ {len(results)} móviles encontrados para empresa {empresaId}")
+        
+        return {
+            "success": True,
+            "empresaId": empresaId,
+            "count": len(results),
+            "data": results,
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo móviles de empresa {empresaId}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Columnas de LOGCOORDMOVIL que devuelven los endpoints de posiciones ({a} = alias de tabla)
+LOGCOORDMOVIL_SELECT = """
+            {a}LOGCOORDMOVILIDENTIFICADOR as identificador,
+            {a}LOGCOORDMOVILORIGEN as origen,
+            {a}LOGCOORDMOVILCOORDX as coordX,
+            {a}LOGCOORDMOVILCOORDY as coordY,
+            {a}LOGCOORDMOVILFCHINSLOG as fechaInsLog,
+            {a}LOGCOORDMOVILAUXIN2 as auxIn2,
+            {a}LOGCOORDMOVILDISTRECORRIDA as distRecorrida,
+            {a}LOGCOORDMOVILOBS as obs,
+            {a}LOGCOORDMOVILpedid as pedidoId,
+            {a}logcoordmovilcoordclix as clienteX,
+            {a}logcoordmovilcoordcliy as clienteY"""
+
+# Columnas de LOGCOORDMOVIL_SELECT tal como las devuelve execute_query (format=columnar)
+LOGCOORDMOVIL_COLUMNS = [alias.lower() for alias in re.findall(r'\bas (\w+)', LOGCOORDMOVIL_SELECT)]
+
+
+def parse_id_list(value: str, param_name: str) -> List[int]:
+    """Parsear '693,251,337' → [693, 251, 337] (400 si algún ID no es entero)"""
+    try:
+        ids = [int(id.strip()) for id in value.split(',') if id.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{param_name} debe ser una lista de enteros separados por coma"
+        )
+    if not ids:
+        raise HTTPException(status_code=400, detail=f"{param_name} no puede estar vacío")
+    return ids
+
+
+# ⏱️ BUCKETS DE TIEMPO (bucket=30s|1m|5m): un punto representativo por móvil y bucket, el
+# último del bucket (bucketMode=last) o el centroide (bucketMode=centroid). La agregación se
+# hace en DB2 con ROW_NUMBER/AVG OVER por (móvil, día, MIDNIGHT_SECONDS / N), así AS400
+# devuelve una fila por bucket. Las filas de eventos (UPDPEDIDOS/DYLPEDIDOS o con pedidoId)
+# no se agregan. Con HISTORY_BUCKET_PUSHDOWN=false se agrega en Python sobre las filas crudas
+# (hasta HISTORY_BUCKET_FALLBACK_MAX_ROWS) y limit se aplica después, sobre los buckets.
+HISTORY_BUCKETS = {'30s': 30, '1m': 60, '5m': 300}
+HISTORY_BUCKET_MODES = ('last', 'centroid')
+HISTORY_BUCKET_PUSHDOWN = os.getenv('HISTORY_BUCKET_PUSHDOWN', 'true').lower() in ('1', 'true', 'yes')
+HISTORY_BUCKET_FALLBACK_MAX_ROWS = int(os.getenv('HISTORY_BUCKET_FALLBACK_MAX_ROWS', '200000'))
+
+# Columnas físicas de LOGCOORDMOVIL que usa LOGCOORDMOVIL_SELECT
+LOGCOORDMOVIL_RAW_COLUMNS = re.findall(r'\{a\}(\w+) as', LOGCOORDMOVIL_SELECT)
+
+COORD_BBOX_CONDITIONS = (
+    "{a}LOGCOORDMOVILCOORDX BETWEEN -35 AND -30",
+    "{a}LOGCOORDMOVILCOORDY BETWEEN -58 AND -53",
+)
+
+
+def check_bucket(bucket: Optional[str], bucket_mode: str, mode: Optional[str]) -> Optional[int]:
+    """Segundos del bucket pedido (None sin bucket); 400 si bucket/bucketMode no son válidos"""
+    if bucket_mode not in HISTORY_BUCKET_MODES:
+        raise HTTPException(status_code=400, detail=f"bucketMode inválido. Use {' | '.join(HISTORY_BUCKET_MODES)}")
+    if bucket is None:
+        return None
+    if bucket not in HISTORY_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket inválido. Use {' | '.join(HISTORY_BUCKETS)}")
+    if mode and not HISTORY_BUCKET_PUSHDOWN:
+        raise HTTPException(status_code=400, detail="bucket no admite streaming con HISTORY_BUCKET_PUSHDOWN=false")
+    return HISTORY_BUCKETS[bucket]
+
+
+def logcoord_from(
+    alias: str,
+    conditions: List[str],
+    join: str = "",
+    bucket_seconds: Optional[int] = None,
+    centroid: bool = False
+) -> str:
+    """
+    Cláusula FROM ... WHERE ... de LOGCOORDMOVIL con sus filtros.
+    
+    Con bucket_seconds es una tabla derivada con las mismas columnas (y el mismo alias)
+    que solo tiene un punto por móvil y bucket más las filas de eventos, así las queries
+    de historial se arman igual con o sin buckets.
+    """
+    schema = AS400_CONFIG['schema']
+    table = f"{schema}.LOGCOORDMOVIL {alias}" + (f"\n            {join}" if join else "")
+    where = "\n              AND ".join(conditions)
+    if not bucket_seconds:
+        return f"""{table}
+            WHERE {where}"""
+    
+    a = f"{alias}."
+    event = f"({a}LOGCOORDMOVILORIGEN IN ('UPDPEDIDOS', 'DYLPEDIDOS') OR COALESCE({a}LOGCOORDMOVILPEDID, 0) <> 0)"
+    partition = (
+        f"{a}LOGCOORDMOVILIDENTIFICADOR, CASE WHEN {event} THEN 1 ELSE 0 END, "
+        f"DATE({a}LOGCOORDMOVILFCHINSLOG), MIDNIGHT_SECONDS({a}LOGCOORDMOVILFCHINSLOG) / {int(bucket_seconds)}"
+    )
+    centroid_of = {'LOGCOORDMOVILCOORDX': 'CX', 'LOGCOORDMOVILCOORDY': 'CY'} if centroid else {}
+    columns = []
+    for column in LOGCOORDMOVIL_RAW_COLUMNS:
+        if column.upper() in centroid_of:
+            columns.append(f"CASE WHEN B.EV = 1 THEN B.{column} ELSE B.{centroid_of[column.upper()]} END AS {column}")
+        else:
+            columns.append(f"B.{column}")
+    centroid_columns = f"""
+                           AVG({a}LOGCOORDMOVILCOORDX) OVER (PARTITION BY {partition}) AS CX,
+                           AVG({a}LOGCOORDMOVILCOORDY) OVER (PARTITION BY {partition}) AS CY,""" if centroid else ""
+    return f"""(
+                SELECT {', '.join(columns)}
+                FROM (
+                    SELECT {a}*,{centroid_columns}
+                           CASE WHEN {event} THEN 1 ELSE 0 END AS EV,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY {partition}
+                               ORDER BY {a}LOGCOORDMOVILFCHINSLOG DESC
+                           ) AS BRN
+                    FROM {table}
+                    WHERE {where}
+                ) B
+                WHERE B.BRN = 1 OR B.EV = 1
+            ) {alias}"""
+
+
+def bucket_rows(rows: List[Dict[str, Any]], bucket_seconds: int, centroid: bool = False) -> List[Dict[str, Any]]:
+    """
+    Fallback en Python de logcoord_from(bucket_seconds=...): un punto por móvil y bucket
+    (el último, o con coordenadas promedio si centroid) y las filas de eventos intactas.
+    Conserva el orden original de las filas.
+    """
+    buckets: Dict[Tuple[Any, str, int], List[int]] = {}
+    kept: List[int] = []
+    for i, row in enumerate(rows):
+        fecha = str(row.get('fechainslog') or '')
+        if _is_business_point(row.get('origen'), row.get('pedidoid')) or len(fecha) < 19:
+            kept.append(i)
+            continue
+        seconds = int(fecha[11:13]) * 3600 + int(fecha[14:16]) * 60 + int(fecha[17:19])
+        buckets.setdefault((row.get('identificador'), fecha[:10], seconds // bucket_seconds), []).append(i)
+    
+    representatives: Dict[int, Dict[str, Any]] = {}
+    for indices in buckets.values():
+        last = max(indices, key=lambda i: str(rows[i].get('fechainslog')))
+        row = rows[last]
+        if centroid and len(indices) > 1:
+            xs = [rows[i]['coordx'] for i in indices if rows[i].get('coordx') is not None]
+            ys = [rows[i]['coordy'] for i in indices if rows[i].get('coordy') is not None]
+            row = {**row}
+            if xs:
+                row['coordx'] = sum(xs) / len(xs)
+            if ys:
+                row['coordy'] = sum(ys) / len(ys)
+        representatives[last] = row
+    
+    kept.extend(representatives)
+    kept.sort()
+    return [representatives.get(i, rows[i]) for i in kept]
+
+
+def limit_per_movil(rows: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """Las primeras `limit` filas de cada móvil, conservando el orden"""
+    counts: Dict[Any, int] = {}
+    limited = []
+    for row in rows:
+        movil_id = row.get('identificador')
+        n = counts.get(movil_id, 0)
+        if n < limit:
+            counts[movil_id] = n + 1
+            limited.append(row)
+    return limited
+
+
+def build_coordinates_query(
+    movil_id: int,
+    fecha_inicio: str,
+    limit: int,
+    empresa_ids: Optional[List[int]] = None,
+    bucket_seconds: Optional[int] = None,
+    centroid: bool = False
+) -> Tuple[str, List[Any]]:
+    """Query (con parameter markers) de las últimas `limit` coordenadas (o buckets) de un móvil"""
+    conditions = [
+        "l.LOGCOORDMOVILFCHINSLOG >= ?",
+        "l.LOGCOORDMOVILIDENTIFICADOR = ?",
+        *(c.format(a='l.') for c in COORD_BBOX_CONDITIONS),
+    ]
+    params: List[Any] = [fecha_inicio, movil_id]
+    
+    # Determinar si necesitamos JOIN con MOVILES
+    join = ""
+    if empresa_ids:
+        empresa_markers, empresa_params = in_list_params(empresa_ids)
+        join = "JOIN GXCALDTA.MOVILES m ON l.LOGCOORDMOVILIDENTIFICADOR = m.MOVID"
+        conditions.append(f"m.EFLID IN ({empresa_markers})")
+        params.extend(empresa_params)
+    params.append(limit)
+    
+    query = f"""
+        SELECT {LOGCOORDMOVIL_SELECT.format(a='l.')}
+        FROM {logcoord_from('l', conditions, join, bucket_seconds, centroid)}
+        ORDER BY l.LOGCOORDMOVILFCHINSLOG DESC
+        FETCH FIRST ? ROWS ONLY
+    """
+    return query, params
+
+
+# 〰️ SIMPLIFICACIÓN DE RECORRIDOS (simplify=<metros>): Douglas-Peucker por móvil antes de
+# serializar, para no mandar miles de puntos casi colineales a la polilínea del mapa.
+# Las filas con significado de negocio (UPDPEDIDOS/DYLPEDIDOS o con pedidoId) se conservan
+# siempre: el recorrido se corta en ellas y cada tramo se simplifica por separado.
+SIMPLIFY_KEEP_ORIGENES = ('UPDPEDIDOS', 'DYLPEDIDOS')
+METERS_PER_DEGREE_LAT = 110_574.0
+METERS_PER_DEGREE_LON = 111_320.0  # en el ecuador, se escala por cos(latitud)
+
+
+def _is_business_point(origen: Any, pedido_id: Any) -> bool:
+    return bool(pedido_id) or (origen or '').strip() in SIMPLIFY_KEEP_ORIGENES
+
+
+def _douglas_peucker_numpy(xs, ys, keep: List[bool], tolerance: float) -> List[bool]:
+    """Douglas-Peucker iterativo entre anclas consecutivas; las distancias de cada tramo van vectorizadas"""
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    anchors = [i for i, k in enumerate(keep) if k]
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    tol2 = tolerance * tolerance
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        px = xs[a + 1:b] - xs[a]
+        py = ys[a + 1:b] - ys[a]
+        dx = xs[b] - xs[a]
+        dy = ys[b] - ys[a]
+        seg2 = dx * dx + dy * dy
+        if seg2 > 0:
+            # Distancia al segmento (no a la recta): un ida y vuelta por la misma calle no se pierde
+            t = np.clip((px * dx + py * dy) / seg2, 0.0, 1.0)
+            px = px - t * dx
+            py = py - t * dy
+        d2 = px * px + py * py
+        i = int(np.argmax(d2))
+        if d2[i] > tol2:
+            m = a + 1 + i
+            keep[m] = True
+            stack.append((a, m))
+            stack.append((m, b))
+    return keep
+
+
+def _douglas_peucker_python(xs, ys, keep: List[bool], tolerance: float) -> List[bool]:
+    """Mismo algoritmo que _douglas_peucker_numpy, en Python puro (sin numpy)"""
+    anchors = [i for i, k in enumerate(keep) if k]
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    tol2 = tolerance * tolerance
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        ax, ay = xs[a], ys[a]
+        dx = xs[b] - ax
+        dy = ys[b] - ay
+        seg2 = dx * dx + dy * dy
+        best, best_d2 = -1, tol2
+        for i in range(a + 1, b):
+            px = xs[i] - ax
+            py = ys[i] - ay
+            if seg2 > 0:
+                t = min(max((px * dx + py * dy) / seg2, 0.0), 1.0)
+                px -= t * dx
+                py -= t * dy
+            d2 = px * px + py * py
+            if d2 > best_d2:
+                best, best_d2 = i, d2
+        if best >= 0:
+            keep[best] = True
+            stack.append((a, best))
+            stack.append((best, b))
+    return keep
+
+
+_douglas_peucker = _douglas_peucker_numpy if np is not None else _douglas_peucker_python
+
+
+def simplify_track_indices(
+    movil_ids: Sequence[Any],
+    lats: Sequence[Any],
+    lons: Sequence[Any],
+    anchors: Sequence[bool],
+    tolerance: float
+) -> List[int]:
+    """
+    Índices (en el orden original) de las filas que sobreviven a la simplificación.
+    
+    Agrupa por móvil, proyecta a metros (equirectangular local) y aplica Douglas-Peucker
+    con `tolerance` metros. Primer y último punto de cada móvil, anclas y filas sin
+    coordenadas se conservan siempre.
+    """
+    tracks: Dict[Any, List[int]] = {}
+    kept: List[int] = []
+    for i, movil_id in enumerate(movil_ids):
+        if lats[i] is None or lons[i] is None:
+            kept.append(i)
+        else:
+            tracks.setdefault(movil_id, []).append(i)
+    
+    for indices in tracks.values():
+        lat = [float(lats[i]) for i in indices]
+        lon = [float(lons[i]) for i in indices]
+        kx = METERS_PER_DEGREE_LON * math.cos(math.radians(sum(lat) / len(lat)))
+        xs = [v * kx for v in lon]
+        ys = [v * METERS_PER_DEGREE_LAT for v in lat]
+        keep = [bool(anchors[i]) for i in indices]
+        keep[0] = keep[-1] = True
+        keep = _douglas_peucker(xs, ys, keep, tolerance)
+        kept.extend(index for index, k in zip(indices, keep) if k)
+    
+    kept.sort()
+    return kept
+
+
+def simplify_rows(rows: List[Dict[str, Any]], tolerance: float) -> List[Dict[str, Any]]:
+    """simplify=<metros> sobre filas de LOGCOORDMOVIL (lista de diccionarios)"""
+    kept = simplify_track_indices(
+        [row.get('identificador') for row in rows],
+        [row.get('coordx') for row in rows],
+        [row.get('coordy') for row in rows],
+        [_is_business_point(row.get('origen'), row.get('pedidoid')) for row in rows],
+        tolerance
+    )
+    return [rows[i] for i in kept]
+
+
+def simplify_columnar(columns: List[str], arrays: List[List[Any]], tolerance: float) -> List[List[Any]]:
+    """simplify=<metros> sobre el resultado de execute_query_columnar (un array por columna)"""
+    if not arrays or not arrays[0]:
+        return arrays
+    col = {name: arrays[i] for i, name in enumerate(columns)}
+    kept = simplify_track_indices(
+        col['identificador'],
+        col['coordx'],
+        col['coordy'],
+        [_is_business_point(origen, pedido_id) for origen, pedido_id in zip(col['origen'], col['pedidoid'])],
+        tolerance
+    )
+    return [[values[i] for i in kept] for values in arrays]
+
+
+def check_simplify(simplify: Optional[float], mode: Optional[str]):
+    if simplify is not None and mode:
+        raise HTTPException(status_code=400, detail="simplify no admite respuestas streaming (stream=true / format=ndjson)")
+
+
+@app.get("/coordinates")
+@negotiated_route
+@cached_route('coordinates', when=_is_buffered_request)
+async def get_coordinates(
+    request: Request,
+    response: Response,
+    movilId: int = Query(..., description="ID del vehículo a consultar"),
+    startDate: str = Query(..., description="Fecha inicial en formato YYYY-MM-DD"),
+    limit: int = Query(1, ge=1, le=1000, description="Límite de registros (1-1000, default: 1 = más reciente)"),
+    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (opcional)"),
+    format: str = Query('json', description="json | ndjson (una fila por línea, siempre streaming) | columnar (un array por columna)"),
+    stream: bool = Query(False, description="Streaming: las filas se envían a medida que se leen de AS400"),
+    simplify: Optional[float] = Query(None, gt=0, le=5000, description="Simplificar el recorrido de cada móvil con tolerancia en metros (Douglas-Peucker)"),
+    bucket: Optional[str] = Query(None, description="30s | 1m | 5m: un punto por móvil y bucket de tiempo (los eventos no se agregan)"),
+    bucketMode: str = Query('last', description="last (último punto del bucket) | centroid (posición promedio)")
+):
+    """
+    Obtener coordenadas de un vehículo específico (por defecto solo la más reciente)
+    
+    Parámetros:
+    - movilId: ID del vehículo (ej: 693, 251, 337)
+    - startDate: Fecha inicial en formato YYYY-MM-DD (ej: 2025-10-14)
+    - limit: Cantidad máxima de registros a retornar (default: 1 = solo la más reciente)
+    - format/stream: con stream=true o format=ndjson la respuesta se envía por chunks;
+      format=columnar retorna "columns" y un array por columna en "data"
+    - simplify: tolerancia en metros para simplificar el recorrido (se conservan siempre
+      las filas UPDPEDIDOS/DYLPEDIDOS y las que tienen pedidoId); no admite streaming
+    - bucket/bucketMode: un punto por bucket de tiempo (30s | 1m | 5m), el último o el
+      centroide; limit cuenta buckets y las filas de eventos vienen sin agregar
+    - Accept: application/msgpack o application/vnd.apache.arrow.stream para formatos binarios
+      (msgpack y pyarrow van en requirements.txt; sin la librería el formato responde 406)
+    
+    Retorna lista de coordenadas con formato:
+    ```json
+    [
+      {
+        "identificador": 693,
+        "origen": "GPS",
+        "coordx": -34.9011,
+        "coordy": -56.1645,
+        "fechainslog": "2025-10-14T10:30:00",
+        "auxin2": "INFO",
+        "distrecorrida": 12.5
+      }
+    ]
+    ```
+    """
+    
+    logger.info(f"📥 Request recibido: movilId={movilId}, startDate={startDate}, limit={limit}")
+    
+    try:
+        # Validar formato de fecha
+        try:
+            datetime.strptime(startDate, '%Y-%m-%d')
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail="Formato de fecha inválido. Use YYYY-MM-DD"
+            )
+        
+        mode = stream_mode(format, stream)
+        emp_ids = parse_id_list(empresaIds, 'empresaIds') if empresaIds else None
+        check_simplify(simplify, mode)
+        bucket_seconds = check_bucket(bucket, bucketMode, mode)
+        centroid = bucketMode == 'centroid'
+        pushdown = bool(bucket_seconds) and HISTORY_BUCKET_PUSHDOWN
+        # Sin pushdown se traen las filas crudas y limit se aplica después de bucket_rows
+        query, params = build_coordinates_query(
+            movilId, f"{startDate} 00:00:00",
+            HISTORY_BUCKET_FALLBACK_MAX_ROWS if bucket_seconds and not pushdown else limit, emp_ids,
+            bucket_seconds if pushdown else None, centroid
+        )
+        
+        # LOG: Imprimir query completo para debugging
+        logger.info(f"🔍 QUERY COMPLETO:\n{query}\nparams={params}")
+        
+        if mode:
+            envelope = {"success": True, "movilId": movilId, "startDate": startDate}
+            return await streaming_query_response(query, params, envelope, mode)
+        
+        # Rango cerrado desde el espejo local (si está habilitado y lo cubre), cola desde AS400
+        mirrored = None
+        if not emp_ids and not (bucket_seconds and not pushdown):
+            mirrored = await HISTORY_MIRROR.history(
+                f"{startDate} 00:00:00", limit, [movilId],
+                lambda desde: build_coordinates_query(movilId, desde, limit, None, bucket_seconds, centroid),
+                bucket_seconds=bucket_seconds, centroid=centroid
+            )
+        
+        if format == 'columnar' and mirrored is None and not (bucket_seconds and not pushdown):
+            columns, arrays = await query_db(execute_query_columnar, query, params)
+            count = len(arrays[0]) if arrays else 0
+            logger.info(f"✅ Retrieved {count} coordinates from AS400 (columnar)")
+            response_body = {
+                "success": True,
+                "movilId": movilId,
+                "startDate": startDate,
+                "count": count,
+                "format": "columnar",
+                "columns": columns,
+                "data": arrays
+            }
+            if simplify is not None:
+                response_body["data"] = simplify_columnar(columns, arrays, simplify)
+                response_body["count"] = len(response_body["data"][0]) if arrays else 0
+                response_body["originalCount"] = count
+                response_body["simplify"] = simplify
+            if bucket_seconds:
+                response_body["bucket"] = bucket
+                response_body["bucketMode"] = bucketMode
+            return response_body
+        
+        results = mirrored if mirrored is not None else await query_db(execute_query, query, params)
+        if bucket_seconds and not pushdown:
+            results = bucket_rows(results, bucket_seconds, centroid)[:limit]
+        
+        # LOG: Contar tipos de origen en los resultados
+        origen_counts = {}
+        updpedidos_count = 0
+        for r in results:
+            origen = r.get('origen', '').strip() if r.get('origen') else 'N/A'
+            origen_counts[origen] = origen_counts.get(origen, 0) + 1
+            if origen in ['UPDPEDIDOS', 'DYLPEDIDOS']:
+                updpedidos_count += 1
+                logger.info(f"  📦 {origen}: pedidoId={r.get('pedidoid')}, clienteX={r.get('clientex')}, clienteY={r.get('clientey')}")
+        
+        logger.info(f"✅ Retrieved {len(results)} coordinates from AS400")
+        logger.info(f"📊 Origen breakdown: {origen_counts}")
+        logger.info(f"🎯 Pedidos completados encontrados: {updpedidos_count}")
+        
+        response_body = {
+            "success": True,
+            "movilId": movilId,
+            "startDate": startDate,
+            "count": len(results),
+            "data": results
+        }
+        if simplify is not None:
+            response_body["data"] = simplify_rows(results, simplify)
+            response_body["count"] = len(response_body["data"])
+            response_body["originalCount"] = len(results)
+            response_body["simplify"] = simplify
+            logger.info(f"〰️ Recorrido simplificado: {len(results)} → {response_body['count']} puntos")
+        if bucket_seconds:
+            response_body["bucket"] = bucket
+            response_body["bucketMode"] = bucketMode
+        if format == 'columnar':
+            return to_columnar(response_body, LOGCOORDMOVIL_COLUMNS)
+        return response_body
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error en /coordinates: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error obteniendo coordenadas: {str(e)}"
+        )
+
+
+def build_latest_positions_query(
+    fecha_filtro: str,
+    movil_ids: Optional[List[int]] = None,
+    empresa_ids: Optional[List[int]] = None
+) -> Tuple[str, List[Any]]:
+    """Query (con parameter markers) de la última posición de cada móvil desde fecha_filtro (YYYY-MM-DD HH:MM:SS)"""
+    params: List[Any] = [fecha_filtro]
+    
+    movil_filter = ""
+    if movil_ids:
+        movil_markers, movil_params = in_list_params(movil_ids)
+        movil_filter = f"AND l2.LOGCOORDMOVILIDENTIFICADOR IN ({movil_markers})"
+        params.extend(movil_params)
+    
+    empresa_join = ""
+    empresa_filter = ""
+    if empresa_ids:
+        empresa_markers, empresa_params = in_list_params(empresa_ids)
+        empresa_join = "JOIN GXCALDTA.MOVILES mov2 ON l2.LOGCOORDMOVILIDENTIFICADOR = mov2.MOVID"
+        empresa_filter = f"AND mov2.EFLID IN ({empresa_markers})"
+        params.extend(empresa_params)
+    
+    schema = AS400_CONFIG['schema']
+    
+    # Filtros geográficos de Uruguay (aproximado)
+    # Uruguay: Lat -30° a -35°, Lng -53° a -58°
+    
+    # Query optimizado con JOIN a MOVILES para filtrar por empresa fletera
+    query = f"""
+        SELECT {LOGCOORDMOVIL_SELECT.format(a='l.')}
+        FROM {schema}.LOGCOORDMOVIL l
+        INNER JOIN (
+            SELECT 
+                l2.LOGCOORDMOVILIDENTIFICADOR,
+                MAX(l2.LOGCOORDMOVILFCHINSLOG) as max_fecha
+            FROM {schema}.LOGCOORDMOVIL l2
+            {empresa_join}
+            WHERE l2.LOGCOORDMOVILFCHINSLOG >= ?
+              AND l2.LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
+              AND l2.LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
+            {movil_filter}
+            {empresa_filter}
+            GROUP BY l2.LOGCOORDMOVILIDENTIFICADOR
+        ) latest ON l.LOGCOORDMOVILIDENTIFICADOR = latest.LOGCOORDMOVILIDENTIFICADOR
+                AND l.LOGCOORDMOVILFCHINSLOG = latest.max_fecha
+        WHERE l.LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
+          AND l.LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
+        ORDER BY l.LOGCOORDMOVILFCHINSLOG DESC
+    """
+    return query, params
+
+
+# 🛰️ TABLA DE POSICIONES EN VIVO: en lugar de re-escanear LOGCOORDMOVIL desde startDate con
+# GROUP BY/MAX en cada request, se siembra una vez por día la última posición de cada móvil y
+# un poller trae solo las filas con LOGCOORDMOVILFCHINSLOG posterior a la marca de agua.
+# /latest-positions del día se responde desde memoria: el costo en AS400 pasa a ser
+# proporcional a los puntos nuevos y no al volumen del día.
+LIVE_POSITIONS_CONFIG = {
+    'enabled': os.getenv('LIVE_POSITIONS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'poll_interval': float(os.getenv('LIVE_POSITIONS_POLL_INTERVAL', '5')),
+    # Se relee una pequeña ventana antes de la marca de agua por filas que commitean tarde
+    'overlap_seconds': float(os.getenv('LIVE_POSITIONS_OVERLAP_SECONDS', '10')),
+    'moviles_refresh_interval': float(os.getenv('LIVE_POSITIONS_MOVILES_REFRESH', '600')),
+}
+
+MOVILES_EMPRESA_QUERY = """
+    SELECT MOVID, EFLID
+    FROM GXCALDTA.MOVILES
+"""
+
+
+def build_positions_since_query(desde: str) -> Tuple[str, List[Any]]:
+    """Query (con parameter markers) de todas las coordenadas insertadas desde `desde`"""
+    schema = AS400_CONFIG['schema']
+    query = f"""
+        SELECT {LOGCOORDMOVIL_SELECT.format(a='')}
+        FROM {schema}.LOGCOORDMOVIL
+        WHERE LOGCOORDMOVILFCHINSLOG >= ?
+          AND LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
+          AND LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
+        ORDER BY LOGCOORDMOVILFCHINSLOG
+    """
+    return query, [desde]
+
+
+def _fch_key(value: Any) -> str:
+    """fechainslog comparable como texto ('YYYY-MM-DD HH:MM:SS[.ffffff]')"""
+    return str(value).replace('T', ' ') if value is not None else ''
+
+
+class LivePositionTable:
+    """
+    Última posición conocida de cada móvil en el día, mantenida incrementalmente.
+    
+    seed()/poll() son bloqueantes (corren en el executor de DB); las lecturas se hacen
+    desde el event loop. `version` aumenta cada vez que cambia alguna posición.
+    """
+
+    def __init__(self, poll_interval: float, overlap_seconds: float, moviles_refresh_interval: float, enabled: bool = True):
+        self.enabled = enabled
+        self.poll_interval = poll_interval
+        self.overlap_seconds = overlap_seconds
+        self.moviles_refresh_interval = moviles_refresh_interval
+        self._lock = threading.Lock()
+        self.day: Optional[str] = None
+        self.positions: Dict[int, Dict[str, Any]] = {}
+        self.movil_empresa: Dict[int, Any] = {}
+        self.movil_empresa_loaded = False
+        # Versión en la que cambió cada móvil (para respuestas delta con `since`)
+        self.changed_at: Dict[int, int] = {}
+        self.empresa_changed_at: Dict[int, int] = {}
+        self.watermark: Optional[str] = None
+        self.version = 0
+        self.refreshed_at: Optional[float] = None
+        self._moviles_loaded_at: Optional[float] = None
+        self.counters = {
+            'seeds': 0,
+            'polls': 0,
+            'poll_errors': 0,
+            'rows_fetched': 0,
+            'positions_changed': 0,
+            'last_poll_ms': None,
+        }
+
+    def covers(self, fecha_filtro: str) -> bool:
+        """¿Se puede responder fecha_filtro desde memoria? (mismo día que la tabla sembrada)"""
+        return self.enabled and self.refreshed_at is not None and fecha_filtro[:10] == self.day
+
+    def age(self) -> float:
+        return time.monotonic() - self.refreshed_at if self.refreshed_at is not None else float('inf')
+
+    def _load_moviles(self):
+        columns, rows = fetch_raw(MOVILES_EMPRESA_QUERY)
+        mapping = {int(movid): eflid for movid, eflid in rows}
+        with self._lock:
+            moved = [m for m in set(mapping) | set(self.movil_empresa) if mapping.get(m) != self.movil_empresa.get(m)]
+            self.movil_empresa = mapping
+            if moved and self.movil_empresa_loaded:
+                # Un móvil que cambia de empresa puede entrar o salir de un filtro empresaIds
+                self.version += 1
+                for movil_id in moved:
+                    self.empresa_changed_at[movil_id] = self.version
+            self.movil_empresa_loaded = True
+        self._moviles_loaded_at = time.monotonic()
+
+    def seed(self, day: str):
+        """Sembrar la tabla con la última posición de cada móvil del día (GROUP BY/MAX, una vez por día)"""
+        query, params = build_latest_positions_query(f"{day} 00:00:00")
+        rows = execute_query(query, params)
+        positions: Dict[int, Dict[str, Any]] = {}
+        for row in rows:
+            movil_id = row['identificador']
+            current = positions.get(movil_id)
+            if current is None or _fch_key(row['fechainslog']) >= _fch_key(current['fechainslog']):
+                positions[movil_id] = row
+        watermark = max((_fch_key(r['fechainslog']) for r in rows), default=f"{day} 00:00:00")
+        with self._lock:
+            self.day = day
+            self.positions = positions
+            self.watermark = watermark
+            self.version += 1
+            self.changed_at = {movil_id: self.version for movil_id in positions}
+            self.empresa_changed_at = {}
+            self.refreshed_at = time.monotonic()
+        self.counters['seeds'] += 1
+        logger.info(f"🛰️ Tabla de posiciones sembrada para {day}: {len(positions)} móviles, marca de agua {watermark}")
+
+    def poll(self) -> List[int]:
+        """Traer las filas nuevas desde la marca de agua y mezclarlas. Retorna los móviles que cambiaron."""
+        t0 = time.monotonic()
+        today = datetime.now().strftime('%Y-%m-%d')
+        if self._moviles_loaded_at is None or t0 - self._moviles_loaded_at > self.moviles_refresh_interval:
+            self._load_moviles()
+        if self.day != today:
+            self.seed(today)
+            self.counters['last_poll_ms'] = round((time.monotonic() - t0) * 1000, 1)
+            return list(self.positions)
+        
+        desde = datetime.fromisoformat(self.watermark) - timedelta(seconds=self.overlap_seconds)
+        query, params = build_positions_since_query(desde.strftime('%Y-%m-%d %H:%M:%S.%f'))
+        rows = execute_query(query, params)
+        
+        changed = []
+        with self._lock:
+            for row in rows:
+                movil_id = row['identificador']
+                current = self.positions.get(movil_id)
+                if current is None or _fch_key(row['fechainslog']) > _fch_key(current['fechainslog']):
+                    self.positions[movil_id] = row
+                    changed.append(movil_id)
+                    self.changed_at[movil_id] = self.version + 1
+                if _fch_key(row['fechainslog']) > self.watermark:
+                    self.watermark = _fch_key(row['fechainslog'])
+            if changed:
+                self.version += 1
+            self.refreshed_at = time.monotonic()
+        
+        self.counters['polls'] += 1
+        self.counters['rows_fetched'] += len(rows)
+        self.counters['positions_changed'] += len(changed)
+        self.counters['last_poll_ms'] = round((time.monotonic() - t0) * 1000, 1)
+        return changed
+
+    def query(
+        self,
+        fecha_filtro: str,
+        movil_ids: Optional[List[int]] = None,
+        empresa_ids: Optional[List[int]] = None
+    ) -> List[Dict[str, Any]]:
+        """Equivalente en memoria de build_latest_positions_query (más reciente primero)"""
+        desde = _fch_key(fecha_filtro)
+        movil_set = set(movil_ids) if movil_ids else None
+        empresa_set = set(empresa_ids) if empresa_ids else None
+        with self._lock:
+            rows = [
+                row for movil_id, row in self.positions.items()
+                if (movil_set is None or movil_id in movil_set)
+                and (empresa_set is None or self.movil_empresa.get(movil_id) in empresa_set)
+                and _fch_key(row['fechainslog']) >= desde
+            ]
+        rows.sort(key=lambda r: _fch_key(r['fechainslog']), reverse=True)
+        return rows
+
+    def delta(
+        self,
+        since_version: int,
+        fecha_filtro: str,
+        movil_ids: Optional[List[int]] = None,
+        empresa_ids: Optional[List[int]] = None
+    ) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """
+        Cambios desde since_version: (filas que avanzaron, móviles que dejaron de matchear el filtro).
+        Solo un cambio de empresa puede sacar a un móvil del resultado dentro del mismo día.
+        """
+        rows = [
+            row for row in self.query(fecha_filtro, movil_ids, empresa_ids)
+            if self.changed_at.get(row['identificador'], 0) > since_version
+            or self.empresa_changed_at.get(row['identificador'], 0) > since_version
+        ]
+        removed = []
+        if empresa_ids:
+            empresa_set = set(empresa_ids)
+            movil_set = set(movil_ids) if movil_ids else None
+            with self._lock:
+                removed = sorted(
+                    movil_id for movil_id, version in self.empresa_changed_at.items()
+                    if version > since_version
+                    and (movil_set is None or movil_id in movil_set)
+                    and self.movil_empresa.get(movil_id) not in empresa_set
+                )
+        return rows, removed
+
+    def rows_for(self, movil_ids: Sequence[int]) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self.positions[m] for m in movil_ids if m in self.positions]
+
+    async def refresh(self):
+        """Un poll (coalescido) y publicación de los cambios a los suscriptores del stream"""
+        day = self.day
+        changed = await DB_SINGLE_FLIGHT.do(('live_positions_poll',), self.poll)
+        if self.day != day:
+            MOVIL_GRID.rebuild(self.rows_for(list(self.positions)))
+            POSITION_HUB.resync(self.version)
+        elif changed:
+            rows = self.rows_for(changed)
+            MOVIL_GRID.update(rows)
+            POSITION_HUB.publish(self.version, rows)
+
+    async def ensure_fresh(self, max_staleness: float):
+        """Si la tabla está más vieja que max_staleness (poller trabado), hacer un poll sincrónico"""
+        if self.age() > max_staleness:
+            await self.refresh()
+
+    async def run(self):
+        """Tarea de fondo: poll incremental cada poll_interval segundos"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.counters['poll_errors'] += 1
+                logger.error(f"❌ Error en poll de posiciones en vivo: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'day': self.day,
+            'moviles': len(self.positions),
+            'watermark': self.watermark,
+            'version': self.version,
+            'age_seconds': round(self.age(), 1) if self.refreshed_at is not None else None,
+            **self.counters,
+        }
+
+
+LIVE_POSITIONS = LivePositionTable(**LIVE_POSITIONS_CONFIG)
+
+
+# 🧭 ÍNDICE ESPACIAL de las posiciones en vivo: grilla uniforme (celda → móviles) que se
+# actualiza con cada poll de LIVE_POSITIONS solo para los móviles que cambiaron.
+# /moviles-near responde k-más-cercanos y radio desde memoria, sin ir a AS400.
+SPATIAL_INDEX_CONFIG = {
+    # Lado de la celda fina en grados (0.01 ≈ 1,1 km); la grilla gruesa es coarse_factor veces
+    # más grande y atiende las búsquedas en zonas con pocos móviles
+    'cell_degrees': float(os.getenv('SPATIAL_INDEX_CELL_DEGREES', '0.01')),
+    'coarse_factor': int(os.getenv('SPATIAL_INDEX_COARSE_FACTOR', '16')),
+    # Anillos de la grilla fina antes de pasar a la gruesa
+    'fine_rings': int(os.getenv('SPATIAL_INDEX_FINE_RINGS', '4')),
+}
+EARTH_RADIUS_METERS = 6_371_008.8
+
+
+def haversine_meters(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    h = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(h))
+
+
+class SpatialGrid:
+    """
+    Grilla uniforme en grados sobre la última posición de cada móvil (coordx = lat, coordy = lng).
+    
+    Se modifica y se consulta desde el event loop (refresh de LIVE_POSITIONS y endpoints),
+    así que no necesita lock.
+    """
+
+    def __init__(self, cell_degrees: float):
+        self._set_cell(cell_degrees)
+        self.cells: Dict[Tuple[int, int], set] = {}
+        self.points: Dict[int, Tuple[float, float, Tuple[int, int]]] = {}
+        self.rows: Dict[int, Dict[str, Any]] = {}
+        # Caja (en celdas) que contiene todas las celdas ocupadas; solo crece hasta el próximo rebuild
+        self.bounds: Optional[List[int]] = None
+
+    def _set_cell(self, cell_degrees: float):
+        self.cell_degrees = cell_degrees
+        self.cell_meters = cell_degrees * math.pi / 180 * EARTH_RADIUS_METERS
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lng / self.cell_degrees))
+
+    def _put(self, row: Dict[str, Any]):
+        movil_id = row['identificador']
+        if row.get('coordx') is None or row.get('coordy') is None:
+            return
+        lat, lng = float(row['coordx']), float(row['coordy'])
+        cell = self._cell(lat, lng)
+        previous = self.points.get(movil_id)
+        if previous is not None and previous[2] != cell:
+            members = self.cells[previous[2]]
+            members.discard(movil_id)
+            if not members:
+                del self.cells[previous[2]]
+        self.cells.setdefault(cell, set()).add(movil_id)
+        self.points[movil_id] = (lat, lng, cell)
+        self.rows[movil_id] = row
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            b = self.bounds
+            b[0], b[1], b[2], b[3] = min(b[0], cell[0]), max(b[1], cell[0]), min(b[2], cell[1]), max(b[3], cell[1])
+
+    def rebuild(self, rows: List[Dict[str, Any]]):
+        self.cells, self.points, self.rows, self.bounds = {}, {}, {}, None
+        for row in rows:
+            self._put(row)
+
+    def update(self, rows: List[Dict[str, Any]]):
+        for row in rows:
+            self._put(row)
+
+    @staticmethod
+    def _ring(ci: int, cj: int, ring: int, lng_span: int):
+        """Celdas del borde del anillo `ring` (ring celdas de latitud, ring * lng_span de longitud)"""
+        if ring == 0:
+            yield ci, cj
+            return
+        width = ring * lng_span
+        inner = (ring - 1) * lng_span
+        for j in range(cj - width, cj + width + 1):
+            yield ci - ring, j
+            yield ci + ring, j
+        for i in range(ci - ring + 1, ci + ring):
+            for j in range(cj - width, cj - inner):
+                yield i, j
+            for j in range(cj + inner + 1, cj + width + 1):
+                yield i, j
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int,
+        radius: Optional[float] = None,
+        accept: Optional[Callable[[int], bool]] = None,
+        max_rings: Optional[int] = None
+    ) -> Optional[List[Tuple[float, Dict[str, Any]]]]:
+        """
+        Hasta k móviles más cercanos a (lat, lng), opcionalmente dentro de `radius` metros.
+        
+        Recorre anillos de celdas crecientes hasta que el k-ésimo candidato está más cerca que
+        cualquier celda sin visitar; si el anillo ya tiene más celdas que las ocupadas, barre
+        todos los puntos. Los candidatos se ordenan con distancia equirectangular y los finales
+        se reordenan con haversine. Retorna [(distancia en metros, fila)] ordenado, o None si
+        no pudo concluir en max_rings anillos.
+        """
+        if not self.cells:
+            return []
+        ci, cj = self._cell(lat, lng)
+        cell_m = self.cell_meters
+        ky = math.pi / 180 * EARTH_RADIUS_METERS
+        kx = ky * math.cos(math.radians(lat))
+        # Celdas de longitud por celda de latitud, para que cada anillo cubra un "cuadrado" en metros
+        lng_span = max(1, math.ceil(ky / max(kx, ky * 0.01)))
+        b = self.bounds
+        max_ring = max(abs(ci - b[0]), abs(ci - b[1]), math.ceil(max(abs(cj - b[2]), abs(cj - b[3])) / lng_span))
+        if radius is not None:
+            max_ring = min(max_ring, math.ceil(radius / cell_m) + 1)
+        # Con el error de la aproximación equirectangular, se toman de más y se reordenan con haversine
+        limit2 = (radius * 1.01) ** 2 if radius is not None else None
+        
+        found: List[Tuple[float, int]] = []
+        
+        def visit(members):
+            for movil_id in members:
+                if accept is not None and not accept(movil_id):
+                    continue
+                p_lat, p_lng, _ = self.points[movil_id]
+                dy = (p_lat - lat) * ky
+                dx = (p_lng - lng) * kx
+                d2 = dx * dx + dy * dy
+                if limit2 is None or d2 <= limit2:
+                    found.append((d2, movil_id))
+        
+        ring = 0
+        while ring <= max_ring:
+            if (2 * ring + 1) * (2 * ring * lng_span + 1) > len(self.cells):
+                # Barrer todos los puntos es más barato que seguir recorriendo anillos casi vacíos
+                found = []
+                visit(self.points)
+                break
+            for cell in self._ring(ci, cj, ring, lng_span):
+                members = self.cells.get(cell)
+                if members:
+                    visit(members)
+            # Todo lo que queda sin visitar está a más de `ring` celdas completas del centro
+            if len(found) >= k and sorted(found)[k - 1][0] <= (ring * cell_m * 0.99) ** 2:
+                break
+            if max_rings is not None and ring >= max_rings and ring < max_ring:
+                return None
+            ring += 1
+        
+        found.sort()
+        candidates = []
+        for _, movil_id in found[:k * 2 + 4]:
+            p_lat, p_lng, _ = self.points[movil_id]
+            distance = haversine_meters(lat, lng, p_lat, p_lng)
+            if radius is None or distance <= radius:
+                candidates.append((distance, movil_id))
+        candidates.sort()
+        return [(distance, self.rows[movil_id]) for distance, movil_id in candidates[:k]]
+
+
+class SpatialIndex:
+    """
+    Dos SpatialGrid sobre las mismas posiciones: la fina resuelve rápido donde la flota es
+    densa y, si no concluye en fine_rings anillos (zona con pocos móviles), responde la gruesa.
+    """
+
+    def __init__(self, cell_degrees: float, coarse_factor: int, fine_rings: int):
+        self.fine = SpatialGrid(cell_degrees)
+        self.coarse = SpatialGrid(cell_degrees * coarse_factor)
+        self.fine_rings = fine_rings
+        self.counters = {'rebuilds': 0, 'updates': 0, 'queries': 0, 'coarse_queries': 0, 'last_query_us': None}
+
+    def rebuild(self, rows: List[Dict[str, Any]]):
+        self.fine.rebuild(rows)
+        self.coarse.rebuild(rows)
+        self.counters['rebuilds'] += 1
+
+    def update(self, rows: List[Dict[str, Any]]):
+        self.fine.update(rows)
+        self.coarse.update(rows)
+        self.counters['updates'] += 1
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int,
+        radius: Optional[float] = None,
+        accept: Optional[Callable[[int], bool]] = None
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """Hasta k móviles más cercanos (dentro de `radius` metros si se indica): [(metros, fila)]"""
+        t0 = time.perf_counter()
+        result = self.fine.nearest(lat, lng, k, radius, accept, max_rings=self.fine_rings)
+        if result is None:
+            result = self.coarse.nearest(lat, lng, k, radius, accept)
+            self.counters['coarse_queries'] += 1
+        self.counters['queries'] += 1
+        self.counters['last_query_us'] = round((time.perf_counter() - t0) * 1_000_000, 1)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'cell_degrees': self.fine.cell_degrees,
+            'coarse_cell_degrees': self.coarse.cell_degrees,
+            'moviles': len(self.fine.points),
+            'cells': len(self.fine.cells),
+            'coarse_cells': len(self.coarse.cells),
+            **self.counters,
+        }
+
+
+MOVIL_GRID = SpatialIndex(**SPATIAL_INDEX_CONFIG)
+
+
+# 📡 STREAM DE POSICIONES (SSE): un único poll de LIVE_POSITIONS se reparte a todos los
+# suscriptores, así la carga en AS400 no crece con la cantidad de pestañas abiertas.
+STREAM_CONFIG = {
+    'max_subscribers': int(os.getenv('STREAM_MAX_SUBSCRIBERS', '500')),
+    'queue_size': int(os.getenv('STREAM_QUEUE_SIZE', '64')),
+    'keepalive': float(os.getenv('STREAM_KEEPALIVE_SECONDS', '15')),
+}
+
+
+class PositionSubscriber:
+    """Un cliente del stream: filtros opcionales y cola acotada de eventos pendientes"""
+
+    def __init__(self, movil_ids: Optional[List[int]], empresa_ids: Optional[List[int]], queue_size: int):
+        self.movil_ids = movil_ids
+        self.empresa_ids = empresa_ids
+        self.movil_set = set(movil_ids) if movil_ids else None
+        self.empresa_set = set(empresa_ids) if empresa_ids else None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def matches(self, row: Dict[str, Any], movil_empresa: Dict[int, Any]) -> bool:
+        movil_id = row['identificador']
+        if self.movil_set is not None and movil_id not in self.movil_set:
+            return False
+        if self.empresa_set is not None and movil_empresa.get(movil_id) not in self.empresa_set:
+            return False
+        return True
+
+
+class PositionHub:
+    """
+    Fan-out de cambios de posición a los suscriptores.
+    
+    Corre en el event loop. Un suscriptor lento no frena a los demás: si su cola se
+    llena se vacía y se le encola un snapshot completo (resync).
+    """
+
+    def __init__(self, max_subscribers: int, queue_size: int, keepalive: float):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.subscribers: set = set()
+        self.last_version = 0
+        self.counters = {
+            'subscribed': 0,
+            'rejected': 0,
+            'events_published': 0,
+            'resyncs': 0,
+        }
+
+    def subscribe(self, movil_ids: Optional[List[int]], empresa_ids: Optional[List[int]]) -> PositionSubscriber:
+        if len(self.subscribers) >= self.max_subscribers:
+            self.counters['rejected'] += 1
+            raise HTTPException(status_code=503, detail="Demasiados suscriptores al stream de posiciones")
+        sub = PositionSubscriber(movil_ids, empresa_ids, self.queue_size)
+        self.subscribers.add(sub)
+        self.counters['subscribed'] += 1
+        return sub
+
+    def unsubscribe(self, sub: PositionSubscriber):
+        self.subscribers.discard(sub)
+
+    def _offer(self, sub: PositionSubscriber, event: Tuple[str, Any]):
+        try:
+            sub.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not sub.queue.empty():
+                sub.queue.get_nowait()
+            sub.queue.put_nowait(('snapshot', None))
+            self.counters['resyncs'] += 1
+
+    def publish(self, version: int, rows: List[Dict[str, Any]]):
+        """Encolar a cada suscriptor los cambios que le corresponden (una vez por versión)"""
+        if version <= self.last_version:
+            return
+        self.last_version = version
+        movil_empresa = LIVE_POSITIONS.movil_empresa
+        for sub in list(self.subscribers):
+            if sub.movil_set is None and sub.empresa_set is None:
+                matching = rows
+            else:
+                matching = [row for row in rows if sub.matches(row, movil_empresa)]
+            if matching:
+                self._offer(sub, ('positions', (version, matching)))
+                self.counters['events_published'] += 1
+
+    def resync(self, version: int):
+        """Cambio de día: todos los suscriptores reciben un snapshot nuevo"""
+        self.last_version = version
+        for sub in list(self.subscribers):
+            self._offer(sub, ('snapshot', None))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'subscribers': len(self.subscribers),
+            'max_subscribers': self.max_subscribers,
+            'last_version': self.last_version,
+            **self.counters,
+        }
+
+
+POSITION_HUB = PositionHub(**STREAM_CONFIG)
+
+
+def _sse_event(event: str, event_id: int, payload: Any) -> bytes:
+    return f"event: {event}\nid: {event_id}\ndata: ".encode("utf-8") + dumps_json(payload) + b"\n\n"
+
+
+# 📸 SNAPSHOT DE LA FLOTA (stale-while-revalidate): la última posición de todos los móviles
+# se refresca en segundo plano un poco antes de que venza, así el request que llega después
+# del TTL no espera la query a LOGCOORDMOVIL. La edad del snapshot va en los headers
+# Age / X-Snapshot-Age y el cuerpo trae la hora del refresco ("refreshedAt", fija por versión);
+# pasado max_staleness el request refresca de forma sincrónica. Solo se refresca en segundo
+# plano el día en curso: los días anteriores cambian poco y se recargan al pedirlos pasado
+# max_staleness.
+SNAPSHOT_CONFIG = {
+    'refresh_interval': float(os.getenv('SNAPSHOT_REFRESH_INTERVAL', str(max(CACHE_TTLS['latest_positions'] - 5, 1)))),
+    'max_staleness': float(os.getenv('SNAPSHOT_MAX_STALENESS', '90')),
+    'idle_timeout': float(os.getenv('SNAPSHOT_IDLE_TIMEOUT', '300')),
+}
+
+
+class FleetSnapshot:
+    """Snapshots de /latest-positions sin filtros, uno por fecha_filtro pedida recientemente"""
+
+    def __init__(self, refresh_interval: float, max_staleness: float, idle_timeout: float):
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.idle_timeout = idle_timeout
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._version = 0
+        self.counters = {
+            'served': 0,
+            'sync_refreshes': 0,
+            'background_refreshes': 0,
+            'refresh_errors': 0,
+        }
+
+    async def _refresh(self, fecha_filtro: str) -> Dict[str, Any]:
+        query, params = build_latest_positions_query(fecha_filtro)
+        results = await query_db(execute_query, query, params)
+        entry = self._entries.setdefault(fecha_filtro, {'last_access': time.monotonic()})
+        entry['response'] = {
             "success": True,
-            "empresaId": empresaId,
             "count": len(results),
             "data": results,
-            "timestamp": datetime.now().isoformat()
+            "refreshedAt": datetime.now().isoformat(timespec='seconds'),
+        }
+        entry['refreshed_at'] = time.monotonic()
+        self._version += 1
+        entry['version'] = self._version
+        return entry
+
+    async def get(self, fecha_filtro: str) -> Tuple[Dict[str, Any], float, bool, int]:
+        """(respuesta, edad en segundos, servida desde el snapshot sin esperar a AS400, versión)"""
+        now = time.monotonic()
+        entry = self._entries.get(fecha_filtro)
+        from_snapshot = entry is not None and 'response' in entry and now - entry['refreshed_at'] <= self.max_staleness
+        if from_snapshot:
+            entry['last_access'] = now
+        else:
+            self.counters['sync_refreshes'] += 1
+            entry = await self._refresh(fecha_filtro)
+            entry['last_access'] = time.monotonic()
+        self.counters['served'] += 1
+        return entry['response'], time.monotonic() - entry['refreshed_at'], from_snapshot, entry['version']
+
+    async def _background_refresh(self, fecha_filtro: str):
+        try:
+            await self._refresh(fecha_filtro)
+            self.counters['background_refreshes'] += 1
+        except Exception as e:
+            self.counters['refresh_errors'] += 1
+            logger.error(f"❌ Error refrescando snapshot de flota ({fecha_filtro}): {str(e)}")
+        finally:
+            self._refreshing.pop(fecha_filtro, None)
+
+    async def run(self):
+        """Tarea de fondo: refrescar snapshots del día próximos a vencer y olvidar los que nadie pide"""
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            today = datetime.now().strftime('%Y-%m-%d')
+            for fecha_filtro, entry in list(self._entries.items()):
+                if now - entry['last_access'] > self.idle_timeout:
+                    del self._entries[fecha_filtro]
+                    logger.info(f"🧹 Snapshot de flota {fecha_filtro} descartado por inactividad")
+                    continue
+                if fecha_filtro in self._refreshing or 'refreshed_at' not in entry or fecha_filtro[:10] != today:
+                    continue
+                if now - entry['refreshed_at'] >= self.refresh_interval:
+                    self._refreshing[fecha_filtro] = asyncio.create_task(self._background_refresh(fecha_filtro))
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            **self.counters,
+            'refresh_interval': self.refresh_interval,
+            'max_staleness': self.max_staleness,
+            'snapshots': {
+                fecha_filtro: {
+                    'age_seconds': round(now - entry['refreshed_at'], 1) if 'refreshed_at' in entry else None,
+                    'count': entry['response']['count'] if 'response' in entry else None,
+                }
+                for fecha_filtro, entry in self._entries.items()
+            },
         }
+
+
+FLEET_SNAPSHOT = FleetSnapshot(**SNAPSHOT_CONFIG)
+
+
+def _latest_positions_from_db(kwargs: Dict[str, Any]) -> bool:
+    """Solo los requests filtrados de días anteriores van al caché de respuestas + AS400"""
+    if LIVE_POSITIONS.covers(kwargs.get('startDate') or ''):
+        return False
+    return bool(kwargs.get('movilIds') or kwargs.get('empresaIds'))
+
+
+def encode_since_token(day: str, version: int) -> str:
+    """Token opaco para `since`: día, arranque del proceso y versión de la tabla en vivo"""
+    raw = f"{day}:{PROCESS_EPOCH}:{version}"
+    return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_since_token(token: str) -> Tuple[str, int, int]:
+    """(día, epoch, versión) de un token `since` (400 si es inválido)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("ascii")
+        day, epoch, version = raw.split(":")
+        return day, int(epoch), int(version)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Token 'since' inválido")
+
+
+def build_etag(*parts: Any) -> str:
+    """ETag fuerte a partir de la versión de los datos y los parámetros que determinan el cuerpo"""
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """¿El If-None-Match del request incluye este ETag?"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    candidates = [c.strip() for c in header.split(',')]
+    return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+# 🗺️ VIEWPORT DEL MAPA: /latest-positions con bbox= filtra a la zona visible y con zoom= arma
+# tiles Web Mercator (256 px) desde el snapshot/tabla en vivo. Hasta cluster_max_zoom cada tile
+# trae clusters (cantidad + centroide por celda de cluster_cell_px); más cerca, los móviles.
+# El índice por tile y los clusters de cada tile se cachean por versión de los datos, así al
+# mover el mapa solo se calculan los tiles nuevos.
+VIEWPORT_CONFIG = {
+    'cluster_max_zoom': int(os.getenv('VIEWPORT_CLUSTER_MAX_ZOOM', '13')),
+    'cluster_cell_px': int(os.getenv('VIEWPORT_CLUSTER_CELL_PX', '64')),
+    # Con zoom mayor los tiles de móviles individuales se arman a este zoom (tiles más grandes)
+    'max_tile_zoom': int(os.getenv('VIEWPORT_MAX_TILE_ZOOM', '15')),
+}
+CLUSTER_COLUMNS = ['lat', 'lng', 'count', 'identificador', 'bbox']
+MERCATOR_MAX_LAT = 85.05112878
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    """'oeste,sur,este,norte' (lng,lat,lng,lat) → tupla de floats (400 si es inválido)"""
+    try:
+        west, south, east, north = (float(v) for v in value.split(','))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox debe ser 'oeste,sur,este,norte' (lng,lat,lng,lat)")
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise HTTPException(status_code=400, detail="bbox fuera de rango u ordenado al revés")
+    return west, south, east, north
+
+
+def _mercator(lat: float, lng: float) -> Tuple[float, float]:
+    """(x, y) Web Mercator normalizado a [0, 1)"""
+    lat = min(max(lat, -MERCATOR_MAX_LAT), MERCATOR_MAX_LAT)
+    x = (lng + 180) / 360
+    y = (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2
+    return x, y
+
+
+def _row_latlng(row: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    if row.get('coordx') is None or row.get('coordy') is None:
+        return None
+    return float(row['coordx']), float(row['coordy'])
+
+
+def _tile_index(source_key: Optional[Tuple[Any, ...]], rows: List[Dict[str, Any]], zoom: int) -> Dict[Tuple[int, int], List[Dict[str, Any]]]:
+    """Filas agrupadas por tile (x, y) al zoom dado; cacheado por versión de los datos (source_key)"""
+    key = ('viewport_tiles', 'index', source_key, zoom)
+    if source_key is not None:
+        hit = RESPONSE_CACHE.get(key)
+        if hit is not None:
+            return hit[0]
+    n = 2 ** zoom
+    index: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+    for row in rows:
+        latlng = _row_latlng(row)
+        if latlng is None:
+            continue
+        x, y = _mercator(*latlng)
+        index.setdefault((min(int(x * n), n - 1), min(int(y * n), n - 1)), []).append(row)
+    if source_key is not None:
+        RESPONSE_CACHE.set(key, index, CACHE_TTLS['viewport_tiles'])
+    return index
+
+
+def _tile_clusters(source_key: Optional[Tuple[Any, ...]], tile: Tuple[int, int], rows: List[Dict[str, Any]], zoom: int) -> List[Dict[str, Any]]:
+    """Clusters (cantidad, centroide y caja) por celda de cluster_cell_px dentro de un tile"""
+    key = ('viewport_tiles', 'clusters', source_key, zoom, tile)
+    if source_key is not None:
+        hit = RESPONSE_CACHE.get(key)
+        if hit is not None:
+            return hit[0]
+    scale = 2 ** zoom * 256 / VIEWPORT_CONFIG['cluster_cell_px']
+    cells: Dict[Tuple[int, int], List[Tuple[float, float, Any]]] = {}
+    for row in rows:
+        lat, lng = _row_latlng(row)
+        x, y = _mercator(lat, lng)
+        cells.setdefault((int(x * scale), int(y * scale)), []).append((lat, lng, row['identificador']))
+    clusters = []
+    for cell in sorted(cells):
+        points = cells[cell]
+        lats = [p[0] for p in points]
+        lngs = [p[1] for p in points]
+        clusters.append({
+            "lat": round(sum(lats) / len(points), 6),
+            "lng": round(sum(lngs) / len(points), 6),
+            "count": len(points),
+            "identificador": points[0][2] if len(points) == 1 else None,
+            "bbox": [min(lngs), min(lats), max(lngs), max(lats)],
+        })
+    if source_key is not None:
+        RESPONSE_CACHE.set(key, clusters, CACHE_TTLS['viewport_tiles'])
+    return clusters
+
+
+def apply_viewport(
+    source_key: Optional[Tuple[Any, ...]],
+    rows: List[Dict[str, Any]],
+    bbox: Optional[Tuple[float, float, float, float]],
+    zoom: Optional[int]
+) -> Dict[str, Any]:
+    """
+    Campos de respuesta para bbox/zoom sobre las últimas posiciones `rows`.
     
-    except Exception as e:
-        logger.error(f"❌ Error obteniendo móviles de empresa {empresaId}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    Sin zoom: las filas dentro de bbox. Con zoom: los tiles que tocan bbox (o todos los
+    ocupados), con clusters hasta cluster_max_zoom y filas más cerca. source_key identifica
+    la versión de `rows` para cachear por tile (None = sin caché, ej: consultas a AS400).
+    """
+    if zoom is None:
+        west, south, east, north = bbox
+        data = []
+        for row in rows:
+            latlng = _row_latlng(row)
+            if latlng is not None and south <= latlng[0] <= north and west <= latlng[1] <= east:
+                data.append(row)
+        return {"bbox": list(bbox), "count": len(data), "data": data}
+    
+    clustered = zoom <= VIEWPORT_CONFIG['cluster_max_zoom']
+    tile_zoom = zoom if clustered else min(zoom, VIEWPORT_CONFIG['max_tile_zoom'])
+    index = _tile_index(source_key, rows, tile_zoom)
+    tiles = sorted(index)
+    if bbox is not None:
+        n = 2 ** tile_zoom
+        west, south, east, north = bbox
+        x0, y0 = _mercator(north, west)
+        x1, y1 = _mercator(south, east)
+        tx0, ty0 = int(x0 * n), int(y0 * n)
+        tx1, ty1 = min(int(x1 * n), n - 1), min(int(y1 * n), n - 1)
+        tiles = [t for t in tiles if tx0 <= t[0] <= tx1 and ty0 <= t[1] <= ty1]
+    
+    result: Dict[str, Any] = {"zoom": zoom, "bbox": list(bbox) if bbox else None, "tiles": len(tiles), "clustered": clustered}
+    if clustered:
+        clusters = [c for tile in tiles for c in _tile_clusters(source_key, tile, index[tile], tile_zoom)]
+        result.update(count=sum(c['count'] for c in clusters), clusters=len(clusters), data=clusters)
+    else:
+        data = [row for tile in tiles for row in index[tile]]
+        result.update(count=len(data), data=data)
+    return result
 
 
-@app.get("/coordinates")
-async def get_coordinates(
-    movilId: int = Query(..., description="ID del vehículo a consultar"),
-    startDate: str = Query(..., description="Fecha inicial en formato YYYY-MM-DD"),
-    limit: int = Query(1, ge=1, le=1000, description="Límite de registros (1-1000, default: 1 = más reciente)"),
-    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (opcional)")
+@app.get("/latest-positions")
+@negotiated_route
+@cached_route('latest_positions', when=_latest_positions_from_db)
+async def get_latest_positions(
+    request: Request,
+    response: Response,
+    startDate: str = Query(..., description="Fecha inicial en formato YYYY-MM-DD HH:MM:SS o YYYY-MM-DD"),
+    movilIds: Optional[str] = Query(None, description="IDs de vehículos separados por comas (ej: 693,251,337). Si no se especifica, retorna todos los móviles."),
+    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (ej: 103,105). Filtra móviles por empresa."),
+    since: Optional[str] = Query(None, description="Token `since` de una respuesta anterior: retorna solo los móviles que cambiaron"),
+    format: str = Query('json', description="json | columnar (un array por columna)"),
+    bbox: Optional[str] = Query(None, description="Zona visible del mapa: oeste,sur,este,norte (ej: -56.3,-34.95,-56.0,-34.8)"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description="Zoom del mapa: hasta VIEWPORT_CLUSTER_MAX_ZOOM retorna clusters, más cerca móviles por tile")
 ):
     """
-    Obtener coordenadas de un vehículo específico (por defecto solo la más reciente)
+    Obtener la ÚLTIMA posición de cada móvil (solo una coordenada por móvil)
     
     Parámetros:
-    - movilId: ID del vehículo (ej: 693, 251, 337)
-    - startDate: Fecha inicial en formato YYYY-MM-DD (ej: 2025-10-14)
-    - limit: Cantidad máxima de registros a retornar (default: 1 = solo la más reciente)
+    - startDate: Fecha inicial (ej: '2025-10-14' o '2025-10-14 14:30:00')
+    - movilIds: IDs de vehículos separados por comas (opcional)
     
-    Retorna lista de coordenadas con formato:
-    ```json
-    [
-      {
-        "identificador": 693,
-        "origen": "GPS",
-        "coordx": -34.9011,
-        "coordy": -56.1645,
-        "fechainslog": "2025-10-14T10:30:00",
-        "auxin2": "INFO",
-        "distrecorrida": 12.5
-      }
-    ]
-    ```
+    Retorna un objeto por cada móvil con su última coordenada registrada.
+    El día en curso se responde desde la tabla de posiciones en vivo (poll incremental);
+    otros días sin filtros se sirven del snapshot. La edad va en los headers Age y X-Snapshot-Age
+    (el cuerpo del snapshot trae la hora absoluta del refresco en "refreshedAt").
+    
+    Las respuestas del día en curso traen un token `since` y un ETag: con `since` se reciben
+    solo los móviles cuyo fechaInsLog avanzó (+ `removed`), con If-None-Match un 304 si nada cambió.
+    En otros días `since` no aplica: la respuesta es completa y trae delta=false, reset=true.
+    Con format=columnar "data" trae un array por cada columna listada en "columns".
+    Con Accept: application/msgpack o application/vnd.apache.arrow.stream la respuesta es binaria
+    (msgpack y pyarrow van en requirements.txt; sin la librería el formato responde 406).
+    
+    Con bbox (oeste,sur,este,norte) solo vienen los móviles de la zona visible. Con zoom la
+    respuesta se arma por tiles: clusters ("clustered": true, cada uno con lat, lng, count y
+    bbox) hasta VIEWPORT_CLUSTER_MAX_ZOOM y móviles individuales con más zoom.
     """
     
-    logger.info(f"📥 Request recibido: movilId={movilId}, startDate={startDate}, limit={limit}")
+    logger.info(f"📥 /latest-positions - startDate={startDate}, movilIds={movilIds}")
     
     try:
-        # Validar formato de fecha
+        check_format(format, ('json', 'columnar'))
+        viewport_box = parse_bbox(bbox) if bbox else None
+        viewport = viewport_box is not None or zoom is not None
+        if viewport and since:
+            raise HTTPException(status_code=400, detail="since no admite bbox/zoom")
+        
+        def output(payload: Dict[str, Any]) -> Dict[str, Any]:
+            if format != 'columnar':
+                return payload
+            return to_columnar(payload, CLUSTER_COLUMNS if payload.get('clustered') else LOGCOORDMOVIL_COLUMNS)
+        
+        def shape(payload: Dict[str, Any], source_key: Optional[Tuple[Any, ...]]) -> Dict[str, Any]:
+            if not viewport:
+                return payload
+            return {**payload, **apply_viewport(source_key, payload['data'], viewport_box, zoom)}
+        
+        def precompressed(key: Tuple[Any, ...], build: Callable[[], Dict[str, Any]]):
+            # Cuerpos de snapshot/tabla en vivo: se serializan y comprimen una vez por versión
+            if request.state.media_type != MEDIA_JSON:
+                return output(build())
+            return precompressed_json(request, response, key, lambda: output(build()))
+        
+        # Validar y formatear fecha
         try:
-            datetime.strptime(startDate, '%Y-%m-%d')
+            if ' ' in startDate:
+                # Ya tiene hora
+                datetime.strptime(startDate, '%Y-%m-%d %H:%M:%S')
+                fecha_filtro = startDate
+            else:
+                # Solo fecha, agregar hora 00:00:00
+                datetime.strptime(startDate, '%Y-%m-%d')
+                fecha_filtro = f"{startDate} 00:00:00"
         except ValueError:
             raise HTTPException(
                 status_code=400,
-                detail="Formato de fecha inválido. Use YYYY-MM-DD"
+                detail="Formato de fecha inválido. Use 'YYYY-MM-DD' o 'YYYY-MM-DD HH:MM:SS'"
             )
         
-        # Construir query con JOIN opcional para filtro de empresas
-        schema = AS400_CONFIG['schema']
+        ids = parse_id_list(movilIds, 'movilIds') if movilIds else None
+        emp_ids = parse_id_list(empresaIds, 'empresaIds') if empresaIds else None
         
-        # Determinar si necesitamos JOIN con MOVILES
-        if empresaIds:
-            empresa_list = empresaIds.split(',')
-            empresa_filter = f"AND m.EFLID IN ({','.join(empresa_list)})"
+        # 🛰️ Día en curso: responder desde la tabla de posiciones en vivo
+        if LIVE_POSITIONS.covers(fecha_filtro):
+            await LIVE_POSITIONS.ensure_fresh(SNAPSHOT_CONFIG['max_staleness'])
+            day, version = LIVE_POSITIONS.day, LIVE_POSITIONS.version
             
-            query = f"""
-                SELECT 
-                    l.LOGCOORDMOVILIDENTIFICADOR as identificador,
-                    l.LOGCOORDMOVILORIGEN as origen,
-                    l.LOGCOORDMOVILCOORDX as coordX,
-                    l.LOGCOORDMOVILCOORDY as coordY,
-                    l.LOGCOORDMOVILFCHINSLOG as fechaInsLog,
-                    l.LOGCOORDMOVILAUXIN2 as auxIn2,
-                    l.LOGCOORDMOVILDISTRECORRIDA as distRecorrida,
-                    l.LOGCOORDMOVILOBS as obs,
-                    l.LOGCOORDMOVILpedid as pedidoId,
-                    l.logcoordmovilcoordclix as clienteX,
-                    l.logcoordmovilcoordcliy as clienteY
-                FROM {schema}.LOGCOORDMOVIL l
-                JOIN GXCALDTA.MOVILES m ON l.LOGCOORDMOVILIDENTIFICADOR = m.MOVID
-                WHERE l.LOGCOORDMOVILFCHINSLOG >= '{startDate}'
-                  AND l.LOGCOORDMOVILIDENTIFICADOR = {movilId}
-                  AND l.LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
-                  AND l.LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
-                  {empresa_filter}
-                ORDER BY l.LOGCOORDMOVILFCHINSLOG DESC
-                FETCH FIRST {limit} ROWS ONLY
-            """
-        else:
-            query = f"""
-                SELECT 
-                    LOGCOORDMOVILIDENTIFICADOR as identificador,
-                    LOGCOORDMOVILORIGEN as origen,
-                    LOGCOORDMOVILCOORDX as coordX,
-                    LOGCOORDMOVILCOORDY as coordY,
-                    LOGCOORDMOVILFCHINSLOG as fechaInsLog,
-                    LOGCOORDMOVILAUXIN2 as auxIn2,
-                    LOGCOORDMOVILDISTRECORRIDA as distRecorrida,
-                    LOGCOORDMOVILOBS as obs,
-                    LOGCOORDMOVILpedid as pedidoId,
-                    logcoordmovilcoordclix as clienteX,
-                    logcoordmovilcoordcliy as clienteY
-                FROM {schema}.LOGCOORDMOVIL
-                WHERE LOGCOORDMOVILFCHINSLOG >= '{startDate}'
-                  AND LOGCOORDMOVILIDENTIFICADOR = {movilId}
-                  AND LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
-                  AND LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
-                ORDER BY LOGCOORDMOVILFCHINSLOG DESC
-                FETCH FIRST {limit} ROWS ONLY
-            """
+            # Un token de otro día, de otro arranque del proceso o del futuro obliga a recargar todo
+            since_version = None
+            if since:
+                token_day, token_epoch, token_version = decode_since_token(since)
+                if token_day == day and token_epoch == PROCESS_EPOCH and token_version <= version:
+                    since_version = token_version
+            
+            age = LIVE_POSITIONS.age()
+            # ETag fuerte: distinto por Content-Encoding (identity/gzip/br son representaciones distintas)
+            encoding = choose_encoding(request.headers.get('accept-encoding'))
+            etag = build_etag(day, PROCESS_EPOCH, version, startDate, ids, emp_ids, since_version, since is not None, format, request.state.media_type, encoding, viewport_box, zoom)
+            headers = {
+                'ETag': etag,
+                'Age': str(int(age)),
+                'X-Snapshot-Age': f"{age:.1f}",
+                'Cache-Control': 'no-cache',
+            }
+            if etag_matches(request, etag):
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+            
+            if since_version is not None:
+                def build_delta() -> Dict[str, Any]:
+                    results, removed = LIVE_POSITIONS.delta(since_version, fecha_filtro, ids, emp_ids)
+                    return {
+                        "success": True,
+                        "startDate": startDate,
+                        "delta": True,
+                        "since": encode_since_token(day, version),
+                        "count": len(results),
+                        "data": results,
+                        "removed": removed,
+                        "cached": True
+                    }
+                return precompressed(('latest_positions', etag), build_delta)
+            
+            def build_full() -> Dict[str, Any]:
+                results = LIVE_POSITIONS.query(fecha_filtro, ids, emp_ids)
+                return shape({
+                    "success": True,
+                    "startDate": startDate,
+                    "delta": False,
+                    "reset": since is not None,
+                    "since": encode_since_token(day, version),
+                    "count": len(results),
+                    "data": results,
+                    "cached": True
+                }, ('live', day, PROCESS_EPOCH, version, fecha_filtro, tuple(ids or ()), tuple(emp_ids or ())))
+            return precompressed(('latest_positions', etag), build_full)
         
-        # LOG: Imprimir query completo para debugging
-        logger.info(f"🔍 QUERY COMPLETO:\n{query}")
+        # `since` solo aplica a la tabla en vivo: fuera de ella se responde completo y se avisa
+        # como en un token inválido (delta=false, reset=true) para que el cliente lo descarte
+        reset_fields = {"delta": False, "reset": True} if since else {}
         
-        results = execute_query(query)
+        # 📸 Sin filtros: servir el snapshot de la flota
+        if not movilIds and not empresaIds:
+            snapshot, age, from_snapshot, snapshot_version = await FLEET_SNAPSHOT.get(fecha_filtro)
+            response.headers['Age'] = str(int(age))
+            response.headers['X-Snapshot-Age'] = f"{age:.1f}"
+            return precompressed(
+                ('latest_positions_snapshot', fecha_filtro, snapshot_version, startDate, format, from_snapshot, bool(since), viewport_box, zoom),
+                lambda: shape(
+                    {**snapshot, "startDate": startDate, **reset_fields, "cached": from_snapshot},
+                    ('snapshot', fecha_filtro, snapshot_version)
+                )
+            )
         
-        # LOG: Contar tipos de origen en los resultados
-        origen_counts = {}
-        updpedidos_count = 0
-        for r in results:
-            origen = r.get('origen', '').strip() if r.get('origen') else 'N/A'
-            origen_counts[origen] = origen_counts.get(origen, 0) + 1
-            if origen in ['UPDPEDIDOS', 'DYLPEDIDOS']:
-                updpedidos_count += 1
-                logger.info(f"  📦 {origen}: pedidoId={r.get('pedidoid')}, clienteX={r.get('clientex')}, clienteY={r.get('clientey')}")
+        # Filtros de vehículos y empresas fleteras
+        if ids:
+            logger.info(f"🔍 Filtrando móviles: {ids}")
+        if emp_ids:
+            logger.info(f"🏢 Filtrando empresas fleteras: {emp_ids}")
         
-        logger.info(f"✅ Retrieved {len(results)} coordinates from AS400")
-        logger.info(f"📊 Origen breakdown: {origen_counts}")
-        logger.info(f"🎯 Pedidos completados encontrados: {updpedidos_count}")
+        query, params = build_latest_positions_query(fecha_filtro, ids, emp_ids)
         
-        return {
+        results = await query_db(execute_query, query, params)
+        
+        return output(shape({
             "success": True,
-            "movilId": movilId,
             "startDate": startDate,
+            **reset_fields,
             "count": len(results),
-            "data": results
-        }
-    
+            "data": results,
+            "cached": False
+        }, None))
+        
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ Error en /coordinates: {str(e)}")
+        logger.error(f"❌ Error en /latest-positions: {str(e)}")
         raise HTTPException(
             status_code=500,
-            detail=f"Error obteniendo coordenadas: {str(e)}"
+            detail=f"Error obteniendo últimas posiciones: {str(e)}"
         )
 
 
-@app.get("/latest-positions")
-async def get_latest_positions(
-    startDate: str = Query(..., description="Fecha inicial en formato YYYY-MM-DD HH:MM:SS o YYYY-MM-DD"),
-    movilIds: Optional[str] = Query(None, description="IDs de vehículos separados por comas (ej: 693,251,337). Si no se especifica, retorna todos los móviles."),
-    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (ej: 103,105). Filtra móviles por empresa.")
+# Tope global de filas de /all-coordinates (con limit por móvil, sin filtro puede ser toda la flota)
+ALL_COORDINATES_MAX_ROWS = int(os.getenv('ALL_COORDINATES_MAX_ROWS', '50000'))
+
+
+def build_all_coordinates_query(
+    fecha_inicio: str,
+    limit: int,
+    movil_ids: Optional[List[int]] = None,
+    max_rows: int = ALL_COORDINATES_MAX_ROWS,
+    bucket_seconds: Optional[int] = None,
+    centroid: bool = False
+) -> Tuple[str, List[Any]]:
+    """
+    Query (con parameter markers) del historial de coordenadas de varios móviles:
+    las `limit` más recientes (o los `limit` buckets más recientes) DE CADA móvil.
+    Trae hasta max_rows + 1 filas para poder avisar si el tope global cortó el resultado.
+    """
+    conditions = [
+        "L.LOGCOORDMOVILFCHINSLOG >= ?",
+        *(c.format(a='L.') for c in COORD_BBOX_CONDITIONS),
+    ]
+    params: List[Any] = [fecha_inicio]
+    
+    # Construir filtro de vehículos
+    if movil_ids:
+        movil_markers, movil_params = in_list_params(movil_ids)
+        conditions.append(f"L.LOGCOORDMOVILIDENTIFICADOR IN ({movil_markers})")
+        params.extend(movil_params)
+    
+    params.extend([limit, max_rows + 1])
+    
+    query = f"""
+        SELECT {LOGCOORDMOVIL_SELECT.format(a='T.')}
+        FROM (
+            SELECT L.*,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY L.LOGCOORDMOVILIDENTIFICADOR
+                       ORDER BY L.LOGCOORDMOVILFCHINSLOG DESC
+                   ) AS RN
+            FROM {logcoord_from('L', conditions, '', bucket_seconds, centroid)}
+        ) T
+        WHERE T.RN <= ?
+        ORDER BY T.LOGCOORDMOVILIDENTIFICADOR, T.LOGCOORDMOVILFCHINSLOG DESC
+        FETCH FIRST ? ROWS ONLY
+    """
+    return query, params
+
+
+# 🗄️ ESPEJO LOCAL DEL HISTORIAL: copia de LOGCOORDMOVIL en SQLite (stdlib, sin dependencias)
+# que un sync de fondo llena por marca de agua de LOGCOORDMOVILFCHINSLOG. /coordinates y
+# /all-coordinates responden el rango cerrado desde el espejo y solo van a AS400 por la cola
+# en vivo (desde el punto de corte), así el IBM i deja de recibir scans de historial.
+HISTORY_MIRROR_CONFIG = {
+    'enabled': os.getenv('HISTORY_MIRROR_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+    'path': os.getenv('HISTORY_MIRROR_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'logcoordmovil.sqlite3')),
+    'sync_interval': float(os.getenv('HISTORY_MIRROR_SYNC_INTERVAL', '60')),
+    'backfill_days': int(os.getenv('HISTORY_MIRROR_BACKFILL_DAYS', '7')),
+    'retention_days': int(os.getenv('HISTORY_MIRROR_RETENTION_DAYS', '35')),
+    # Filas más nuevas que marca de agua - overlap se consideran abiertas (pueden commitear tarde)
+    'overlap_seconds': float(os.getenv('HISTORY_MIRROR_OVERLAP_SECONDS', '120')),
+    # Rango máximo de cada query de sync (el backfill inicial se hace de a una ventana)
+    'window_minutes': int(os.getenv('HISTORY_MIRROR_WINDOW_MINUTES', '60')),
+}
+
+# Tipos SQLite de cada columna de LOGCOORDMOVIL_COLUMNS (los DECIMAL se guardan como REAL)
+HISTORY_MIRROR_TYPES = {
+    'identificador': 'INTEGER NOT NULL',
+    'coordx': 'REAL NOT NULL',
+    'coordy': 'REAL NOT NULL',
+    'fechainslog': 'TEXT NOT NULL',
+    'distrecorrida': 'REAL',
+    'pedidoid': 'INTEGER',
+    'clientex': 'REAL',
+    'clientey': 'REAL',
+}
+
+# Los buckets del espejo se alinean a este múltiplo de todos los HISTORY_BUCKETS, así un
+# bucket nunca queda partido entre el espejo y la cola en vivo
+HISTORY_MIRROR_SPLIT_SECONDS = 300
+
+
+def _mirror_value(value: Any) -> Any:
+    return float(value) if isinstance(value, Decimal) else value
+
+
+class HistoryMirror:
+    """
+    Espejo SQLite de LOGCOORDMOVIL (mismos filtros geográficos que las queries de historial).
+    
+    sync()/purge() son bloqueantes y corren en el executor de DB (leen de AS400 con RowStream);
+    query() lee solo SQLite y corre en un thread aparte. Cada thread usa su propia conexión.
+    """
+
+    def __init__(self, path: str, sync_interval: float, backfill_days: int, retention_days: int,
+                 overlap_seconds: float, window_minutes: int, enabled: bool = False):
+        self.enabled = enabled
+        self.path = path
+        self.sync_interval = sync_interval
+        self.backfill_days = backfill_days
+        self.retention_days = retention_days
+        self.overlap_seconds = overlap_seconds
+        self.window = timedelta(minutes=window_minutes)
+        self.columns = LOGCOORDMOVIL_COLUMNS
+        self.covered_from: Optional[str] = None
+        self.watermark: Optional[str] = None
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._purged_day: Optional[str] = None
+        self.counters = {
+            'syncs': 0,
+            'sync_errors': 0,
+            'rows_synced': 0,
+            'last_sync_ms': None,
+            'queries': 0,
+            'last_query_ms': None,
+        }
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def open(self):
+        """Crear el archivo y el esquema si no existen y leer la cobertura guardada"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = self._conn()
+        columns = ', '.join(f"{col} {HISTORY_MIRROR_TYPES.get(col, 'TEXT')}" for col in self.columns)
+        with conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS logcoord ({columns})")
+            # Sin clave única: AS400 puede tener filas distintas con el mismo móvil, segundo y punto
+            # (p. ej. dos UPDPEDIDOS). El sync reemplaza la ventana que relee en lugar de deduplicar.
+            conn.execute("DROP INDEX IF EXISTS logcoord_key")
+            conn.execute("CREATE INDEX IF NOT EXISTS logcoord_movil ON logcoord (identificador, fechainslog)")
+            conn.execute("CREATE INDEX IF NOT EXISTS logcoord_fecha ON logcoord (fechainslog)")
+            conn.execute("CREATE TABLE IF NOT EXISTS mirror_meta (key TEXT PRIMARY KEY, value TEXT)")
+        meta = dict(conn.execute("SELECT key, value FROM mirror_meta"))
+        self.covered_from = meta.get('covered_from')
+        self.watermark = meta.get('watermark')
+        logger.info(f"🗄️ Espejo de historial en {self.path} (cubre {self.covered_from} → {self.watermark})")
+
+    def _set_meta(self, conn: sqlite3.Connection, **values: str):
+        conn.executemany(
+            "INSERT INTO mirror_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            list(values.items())
+        )
+
+    def split_point(self, fecha_inicio: str) -> Optional[str]:
+        """
+        Punto de corte espejo/AS400 para un historial desde fecha_inicio, o None si el
+        espejo no cubre el comienzo del rango (o el rango entero es cola en vivo).
+        """
+        if not self.enabled or self.covered_from is None or self.watermark is None:
+            return None
+        closed = datetime.fromisoformat(self.watermark) - timedelta(seconds=self.overlap_seconds)
+        closed -= timedelta(seconds=(closed.hour * 3600 + closed.minute * 60 + closed.second) % HISTORY_MIRROR_SPLIT_SECONDS,
+                            microseconds=closed.microsecond)
+        split = closed.strftime('%Y-%m-%d %H:%M:%S')
+        if fecha_inicio < self.covered_from or fecha_inicio >= split:
+            return None
+        return split
+
+    def sync(self) -> bool:
+        """
+        Traer de AS400 la próxima ventana desde la marca de agua (menos overlap).
+        Retorna True si quedó al día, False si falta backfill (hay que llamar de nuevo).
+        """
+        t0 = time.monotonic()
+        now = datetime.now()
+        if self.watermark is None:
+            start = (now - timedelta(days=self.backfill_days)).strftime('%Y-%m-%d 00:00:00')
+            with self._conn() as conn:
+                self._set_meta(conn, covered_from=start, watermark=start)
+            self.covered_from = self.watermark = start
+        
+        desde = datetime.fromisoformat(self.watermark) - timedelta(seconds=self.overlap_seconds)
+        hasta = min(datetime.fromisoformat(self.watermark) + self.window, now)
+        schema = AS400_CONFIG['schema']
+        query = f"""
+            SELECT {LOGCOORDMOVIL_SELECT.format(a='')}
+            FROM {schema}.LOGCOORDMOVIL
+            WHERE LOGCOORDMOVILFCHINSLOG >= ?
+              AND LOGCOORDMOVILFCHINSLOG < ?
+              AND LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
+              AND LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
+        """
+        params = [desde.strftime('%Y-%m-%d %H:%M:%S'), hasta.strftime('%Y-%m-%d %H:%M:%S')]
+        
+        insert = f"INSERT INTO logcoord ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})"
+        stream = RowStream(query, params, chunk_size=5000)
+        stream.open()
+        fetched = 0
+        try:
+            with self._write_lock, self._conn() as conn:
+                # La ventana [desde, hasta) se reemplaza entera (en la misma transacción)
+                conn.execute("DELETE FROM logcoord WHERE fechainslog >= ? AND fechainslog < ?", params)
+                while True:
+                    rows = stream.fetch()
+                    if not rows:
+                        break
+                    fetched += len(rows)
+                    conn.executemany(insert, [[_mirror_value(row.get(col)) for col in self.columns] for row in rows])
+                self._set_meta(conn, watermark=params[1])
+        except Exception:
+            stream.close(broken=True)
+            raise
+        stream.close()
+        self.watermark = params[1]
+        
+        self.counters['syncs'] += 1
+        self.counters['rows_synced'] += fetched
+        self.counters['last_sync_ms'] = round((time.monotonic() - t0) * 1000, 1)
+        return hasta >= now
+
+    def purge(self):
+        """Borrar lo anterior a retention_days (una vez por día)"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        if self._purged_day == today or self.covered_from is None:
+            return
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime('%Y-%m-%d 00:00:00')
+        with self._write_lock, self._conn() as conn:
+            deleted = conn.execute("DELETE FROM logcoord WHERE fechainslog < ?", (cutoff,)).rowcount
+            if cutoff > self.covered_from:
+                self._set_meta(conn, covered_from=cutoff)
+                self.covered_from = cutoff
+        self._purged_day = today
+        if deleted:
+            logger.info(f"🧹 Espejo de historial: {deleted} filas anteriores a {cutoff} borradas")
+
+    def query(
+        self,
+        desde: str,
+        hasta: str,
+        limit: int,
+        movil_ids: Optional[List[int]] = None,
+        max_rows: Optional[int] = None,
+        bucket_seconds: Optional[int] = None,
+        centroid: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Equivalente local de build_all_coordinates_query en [desde, hasta): las `limit` filas
+        (o buckets) más recientes de cada móvil, ordenadas por móvil y fecha descendente.
+        """
+        t0 = time.monotonic()
+        where = "fechainslog >= ? AND fechainslog < ?"
+        params: List[Any] = [desde, hasta]
+        if movil_ids:
+            where += f" AND identificador IN ({', '.join('?' * len(movil_ids))})"
+            params.extend(movil_ids)
+        
+        source = f"SELECT * FROM logcoord WHERE {where}"
+        if bucket_seconds:
+            # Misma agregación que logcoord_from() en DB2; epoch / N se alinea a los días
+            partition = f"identificador, ev, CAST(strftime('%s', substr(fechainslog, 1, 19)) AS INTEGER) / {int(bucket_seconds)}"
+            columns = [
+                f"CASE WHEN ev = 1 THEN {col} ELSE c{col[-1]} END AS {col}" if centroid and col in ('coordx', 'coordy') else col
+                for col in self.columns
+            ]
+            source = f"""
+                SELECT {', '.join(columns)}
+                FROM (
+                    SELECT *,
+                           AVG(coordx) OVER (PARTITION BY {partition}) AS cx,
+                           AVG(coordy) OVER (PARTITION BY {partition}) AS cy,
+                           ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY fechainslog DESC) AS brn
+                    FROM (
+                        SELECT *,
+                               CASE WHEN TRIM(origen) IN ('UPDPEDIDOS', 'DYLPEDIDOS') OR COALESCE(pedidoid, 0) <> 0 THEN 1 ELSE 0 END AS ev
+                        FROM logcoord
+                        WHERE {where}
+                    )
+                )
+                WHERE brn = 1 OR ev = 1
+            """
+        query = f"""
+            SELECT {', '.join(self.columns)}
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY identificador ORDER BY fechainslog DESC) AS rn
+                FROM ({source})
+            )
+            WHERE rn <= ?
+            ORDER BY identificador, fechainslog DESC
+        """
+        params.append(limit)
+        if max_rows is not None:
+            query += " LIMIT ?"
+            params.append(max_rows + 1)
+        
+        cursor = self._conn().execute(query, params)
+        rows = [dict(zip(self.columns, row)) for row in cursor]
+        self.counters['queries'] += 1
+        self.counters['last_query_ms'] = round((time.monotonic() - t0) * 1000, 1)
+        return rows
+
+    async def history(
+        self,
+        fecha_inicio: str,
+        limit: int,
+        movil_ids: Optional[List[int]],
+        build_tail: Callable[[str], Tuple[str, List[Any]]],
+        max_rows: Optional[int] = None,
+        bucket_seconds: Optional[int] = None,
+        centroid: bool = False
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Historial desde fecha_inicio armado con el espejo (rango cerrado) + AS400 (cola en vivo,
+        build_tail(split) con la misma query de siempre desde el punto de corte).
+        None si el espejo no cubre el rango: el endpoint va a AS400 como siempre.
+        """
+        split = self.split_point(fecha_inicio)
+        if split is None:
+            return None
+        local = await asyncio.to_thread(self.query, fecha_inicio, split, limit, movil_ids, max_rows, bucket_seconds, centroid)
+        tail_query, tail_params = build_tail(split)
+        tail = await query_db(execute_query, tail_query, tail_params)
+        
+        # Cola (más nueva) primero y después el espejo, `limit` por móvil
+        per_movil: Dict[Any, List[Dict[str, Any]]] = {}
+        for row in (*tail, *local):
+            rows = per_movil.setdefault(row['identificador'], [])
+            if len(rows) < limit:
+                rows.append(row)
+        logger.info(f"🗄️ Historial desde {fecha_inicio}: {len(local)} filas del espejo + {len(tail)} de AS400 (corte {split})")
+        return [row for movil_id in sorted(per_movil) for row in per_movil[movil_id]]
+
+    async def run(self):
+        """Tarea de fondo: sync incremental cada sync_interval (el backfill va de a una ventana)"""
+        await asyncio.to_thread(self.open)
+        while True:
+            caught_up = False
+            try:
+                caught_up = await run_db(self.sync)
+                await run_db(self.purge)
+            except Exception as e:
+                self.counters['sync_errors'] += 1
+                logger.error(f"❌ Error en sync del espejo de historial: {str(e)}")
+            await asyncio.sleep(self.sync_interval if caught_up else 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'path': self.path,
+            'covered_from': self.covered_from,
+            'watermark': self.watermark,
+            **self.counters,
+        }
+
+
+HISTORY_MIRROR = HistoryMirror(**HISTORY_MIRROR_CONFIG)
+
+
+@app.get("/stream/positions")
+async def stream_positions(
+    request: Request,
+    movilIds: Optional[str] = Query(None, description="IDs de vehículos separados por comas (opcional)"),
+    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (opcional)")
+):
+    """
+    Stream (Server-Sent Events) de posiciones del día en curso
+    
+    Al conectar se envía un evento `snapshot` con la última posición de cada móvil;
+    luego eventos `positions` solo con los móviles que cambiaron. El `id` de cada evento
+    es la versión de la tabla de posiciones.
+    """
+    if not LIVE_POSITIONS.enabled or LIVE_POSITIONS.refreshed_at is None:
+        raise HTTPException(status_code=503, detail="Tabla de posiciones en vivo no disponible")
+    
+    ids = parse_id_list(movilIds, 'movilIds') if movilIds else None
+    emp_ids = parse_id_list(empresaIds, 'empresaIds') if empresaIds else None
+    sub = POSITION_HUB.subscribe(ids, emp_ids)
+    logger.info(f"📡 /stream/positions - suscriptor conectado (movilIds={movilIds}, empresaIds={empresaIds}, total={len(POSITION_HUB.subscribers)})")
+    
+    def snapshot_event() -> bytes:
+        rows = LIVE_POSITIONS.query(f"{LIVE_POSITIONS.day} 00:00:00", sub.movil_ids, sub.empresa_ids)
+        return _sse_event('snapshot', LIVE_POSITIONS.version, {
+            "day": LIVE_POSITIONS.day,
+            "version": LIVE_POSITIONS.version,
+            "count": len(rows),
+            "data": rows
+        })
+    
+    async def event_stream():
+        try:
+            yield f"retry: {int(POSITION_HUB.keepalive * 1000)}\n\n".encode("utf-8")
+            yield snapshot_event()
+            while True:
+                try:
+                    kind, payload = await asyncio.wait_for(sub.queue.get(), timeout=POSITION_HUB.keepalive)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield b": keepalive\n\n"
+                    continue
+                if kind == 'snapshot':
+                    yield snapshot_event()
+                else:
+                    version, rows = payload
+                    yield _sse_event('positions', version, {"version": version, "count": len(rows), "data": rows})
+        finally:
+            POSITION_HUB.unsubscribe(sub)
+            logger.info(f"📡 /stream/positions - suscriptor desconectado (total={len(POSITION_HUB.subscribers)})")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/moviles-near")
+async def get_moviles_near(
+    lat: float = Query(..., ge=-90, le=90, description="Latitud del punto (ej: -34.9011)"),
+    lng: float = Query(..., ge=-180, le=180, description="Longitud del punto (ej: -56.1645)"),
+    radius: Optional[float] = Query(None, gt=0, le=200000, description="Radio máximo en metros (opcional)"),
+    k: int = Query(10, ge=1, le=500, description="Cantidad máxima de móviles (los más cercanos)"),
+    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (opcional)")
 ):
     """
-    Obtener la ÚLTIMA posición de cada móvil (solo una coordenada por móvil)
-    
-    Parámetros:
-    - startDate: Fecha inicial (ej: '2025-10-14' o '2025-10-14 14:30:00')
-    - movilIds: IDs de vehículos separados por comas (opcional)
+    Móviles más cercanos a un punto (ej: un cliente), desde la tabla de posiciones en vivo.
     
-    Retorna un objeto por cada móvil con su última coordenada registrada.
+    Retorna hasta k móviles ordenados por distancia (campo "distancia" en metros), solo los
+    que están dentro de `radius` si se indica. No consulta AS400.
     """
+    if not LIVE_POSITIONS.enabled or LIVE_POSITIONS.refreshed_at is None:
+        raise HTTPException(status_code=503, detail="Tabla de posiciones en vivo no disponible")
+    await LIVE_POSITIONS.ensure_fresh(SNAPSHOT_CONFIG['max_staleness'])
     
-    # 🔥 INTENTAR USAR CACHE PRIMERO (solo para consultas sin filtros específicos)
-    cache_key = f"latest_positions_{startDate}_{movilIds}_{empresaIds}"
-    if not movilIds and not empresaIds:  # Solo cachear consultas generales
-        cached = get_cached_data('latest_positions')
-        if cached:
-            return cached
+    accept = None
+    if empresaIds:
+        emp_ids = set(parse_id_list(empresaIds, 'empresaIds'))
+        movil_empresa = LIVE_POSITIONS.movil_empresa
+        accept = lambda movil_id: movil_empresa.get(movil_id) in emp_ids
     
-    logger.info(f"📥 /latest-positions - startDate={startDate}, movilIds={movilIds}")
+    nearest = MOVIL_GRID.nearest(lat, lng, k, radius, accept)
+    logger.info(f"🧭 /moviles-near ({lat}, {lng}) radius={radius} k={k}: {len(nearest)} móviles en {MOVIL_GRID.counters['last_query_us']} µs")
     
-    try:
-        # Validar y formatear fecha
-        try:
-            if ' ' in startDate:
-                # Ya tiene hora
-                datetime.strptime(startDate, '%Y-%m-%d %H:%M:%S')
-                fecha_filtro = startDate
-            else:
-                # Solo fecha, agregar hora 00:00:00
-                datetime.strptime(startDate, '%Y-%m-%d')
-                fecha_filtro = f"{startDate} 00:00:00"
-        except ValueError:
-            raise HTTPException(
-                status_code=400,
-                detail="Formato de fecha inválido. Use 'YYYY-MM-DD' o 'YYYY-MM-DD HH:MM:SS'"
-            )
-        
-        # Construir filtro de vehículos
-        movil_filter = ""
-        if movilIds:
-            ids = [int(id.strip()) for id in movilIds.split(',')]
-            movil_filter = f"AND l.LOGCOORDMOVILIDENTIFICADOR IN ({','.join(map(str, ids))})"
-            logger.info(f"🔍 Filtrando móviles: {ids}")
-        else:
-            logger.info(f"🔍 Sin filtro de móviles - retornando todos")
-        
-        # Construir filtro de empresas fleteras
-        empresa_filter = ""
-        if empresaIds:
-            emp_ids = [int(id.strip()) for id in empresaIds.split(',')]
-            empresa_filter = f"AND mov.EFLID IN ({','.join(map(str, emp_ids))})"
-            logger.info(f"🏢 Filtrando empresas fleteras: {emp_ids}")
-        
-        schema = AS400_CONFIG['schema']
-        
-        # Filtros geográficos de Uruguay (aproximado)
-        # Uruguay: Lat -30° a -35°, Lng -53° a -58°
-        
-        # Query optimizado con JOIN a MOVILES para filtrar por empresa fletera
-        query = f"""
-            SELECT 
-                l.LOGCOORDMOVILIDENTIFICADOR as identificador,
-                l.LOGCOORDMOVILORIGEN as origen,
-                l.LOGCOORDMOVILCOORDX as coordX,
-                l.LOGCOORDMOVILCOORDY as coordY,
-                l.LOGCOORDMOVILFCHINSLOG as fechaInsLog,
-                l.LOGCOORDMOVILAUXIN2 as auxIn2,
-                l.LOGCOORDMOVILDISTRECORRIDA as distRecorrida,
-                l.LOGCOORDMOVILOBS as obs,
-                l.LOGCOORDMOVILpedid as pedidoId,
-                l.logcoordmovilcoordclix as clienteX,
-                l.logcoordmovilcoordcliy as clienteY
-            FROM {schema}.LOGCOORDMOVIL l
-            INNER JOIN (
-                SELECT 
-                    l2.LOGCOORDMOVILIDENTIFICADOR,
-                    MAX(l2.LOGCOORDMOVILFCHINSLOG) as max_fecha
-                FROM {schema}.LOGCOORDMOVIL l2
-                {"JOIN GXCALDTA.MOVILES mov2 ON l2.LOGCOORDMOVILIDENTIFICADOR = mov2.MOVID" if empresa_filter else ""}
-                WHERE l2.LOGCOORDMOVILFCHINSLOG >= '{fecha_filtro}'
-                  AND l2.LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
-                  AND l2.LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
-                {movil_filter}
-                {"AND mov2.EFLID IN (" + ','.join(map(str, [int(id.strip()) for id in empresaIds.split(',')])) + ")" if empresaIds else ""}
-                GROUP BY l2.LOGCOORDMOVILIDENTIFICADOR
-            ) latest ON l.LOGCOORDMOVILIDENTIFICADOR = latest.LOGCOORDMOVILIDENTIFICADOR
-                    AND l.LOGCOORDMOVILFCHINSLOG = latest.max_fecha
-            {"JOIN GXCALDTA.MOVILES mov ON l.LOGCOORDMOVILIDENTIFICADOR = mov.MOVID" if empresa_filter else ""}
-            WHERE l.LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
-              AND l.LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
-              {empresa_filter[4:] if empresa_filter else ""}
-            ORDER BY l.LOGCOORDMOVILFCHINSLOG DESC
-        """
-        
-        results = execute_query(query)
-        
-        response = {
-            "success": True,
-            "startDate": startDate,
-            "count": len(results),
-            "data": results,
-            "cached": False
-        }
-        
-        # 💾 GUARDAR EN CACHE (solo consultas generales)
-        if not movilIds and not empresaIds:
-            set_cached_data('latest_positions', response)
-        
-        return response
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"❌ Error en /latest-positions: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error obteniendo últimas posiciones: {str(e)}"
-        )
+    return {
+        "success": True,
+        "lat": lat,
+        "lng": lng,
+        "radius": radius,
+        "k": k,
+        "version": LIVE_POSITIONS.version,
+        "count": len(nearest),
+        "data": [{**row, "distancia": round(distance, 1)} for distance, row in nearest]
+    }
 
 
 @app.get("/all-coordinates")
+@negotiated_route
+@cached_route('all_coordinates', when=_is_buffered_request)
 async def get_all_coordinates(
+    request: Request,
+    response: Response,
     startDate: str = Query(..., description="Fecha inicial en formato YYYY-MM-DD"),
     movilIds: Optional[str] = Query(None, description="IDs de vehículos separados por comas (ej: 693,251,337)"),
-    limit: int = Query(100, ge=1, le=1000, description="Límite de registros por vehículo")
+    limit: int = Query(100, ge=1, le=1000, description="Límite de registros por vehículo"),
+    format: str = Query('json', description="json | ndjson (una fila por línea, siempre streaming) | columnar (un array por columna)"),
+    stream: bool = Query(False, description="Streaming: las filas se envían a medida que se leen de AS400"),
+    simplify: Optional[float] = Query(None, gt=0, le=5000, description="Simplificar el recorrido de cada móvil con tolerancia en metros (Douglas-Peucker)"),
+    bucket: Optional[str] = Query(None, description="30s | 1m | 5m: un punto por móvil y bucket de tiempo (los eventos no se agregan)"),
+    bucketMode: str = Query('last', description="last (último punto del bucket) | centroid (posición promedio)")
 ):
     """
     Obtener coordenadas históricas de múltiples vehículos (MÚLTIPLES registros por móvil)
@@ -714,7 +4205,17 @@ async def get_all_coordinates(
     Parámetros:
     - startDate: Fecha inicial en formato YYYY-MM-DD
     - movilIds: IDs de vehículos separados por comas (opcional, si no se especifica retorna todos)
-    - limit: Cantidad máxima de registros por vehículo
+    - limit: Cantidad máxima de registros por vehículo (las más recientes de cada uno)
+    
+    El total tiene un tope global (ALL_COORDINATES_MAX_ROWS); si lo alcanza, "truncated" es true.
+    - format/stream: con stream=true o format=ndjson la respuesta se envía por chunks;
+      format=columnar retorna "columns" y un array por columna en "data"
+    - simplify: tolerancia en metros para simplificar el recorrido (se conservan siempre
+      las filas UPDPEDIDOS/DYLPEDIDOS y las que tienen pedidoId); no admite streaming
+    - bucket/bucketMode: un punto por bucket de tiempo (30s | 1m | 5m), el último o el
+      centroide; limit cuenta buckets y las filas de eventos vienen sin agregar
+    - Accept: application/msgpack o application/vnd.apache.arrow.stream para formatos binarios
+      (msgpack y pyarrow van en requirements.txt; sin la librería el formato responde 406)
     """
     
     try:
@@ -727,44 +4228,97 @@ async def get_all_coordinates(
                 detail="Formato de fecha inválido. Use YYYY-MM-DD"
             )
         
-        # Construir filtro de vehículos
-        movil_filter = ""
-        if movilIds:
-            ids = [int(id.strip()) for id in movilIds.split(',')]
-            movil_filter = f"AND LOGCOORDMOVILIDENTIFICADOR IN ({','.join(map(str, ids))})"
+        mode = stream_mode(format, stream)
+        ids = parse_id_list(movilIds, 'movilIds') if movilIds else None
+        check_simplify(simplify, mode)
+        bucket_seconds = check_bucket(bucket, bucketMode, mode)
+        centroid = bucketMode == 'centroid'
+        pushdown = bool(bucket_seconds) and HISTORY_BUCKET_PUSHDOWN
+        max_rows = ALL_COORDINATES_MAX_ROWS
+        if bucket_seconds and not pushdown:
+            # Filas crudas: limit y el tope global se aplican después de bucket_rows
+            query, params = build_all_coordinates_query(
+                f"{startDate} 00:00:00", HISTORY_BUCKET_FALLBACK_MAX_ROWS, ids,
+                max_rows=HISTORY_BUCKET_FALLBACK_MAX_ROWS
+            )
+        else:
+            query, params = build_all_coordinates_query(
+                f"{startDate} 00:00:00", limit, ids,
+                bucket_seconds=bucket_seconds, centroid=centroid
+            )
         
-        # Construir query
-        schema = AS400_CONFIG['schema']
-        query = f"""
-            SELECT 
-                LOGCOORDMOVILIDENTIFICADOR as identificador,
-                LOGCOORDMOVILORIGEN as origen,
-                LOGCOORDMOVILCOORDX as coordX,
-                LOGCOORDMOVILCOORDY as coordY,
-                LOGCOORDMOVILFCHINSLOG as fechaInsLog,
-                LOGCOORDMOVILAUXIN2 as auxIn2,
-                LOGCOORDMOVILDISTRECORRIDA as distRecorrida,
-                LOGCOORDMOVILOBS as obs,
-                LOGCOORDMOVILpedid as pedidoId,
-                logcoordmovilcoordclix as clienteX,
-                logcoordmovilcoordcliy as clienteY
-            FROM {schema}.LOGCOORDMOVIL
-            WHERE LOGCOORDMOVILFCHINSLOG >= '{startDate}'
-              AND LOGCOORDMOVILCOORDX BETWEEN -35 AND -30
-              AND LOGCOORDMOVILCOORDY BETWEEN -58 AND -53
-              {movil_filter}
-            ORDER BY LOGCOORDMOVILIDENTIFICADOR, LOGCOORDMOVILFCHINSLOG DESC
-            FETCH FIRST {limit * (len(movilIds.split(',')) if movilIds else 10)} ROWS ONLY
-        """
+        if mode:
+            envelope = {"success": True, "startDate": startDate}
+            return await streaming_query_response(query, params, envelope, mode, max_rows=max_rows)
         
-        results = execute_query(query)
+        # Rango cerrado desde el espejo local (si está habilitado y lo cubre), cola desde AS400
+        mirrored = None
+        if not (bucket_seconds and not pushdown):
+            mirrored = await HISTORY_MIRROR.history(
+                f"{startDate} 00:00:00", limit, ids,
+                lambda desde: build_all_coordinates_query(
+                    desde, limit, ids, bucket_seconds=bucket_seconds, centroid=centroid
+                ),
+                max_rows=max_rows, bucket_seconds=bucket_seconds, centroid=centroid
+            )
         
-        return {
+        if format == 'columnar' and mirrored is None and not (bucket_seconds and not pushdown):
+            columns, arrays = await query_db(execute_query_columnar, query, params)
+            count = len(arrays[0]) if arrays else 0
+            truncated = count > max_rows
+            if truncated:
+                arrays = [values[:max_rows] for values in arrays]
+                logger.warning(f"⚠️ /all-coordinates truncado en {max_rows} filas")
+            response_body = {
+                "success": True,
+                "startDate": startDate,
+                "count": min(count, max_rows),
+                "truncated": truncated,
+                "format": "columnar",
+                "columns": columns,
+                "data": arrays
+            }
+            if simplify is not None:
+                response_body["data"] = simplify_columnar(columns, arrays, simplify)
+                response_body["originalCount"] = response_body["count"]
+                response_body["count"] = len(response_body["data"][0]) if arrays else 0
+                response_body["simplify"] = simplify
+            if bucket_seconds:
+                response_body["bucket"] = bucket
+                response_body["bucketMode"] = bucketMode
+            return response_body
+        
+        results = mirrored if mirrored is not None else await query_db(execute_query, query, params)
+        truncated = False
+        if bucket_seconds and not pushdown:
+            # Si las filas crudas llegaron al tope, los últimos móviles quedan incompletos
+            truncated = len(results) > HISTORY_BUCKET_FALLBACK_MAX_ROWS
+            results = limit_per_movil(bucket_rows(results[:HISTORY_BUCKET_FALLBACK_MAX_ROWS], bucket_seconds, centroid), limit)
+        if len(results) > max_rows:
+            truncated = True
+            results = results[:max_rows]
+        if truncated:
+            logger.warning(f"⚠️ /all-coordinates truncado en {max_rows} filas")
+        
+        response_body = {
             "success": True,
             "startDate": startDate,
             "count": len(results),
+            "truncated": truncated,
             "data": results
         }
+        if simplify is not None:
+            response_body["data"] = simplify_rows(results, simplify)
+            response_body["count"] = len(response_body["data"])
+            response_body["originalCount"] = len(results)
+            response_body["simplify"] = simplify
+            logger.info(f"〰️ Recorridos simplificados: {len(results)} → {response_body['count']} puntos")
+        if bucket_seconds:
+            response_body["bucket"] = bucket
+            response_body["bucketMode"] = bucketMode
+        if format == 'columnar':
+            return to_columnar(response_body, LOGCOORDMOVIL_COLUMNS)
+        return response_body
     
     except HTTPException:
         raise
@@ -776,7 +4330,56 @@ async def get_all_coordinates(
         )
 
 
+PEDIDOS_SERVICIOS_QUERY = """
+    SELECT *
+    FROM (
+      SELECT 
+        CAST('PEDIDO' AS VARCHAR(10)) AS TIPO,
+        p.PEDID AS ID,
+        p.CLIID,
+        c.CLINOM,
+        p.PEDFCHPARA AS FECHA,
+        p.PEDDIRCORX AS X,
+        p.PEDDIRCORY AS Y,
+        p.PEDESTCOD AS ESTADO,
+        p.PEDSUBESTC AS SUBESTADO
+      FROM GXCALDTA.PEDIDOS p
+      JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID 
+      WHERE p.PEDFECHAPA >= ?
+        AND p.PEDFECHAPA <= ?
+        AND p.PEDMOVIL = ?
+
+      UNION ALL
+
+      SELECT 
+        CAST('SERVICIO' AS VARCHAR(10)) AS TIPO,
+        s.SERVTID AS ID,
+        s.CLIID,
+        c.CLINOM,
+        s.SERVTFCHFI AS FECHA,
+        s.SERVTDCORX AS X,
+        s.SERVTDCORY AS Y,
+        s.SERVTESTCO AS ESTADO,
+        s.SERVTSESTC AS SUBESTADO
+      FROM GXCALDTA.SERVICES s
+      JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID 
+      WHERE s.SERVTFCHFI >= ?
+        AND s.SERVTFCHFI <= ?
+        AND s.SERVTMOVIL = ?
+    ) t
+    ORDER BY t.FECHA DESC
+"""
+
+# Tabla real de cada columna de los UNION de pedidos/servicios (codec por columna):
+# CLINOM es de CLIENTE en las dos mitades, el resto mezcla PEDIDOS y SERVICES
+PEDIDOS_SERVICIOS_SOURCES = (
+    ('clinom', 'GXCALDTA.CLIENTE'),
+    *((col, 'GXCALDTA.PEDIDOS|GXCALDTA.SERVICES') for col in ('movil', 'tipo', 'id', 'cliid', 'fecha', 'x', 'y', 'estado', 'subestado')),
+)
+
+
 @app.get("/pedidos-servicios/{movil_id}")
+@cached_route('pedidos_servicios')
 async def get_pedidos_servicios_movil(
     movil_id: int,
     fecha_desde: Optional[str] = Query(None, description="Fecha desde en formato YYYY-MM-DD HH:MM:SS")
@@ -799,69 +4402,8 @@ async def get_pedidos_servicios_movil(
         
         logger.info(f"📅 Filtrando pedidos/servicios entre {fecha_inicio} y {fecha_fin}")
         
-        query = """
-            SELECT *
-            FROM (
-              SELECT 
-                CAST('PEDIDO' AS VARCHAR(10)) AS TIPO,
-                p.PEDID AS ID,
-                p.CLIID,
-                c.CLINOM,
-                p.PEDFCHPARA AS FECHA,
-                p.PEDDIRCORX AS X,
-                p.PEDDIRCORY AS Y,
-                p.PEDESTCOD AS ESTADO,
-                p.PEDSUBESTC AS SUBESTADO
-              FROM GXCALDTA.PEDIDOS p
-              JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID 
-              WHERE p.PEDFECHAPA >= ?
-                AND p.PEDFECHAPA <= ?
-                AND p.PEDMOVIL = ?
-
-              UNION ALL
-
-              SELECT 
-                CAST('SERVICIO' AS VARCHAR(10)) AS TIPO,
-                s.SERVTID AS ID,
-                s.CLIID,
-                c.CLINOM,
-                s.SERVTFCHFI AS FECHA,
-                s.SERVTDCORX AS X,
-                s.SERVTDCORY AS Y,
-                s.SERVTESTCO AS ESTADO,
-                s.SERVTSESTC AS SUBESTADO
-              FROM GXCALDTA.SERVICES s
-              JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID 
-              WHERE s.SERVTFCHFI >= ?
-                AND s.SERVTFCHFI <= ?
-                AND s.SERVTMOVIL = ?
-            ) t
-            ORDER BY t.FECHA DESC
-        """
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         # Ejecutar query con parámetros (fecha_inicio, fecha_fin para cada parte del UNION)
-        cursor.execute(query, (fecha_inicio, fecha_fin, movil_id, fecha_inicio, fecha_fin, movil_id))
-        
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
-        
-        # Convertir a lista de diccionarios
-        data = []
-        for row in rows:
-            item = {}
-            for i, col in enumerate(columns):
-                value = row[i]
-                # Convertir valores según tipo
-                if isinstance(value, str):
-                    value = value.strip()
-                item[col.lower()] = value
-            data.append(item)
+        data = await query_db(execute_query, PEDIDOS_SERVICIOS_QUERY, (fecha_inicio, fecha_fin, movil_id, fecha_inicio, fecha_fin, movil_id), strip=True, sources=PEDIDOS_SERVICIOS_SOURCES)
         
         logger.info(f"✅ {len(data)} pedidos/servicios encontrados para móvil {movil_id}")
         
@@ -873,6 +4415,8 @@ async def get_pedidos_servicios_movil(
             "data": data
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error obteniendo pedidos/servicios: {str(e)}")
         raise HTTPException(
@@ -881,7 +4425,49 @@ async def get_pedidos_servicios_movil(
         )
 
 
+PEDIDOS_SERVICIOS_PENDIENTES_QUERY = """
+    SELECT *
+    FROM (
+      SELECT 
+        CAST('PEDIDO' AS VARCHAR(10)) AS TIPO,
+        p.PEDID AS ID,
+        p.CLIID,
+        c.CLINOM,
+        p.PEDFCHPARA AS FECHA,
+        p.PEDDIRCORX AS X,
+        p.PEDDIRCORY AS Y,
+        p.PEDESTCOD AS ESTADO,
+        p.PEDSUBESTC AS SUBESTADO
+      FROM GXCALDTA.PEDIDOS p
+      JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID 
+      WHERE p.PEDFECHAPA >= ? AND p.PEDFECHAPA < ?
+        AND p.PEDMOVIL = ?
+        AND p.PEDESTCOD = 1
+
+      UNION ALL
+
+      SELECT 
+        CAST('SERVICIO' AS VARCHAR(10)) AS TIPO,
+        s.SERVTID AS ID,
+        s.CLIID,
+        c.CLINOM,
+        s.SERVTFCHFI AS FECHA,
+        s.SERVTDCORX AS X,
+        s.SERVTDCORY AS Y,
+        s.SERVTESTCO AS ESTADO,
+        s.SERVTSESTC AS SUBESTADO
+      FROM GXCALDTA.SERVICES s
+      JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID 
+      WHERE s.SERVTFCHFI >= ? AND s.SERVTFCHFI < ?
+        AND s.SERVTMOVIL = ?
+        AND s.SERVTESTCO = 1
+    ) t
+    ORDER BY t.FECHA DESC
+"""
+
+
 @app.get("/pedidos-servicios-pendientes/{movil_id}")
+@cached_route('pedidos_servicios_pendientes')
 async def get_pedidos_servicios_pendientes(
     movil_id: int,
     fecha_desde: Optional[str] = Query(None, description="Fecha desde en formato YYYY-MM-DD HH:MM:SS")
@@ -899,77 +4485,11 @@ async def get_pedidos_servicios_pendientes(
         # Calcular fecha_hasta (día siguiente a las 00:00:00)
         fecha_hasta = (datetime.strptime(fecha_desde, '%Y-%m-%d %H:%M:%S') + timedelta(days=1)).strftime('%Y-%m-%d 00:00:00')
         
-        query = """
-            SELECT *
-            FROM (
-              SELECT 
-                CAST('PEDIDO' AS VARCHAR(10)) AS TIPO,
-                p.PEDID AS ID,
-                p.CLIID,
-                c.CLINOM,
-                p.PEDFCHPARA AS FECHA,
-                p.PEDDIRCORX AS X,
-                p.PEDDIRCORY AS Y,
-                p.PEDESTCOD AS ESTADO,
-                p.PEDSUBESTC AS SUBESTADO
-              FROM GXCALDTA.PEDIDOS p
-              JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID 
-              WHERE p.PEDFECHAPA >= ? AND p.PEDFECHAPA < ?
-                AND p.PEDMOVIL = ?
-                AND p.PEDESTCOD = 1
-
-              UNION ALL
-
-              SELECT 
-                CAST('SERVICIO' AS VARCHAR(10)) AS TIPO,
-                s.SERVTID AS ID,
-                s.CLIID,
-                c.CLINOM,
-                s.SERVTFCHFI AS FECHA,
-                s.SERVTDCORX AS X,
-                s.SERVTDCORY AS Y,
-                s.SERVTESTCO AS ESTADO,
-                s.SERVTSESTC AS SUBESTADO
-              FROM GXCALDTA.SERVICES s
-              JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID 
-              WHERE s.SERVTFCHFI >= ? AND s.SERVTFCHFI < ?
-                AND s.SERVTMOVIL = ?
-                AND s.SERVTESTCO = 1
-            ) t
-            ORDER BY t.FECHA DESC
-        """
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(query, (fecha_desde, fecha_hasta, movil_id, fecha_desde, fecha_hasta, movil_id))
-        
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
+        data = await query_db(execute_query, PEDIDOS_SERVICIOS_PENDIENTES_QUERY, (fecha_desde, fecha_hasta, movil_id, fecha_desde, fecha_hasta, movil_id), strip=True, sources=PEDIDOS_SERVICIOS_SOURCES)
         
-        cursor.close()
-        conn.close()
-        
-        # Convertir y contar por tipo
-        data = []
-        pedidos_count = 0
-        servicios_count = 0
-        
-        for row in rows:
-            item = {}
-            for i, col in enumerate(columns):
-                value = row[i]
-                if isinstance(value, str):
-                    value = value.strip()
-                item[col.lower()] = value
-            
-            # Contar por tipo
-            if item['tipo'] == 'PEDIDO':
-                pedidos_count += 1
-            else:
-                servicios_count += 1
-            
-            data.append(item)
+        # Contar por tipo
+        pedidos_count = sum(1 for item in data if item['tipo'] == 'PEDIDO')
+        servicios_count = len(data) - pedidos_count
         
         logger.info(f"✅ Pendientes: {pedidos_count} pedidos, {servicios_count} servicios")
         
@@ -983,6 +4503,8 @@ async def get_pedidos_servicios_pendientes(
             "data": data
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error obteniendo pendientes: {str(e)}")
         raise HTTPException(
@@ -991,7 +4513,289 @@ async def get_pedidos_servicios_pendientes(
         )
 
 
+PEDIDOS_SERVICIOS_BATCH_TEMPLATE = """
+    SELECT *
+    FROM (
+      SELECT 
+        p.PEDMOVIL AS MOVIL,
+        CAST('PEDIDO' AS VARCHAR(10)) AS TIPO,
+        p.PEDID AS ID,
+        p.CLIID,
+        c.CLINOM,
+        p.PEDFCHPARA AS FECHA,
+        p.PEDDIRCORX AS X,
+        p.PEDDIRCORY AS Y,
+        p.PEDESTCOD AS ESTADO,
+        p.PEDSUBESTC AS SUBESTADO
+      FROM GXCALDTA.PEDIDOS p
+      JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID 
+      WHERE p.PEDFECHAPA >= ? AND p.PEDFECHAPA {hasta_op} ?
+        {pedido_filter}
+
+      UNION ALL
+
+      SELECT 
+        s.SERVTMOVIL AS MOVIL,
+        CAST('SERVICIO' AS VARCHAR(10)) AS TIPO,
+        s.SERVTID AS ID,
+        s.CLIID,
+        c.CLINOM,
+        s.SERVTFCHFI AS FECHA,
+        s.SERVTDCORX AS X,
+        s.SERVTDCORY AS Y,
+        s.SERVTESTCO AS ESTADO,
+        s.SERVTSESTC AS SUBESTADO
+      FROM GXCALDTA.SERVICES s
+      JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID 
+      WHERE s.SERVTFCHFI >= ? AND s.SERVTFCHFI {hasta_op} ?
+        {servicio_filter}
+    ) t
+    ORDER BY t.MOVIL, t.FECHA DESC
+"""
+
+
+def build_pedidos_servicios_batch_query(
+    fecha_desde: str,
+    fecha_hasta: str,
+    movil_ids: Optional[List[int]] = None,
+    empresa_ids: Optional[List[int]] = None,
+    pendientes: bool = False
+) -> Tuple[str, List[Any]]:
+    """
+    Query (con parameter markers) de pedidos y servicios de VARIOS móviles en un solo viaje.
+    pendientes=True replica /pedidos-servicios-pendientes (estado 1, hasta exclusivo).
+    """
+    def filters(movil_col: str, estado_col: str) -> Tuple[str, List[Any]]:
+        clauses: List[str] = []
+        params: List[Any] = []
+        if movil_ids:
+            markers, values = in_list_params(movil_ids)
+            clauses.append(f"AND {movil_col} IN ({markers})")
+            params.extend(values)
+        if empresa_ids:
+            markers, values = in_list_params(empresa_ids)
+            clauses.append(f"AND {movil_col} IN (SELECT MOVID FROM GXCALDTA.MOVILES WHERE EFLID IN ({markers}))")
+            params.extend(values)
+        if pendientes:
+            clauses.append(f"AND {estado_col} = 1")
+        return "\n        ".join(clauses), params
+    
+    pedido_filter, pedido_params = filters('p.PEDMOVIL', 'p.PEDESTCOD')
+    servicio_filter, servicio_params = filters('s.SERVTMOVIL', 's.SERVTESTCO')
+    query = PEDIDOS_SERVICIOS_BATCH_TEMPLATE.format(
+        hasta_op='<' if pendientes else '<=',
+        pedido_filter=pedido_filter,
+        servicio_filter=servicio_filter
+    )
+    params = [fecha_desde, fecha_hasta, *pedido_params, fecha_desde, fecha_hasta, *servicio_params]
+    return query, params
+
+
+def group_by_movil(data: List[Dict[str, Any]], movil_ids: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    Agrupar filas de pedidos/servicios por móvil con los mismos contadores que los
+    endpoints por móvil. Los móviles pedidos explícitamente aparecen aunque no tengan filas.
+    """
+    groups: Dict[int, List[Dict[str, Any]]] = {movil_id: [] for movil_id in movil_ids or ()}
+    for item in data:
+        groups.setdefault(item['movil'], []).append(item)
+    result = {}
+    for movil_id, items in groups.items():
+        pedidos = sum(1 for item in items if item['tipo'] == 'PEDIDO')
+        result[movil_id] = {
+            "total": len(items),
+            "pedidos": pedidos,
+            "servicios": len(items) - pedidos,
+            "data": items
+        }
+    return result
+
+
+def parse_batch_filters(movilIds: Optional[str], empresaIds: Optional[str]) -> Tuple[Optional[List[int]], Optional[List[int]]]:
+    """movilIds/empresaIds de los endpoints batch (400 si no viene ninguno)"""
+    if not movilIds and not empresaIds:
+        raise HTTPException(status_code=400, detail="Debe indicar movilIds y/o empresaIds")
+    ids = parse_id_list(movilIds, 'movilIds') if movilIds else None
+    emp_ids = parse_id_list(empresaIds, 'empresaIds') if empresaIds else None
+    return ids, emp_ids
+
+
+@app.get("/pedidos-servicios")
+@cached_route('pedidos_servicios_batch')
+async def get_pedidos_servicios_batch(
+    movilIds: Optional[str] = Query(None, description="IDs de móviles separados por coma (ej: 693,251,337)"),
+    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (todos sus móviles)"),
+    fecha_desde: Optional[str] = Query(None, description="Fecha en formato YYYY-MM-DD (se toma el día completo)")
+):
+    """
+    Pedidos y servicios de VARIOS móviles en una sola consulta (agrupados por móvil).
+    Equivale a llamar /pedidos-servicios/{movil_id} por cada móvil.
+    """
+    try:
+        ids, emp_ids = parse_batch_filters(movilIds, empresaIds)
+        logger.info(f"📦 Consultando pedidos/servicios en lote (movilIds={movilIds}, empresaIds={empresaIds}) desde {fecha_desde}")
+        
+        if not fecha_desde:
+            fecha_desde = datetime.now().strftime('%Y-%m-%d')
+        fecha_solo = fecha_desde.split(' ')[0] if ' ' in fecha_desde else fecha_desde
+        
+        query, params = build_pedidos_servicios_batch_query(f"{fecha_solo} 00:00:00", f"{fecha_solo} 23:59:59", ids, emp_ids)
+        data = await query_db(execute_query, query, params, strip=True, sources=PEDIDOS_SERVICIOS_SOURCES)
+        moviles = group_by_movil(data, ids)
+        
+        logger.info(f"✅ {len(data)} pedidos/servicios encontrados para {len(moviles)} móviles")
+        
+        return {
+            "success": True,
+            "fechaDesde": fecha_desde,
+            "moviles": len(moviles),
+            "count": len(data),
+            "data": moviles
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo pedidos/servicios en lote: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error obteniendo pedidos/servicios: {str(e)}"
+        )
+
+
+@app.get("/pedidos-servicios-pendientes")
+@cached_route('pedidos_servicios_pendientes_batch')
+async def get_pedidos_servicios_pendientes_batch(
+    movilIds: Optional[str] = Query(None, description="IDs de móviles separados por coma (ej: 693,251,337)"),
+    empresaIds: Optional[str] = Query(None, description="IDs de empresas fleteras separados por coma (todos sus móviles)"),
+    fecha_desde: Optional[str] = Query(None, description="Fecha desde en formato YYYY-MM-DD HH:MM:SS")
+):
+    """
+    Pedidos y servicios PENDIENTES (estado = 1) de VARIOS móviles en una sola consulta.
+    Cada móvil trae sus contadores por tipo, igual que /pedidos-servicios-pendientes/{movil_id}.
+    """
+    try:
+        ids, emp_ids = parse_batch_filters(movilIds, empresaIds)
+        logger.info(f"⏳ Consultando pendientes en lote (movilIds={movilIds}, empresaIds={empresaIds})")
+        
+        if not fecha_desde:
+            fecha_desde = datetime.now().strftime('%Y-%m-%d 00:00:00')
+        try:
+            fecha_hasta = (datetime.strptime(fecha_desde, '%Y-%m-%d %H:%M:%S') + timedelta(days=1)).strftime('%Y-%m-%d 00:00:00')
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Formato de fecha inválido. Use 'YYYY-MM-DD HH:MM:SS'")
+        
+        query, params = build_pedidos_servicios_batch_query(fecha_desde, fecha_hasta, ids, emp_ids, pendientes=True)
+        data = await query_db(execute_query, query, params, strip=True, sources=PEDIDOS_SERVICIOS_SOURCES)
+        moviles = group_by_movil(data, ids)
+        pedidos_count = sum(group['pedidos'] for group in moviles.values())
+        
+        logger.info(f"✅ Pendientes en lote: {pedidos_count} pedidos, {len(data) - pedidos_count} servicios en {len(moviles)} móviles")
+        
+        return {
+            "success": True,
+            "fechaDesde": fecha_desde,
+            "moviles": len(moviles),
+            "total": len(data),
+            "pedidosPendientes": pedidos_count,
+            "serviciosPendientes": len(data) - pedidos_count,
+            "data": moviles
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo pendientes en lote: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error obteniendo pendientes: {str(e)}"
+        )
+
+
+PEDIDO_DETALLE_SELECT = """
+    SELECT 
+        p.PEDID as pedid,
+        p.CLIID as cliid,
+        c.CLINOM as clinom,
+        p.PEDOBS as pedobs,
+        p.PEDIMPORTE as pedimporte,
+        p.PEDMOVIL as pedmovil,
+        p.PEDFCHCUMP as pedfchcump,
+        p.PEDDIR as peddir,
+        p.PEDAUX17 as usuario,
+        p.PEDESTCOD as estado,
+        p.PEDSUBESTC as subestado,
+        p.PEDDIRCORX as x,
+        p.PEDDIRCORY as y
+    FROM GXCALDTA.PEDIDOS p
+    JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID"""
+
+PEDIDO_DETALLE_SOURCES = (('clinom', 'GXCALDTA.CLIENTE'),)
+
+PEDIDO_DETALLE_QUERY = PEDIDO_DETALLE_SELECT + """
+    WHERE p.PEDID = ?
+"""
+
+
+# Máximo de IDs por request en /pedidos-detalle y /servicios-detalle, y por query IN (...)
+DETAIL_BATCH_MAX_IDS = int(os.getenv('DETAIL_BATCH_MAX_IDS', '500'))
+DETAIL_BATCH_CHUNK = min(int(os.getenv('DETAIL_BATCH_CHUNK', '256')), IN_LIST_BUCKETS[-1])
+
+
+async def fetch_details_by_ids(
+    namespace: str,
+    select: str,
+    id_column: str,
+    id_key: str,
+    ids: List[int],
+    sources: Sequence[Tuple[str, str]] = ()
+) -> Dict[int, Optional[Dict[str, Any]]]:
+    """
+    Resolver detalles de muchos IDs: primero el LRU por ID (RESPONSE_CACHE[namespace]),
+    y los que falten en una query IN (...) por cada DETAIL_BATCH_CHUNK IDs.
+    
+    Retorna {id: fila} con None para los IDs que no existen (esos no se cachean).
+    """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > DETAIL_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {DETAIL_BATCH_MAX_IDS} IDs por request")
+    
+    result: Dict[int, Optional[Dict[str, Any]]] = {}
+    missing = []
+    for id in ids:
+        hit = RESPONSE_CACHE.get((namespace, id))
+        if hit is not None:
+            result[id] = hit[0]
+        else:
+            missing.append(id)
+    
+    for start in range(0, len(missing), DETAIL_BATCH_CHUNK):
+        chunk = missing[start:start + DETAIL_BATCH_CHUNK]
+        markers, params = in_list_params(chunk)
+        query = f"{select}\n    WHERE {id_column} IN ({markers})"
+        for row in await query_db(execute_query, query, params, strip=True, sources=sources):
+            row_id = int(row[id_key])
+            result[row_id] = row
+            RESPONSE_CACHE.set((namespace, row_id), row, CACHE_TTLS[namespace])
+    
+    logger.info(f"✨ {namespace}: {len(ids) - len(missing)}/{len(ids)} IDs desde caché")
+    return {id: result.get(id) for id in ids}
+
+
+def detail_batch_response(tipo: str, details: Dict[int, Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    not_found = [id for id, row in details.items() if row is None]
+    return {
+        "success": True,
+        "tipo": tipo,
+        "count": len(details),
+        "found": len(details) - len(not_found),
+        "notFound": not_found,
+        "data": details
+    }
+
+
 @app.get("/pedido-detalle/{pedido_id}")
+@cached_route('pedido_detalle')
 async def get_pedido_detalle(pedido_id: int):
     """
     Obtiene los detalles completos de un pedido por su ID.
@@ -999,46 +4803,12 @@ async def get_pedido_detalle(pedido_id: int):
     try:
         logger.info(f"⏳ Consultando detalles del pedido {pedido_id}")
         
-        query = """
-            SELECT 
-                p.PEDID as pedid,
-                p.CLIID as cliid,
-                c.CLINOM as clinom,
-                p.PEDOBS as pedobs,
-                p.PEDIMPORTE as pedimporte,
-                p.PEDMOVIL as pedmovil,
-                p.PEDFCHCUMP as pedfchcump,
-                p.PEDDIR as peddir,
-                p.PEDAUX17 as usuario,
-                p.PEDESTCOD as estado,
-                p.PEDSUBESTC as subestado,
-                p.PEDDIRCORX as x,
-                p.PEDDIRCORY as y
-            FROM GXCALDTA.PEDIDOS p
-            JOIN GXCALDTA.CLIENTE c ON p.CLIID = c.CLIID
-            WHERE p.PEDID = ?
-        """
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(query, (pedido_id,))
-        
-        columns = [desc[0] for desc in cursor.description]
-        row = cursor.fetchone()
+        rows = await query_db(execute_query, PEDIDO_DETALLE_QUERY, (pedido_id,), strip=True, sources=PEDIDO_DETALLE_SOURCES)
         
-        cursor.close()
-        conn.close()
-        
-        if not row:
+        if not rows:
             raise HTTPException(status_code=404, detail=f"Pedido {pedido_id} no encontrado")
         
-        # Convertir a diccionario
-        data = {}
-        for i, col in enumerate(columns):
-            value = row[i]
-            if isinstance(value, str):
-                value = value.strip()
-            data[col.lower()] = value
+        data = rows[0]
         
         logger.info(f"✅ Detalles del pedido {pedido_id} obtenidos")
         
@@ -1058,7 +4828,61 @@ async def get_pedido_detalle(pedido_id: int):
         )
 
 
+@app.get("/pedidos-detalle")
+async def get_pedidos_detalle(
+    ids: str = Query(..., description="IDs de pedidos separados por coma (ej: 1001,1002,1003)")
+):
+    """
+    Detalles de VARIOS pedidos en una sola consulta, como mapa {id: detalle}.
+    Los IDs inexistentes vienen con null y listados en notFound.
+    """
+    try:
+        pedido_ids = parse_id_list(ids, 'ids')
+        logger.info(f"⏳ Consultando detalles de {len(pedido_ids)} pedidos")
+        
+        details = await fetch_details_by_ids('pedido_item', PEDIDO_DETALLE_SELECT, 'p.PEDID', 'pedid', pedido_ids, PEDIDO_DETALLE_SOURCES)
+        response = detail_batch_response("PEDIDO", details)
+        
+        logger.info(f"✅ Detalles de pedidos: {response['found']} encontrados, {len(response['notFound'])} no encontrados")
+        return response
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo detalles de pedidos: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error obteniendo detalles de pedidos: {str(e)}"
+        )
+
+
+SERVICIO_DETALLE_SELECT = """
+    SELECT 
+        s.SERVTID as servtid,
+        s.CLIID as cliid,
+        c.CLINOM as clinom,
+        s.SERVTFCHIN as servtfchin,
+        c.TELFNRO as telfnro,
+        s.SERVTOBS as servtobs,
+        s.SERVTMOVIL as servtmovil,
+        s.SERVTFCHCU as servtfchcu,
+        s.SERVTDIR as servtdir,
+        s.SERVTESTCO as estado,
+        s.SERVTSESTC as subestado,
+        s.SERVTDCORX as x,
+        s.SERVTDCORY as y
+    FROM GXCALDTA.SERVICES s
+    JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID"""
+
+SERVICIO_DETALLE_SOURCES = (('clinom', 'GXCALDTA.CLIENTE'), ('telfnro', 'GXCALDTA.CLIENTE'))
+
+SERVICIO_DETALLE_QUERY = SERVICIO_DETALLE_SELECT + """
+    WHERE s.SERVTID = ?
+"""
+
+
 @app.get("/servicio-detalle/{servicio_id}")
+@cached_route('servicio_detalle')
 async def get_servicio_detalle(servicio_id: int):
     """
     Obtiene los detalles completos de un servicio por su ID.
@@ -1066,46 +4890,12 @@ async def get_servicio_detalle(servicio_id: int):
     try:
         logger.info(f"⏳ Consultando detalles del servicio {servicio_id}")
         
-        query = """
-            SELECT 
-                s.SERVTID as servtid,
-                s.CLIID as cliid,
-                c.CLINOM as clinom,
-                s.SERVTFCHIN as servtfchin,
-                c.TELFNRO as telfnro,
-                s.SERVTOBS as servtobs,
-                s.SERVTMOVIL as servtmovil,
-                s.SERVTFCHCU as servtfchcu,
-                s.SERVTDIR as servtdir,
-                s.SERVTESTCO as estado,
-                s.SERVTSESTC as subestado,
-                s.SERVTDCORX as x,
-                s.SERVTDCORY as y
-            FROM GXCALDTA.SERVICES s
-            JOIN GXCALDTA.CLIENTE c ON s.CLIID = c.CLIID
-            WHERE s.SERVTID = ?
-        """
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(query, (servicio_id,))
-        
-        columns = [desc[0] for desc in cursor.description]
-        row = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
+        rows = await query_db(execute_query, SERVICIO_DETALLE_QUERY, (servicio_id,), strip=True, sources=SERVICIO_DETALLE_SOURCES)
         
-        if not row:
+        if not rows:
             raise HTTPException(status_code=404, detail=f"Servicio {servicio_id} no encontrado")
         
-        # Convertir a diccionario
-        data = {}
-        for i, col in enumerate(columns):
-            value = row[i]
-            if isinstance(value, str):
-                value = value.strip()
-            data[col.lower()] = value
+        data = rows[0]
         
         logger.info(f"✅ Detalles del servicio {servicio_id} obtenidos")
         
@@ -1125,6 +4915,34 @@ async def get_servicio_detalle(servicio_id: int):
         )
 
 
+@app.get("/servicios-detalle")
+async def get_servicios_detalle(
+    ids: str = Query(..., description="IDs de servicios separados por coma (ej: 1001,1002,1003)")
+):
+    """
+    Detalles de VARIOS servicios en una sola consulta, como mapa {id: detalle}.
+    Los IDs inexistentes vienen con null y listados en notFound.
+    """
+    try:
+        servicio_ids = parse_id_list(ids, 'ids')
+        logger.info(f"⏳ Consultando detalles de {len(servicio_ids)} servicios")
+        
+        details = await fetch_details_by_ids('servicio_item', SERVICIO_DETALLE_SELECT, 's.SERVTID', 'servtid', servicio_ids, SERVICIO_DETALLE_SOURCES)
+        response = detail_batch_response("SERVICIO", details)
+        
+        logger.info(f"✅ Detalles de servicios: {response['found']} encontrados, {len(response['notFound'])} no encontrados")
+        return response
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo detalles de servicios: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error obteniendo detalles de servicios: {str(e)}"
+        )
+
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -0,0 +1,106 @@
+"""
+Micro-benchmark: conversión de filas JDBC a diccionarios.
+
+Compara el loop original de execute_query (cadena de isinstance por valor) contra el
+plan de conversión por columna (RowConverter) sobre un result set sintético con la
+forma de LOGCOORDMOVIL.
+
+Uso:
+    python bench_row_converters.py [filas]
+"""
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import jaydebeapi
+
+from api_as400 import RowConverter
+
+
+def legacy_convert(columns, rows):
+    """Loop original de execute_query (antes del plan por columna)"""
+    results = []
+    for row in rows:
+        row_dict = {}
+        for i, value in enumerate(row):
+            col_name = columns[i]
+            if isinstance(value, datetime):
+                row_dict[col_name] = value.isoformat()
+            elif value is None:
+                row_dict[col_name] = None
+            elif isinstance(value, (bytes, bytearray)):
+                try:
+                    row_dict[col_name] = value.decode('utf-8')
+                except UnicodeDecodeError:
+                    try:
+                        row_dict[col_name] = value.decode('latin-1')
+                    except UnicodeDecodeError:
+                        try:
+                            row_dict[col_name] = value.decode('cp1252')
+                        except UnicodeDecodeError:
+                            row_dict[col_name] = value.decode('utf-8', errors='replace')
+            elif isinstance(value, str):
+                row_dict[col_name] = value
+            else:
+                row_dict[col_name] = value
+        results.append(row_dict)
+    return results
+
+
+DESCRIPTION = [
+    ('IDENTIFICADOR', jaydebeapi.NUMBER),
+    ('ORIGEN', jaydebeapi.STRING),
+    ('COORDX', jaydebeapi.DECIMAL),
+    ('COORDY', jaydebeapi.DECIMAL),
+    ('FECHAINSLOG', jaydebeapi.DATETIME),
+    ('AUXIN2', jaydebeapi.STRING),
+    ('DISTRECORRIDA', jaydebeapi.DECIMAL),
+    ('OBS', jaydebeapi.STRING),
+    ('PEDIDOID', jaydebeapi.NUMBER),
+    ('CLIENTEX', jaydebeapi.DECIMAL),
+    ('CLIENTEY', jaydebeapi.DECIMAL),
+]
+
+
+def synthetic_rows(n):
+    rows = []
+    for i in range(n):
+        rows.append((
+            600 + i % 400,
+            'GPS' if i % 10 else 'UPDPEDIDOS',
+            Decimal('-34.901100') - Decimal(i % 1000) / 100000,
+            Decimal('-56.164500') + Decimal(i % 1000) / 100000,
+            f"2025-10-14 {8 + i % 10:02d}:{i % 60:02d}:{(i * 7) % 60:02d}.000000",
+            'INFO',
+            Decimal(i % 5000) / 10,
+            'Camión en ruta' if i % 3 else None,
+            None if i % 10 else 1000 + i,
+            None,
+            None,
+        ))
+    return rows
+
+
+def bench(label, fn, rows, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - t0)
+    print(f"{label:<28} {best * 1000:8.1f} ms  {len(rows) / best:12,.0f} filas/s")
+    return best
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = synthetic_rows(n)
+    columns = [name.lower() for name, _ in DESCRIPTION]
+    converter = RowConverter(DESCRIPTION)
+
+    assert legacy_convert(columns, rows[:1000]) == converter.convert_all(rows[:1000])
+
+    print(f"📊 {n:,} filas x {len(DESCRIPTION)} columnas")
+    before = bench("loop isinstance (antes)", lambda r: legacy_convert(columns, r), rows)
+    after = bench("RowConverter (después)", converter.convert_all, rows)
+    print(f"⚡ Speedup: {before / after:.1f}x")
@@ -0,0 +1,97 @@
+"""
+Benchmark: serialización JSON de payloads reales de la flota.
+
+Compara json.dumps (stdlib) contra orjson con las mismas opciones que usa
+UTF8JSONResponse y verifica que ambos produzcan exactamente los mismos bytes.
+
+Uso:
+    python bench_serializacion.py
+"""
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import api_as400
+from api_as400 import _dumps_stdlib, _dumps_orjson
+
+
+def fleet_rows(n, moviles=400):
+    """Filas con la forma de LOGCOORDMOVIL (como salen de execute_query)"""
+    rows = []
+    for i in range(n):
+        rows.append({
+            "identificador": 600 + i % moviles,
+            "origen": "GPS" if i % 10 else "UPDPEDIDOS",
+            "coordx": Decimal('-34.901100') - Decimal(i % 1000) / 100000,
+            "coordy": Decimal('-56.164500') + Decimal(i % 1000) / 100000,
+            "fechainslog": f"2025-10-14 {8 + i % 10:02d}:{i % 60:02d}:{(i * 7) % 60:02d}.000000",
+            "auxin2": "INFO",
+            "distrecorrida": float(i % 5000) / 10,
+            "obs": "Camión en ruta — señal débil" if i % 3 else None,
+            "pedidoid": None if i % 10 else 1000 + i,
+            "clientex": None,
+            "clientey": None,
+        })
+    return rows
+
+
+PAYLOADS = {
+    "latest-positions (400 móviles)": {
+        "success": True,
+        "startDate": "2025-10-14",
+        "count": 400,
+        "data": fleet_rows(400),
+        "cached": False,
+    },
+    "all-coordinates (100k filas)": {
+        "success": True,
+        "startDate": "2025-10-14",
+        "count": 100_000,
+        "data": fleet_rows(100_000),
+    },
+    "empresas-fleteras": {
+        "success": True,
+        "count": 3,
+        "data": [{"eflid": 103, "eflnom": "Fletes Peñarol", "eflestado": "A"}] * 3,
+        "timestamp": datetime(2025, 10, 14, 10, 30),
+    },
+}
+
+
+def bench(fn, payload, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(payload)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == '__main__':
+    if api_as400.orjson is None:
+        raise SystemExit("orjson no está instalado: pip install orjson")
+
+    for name, payload in PAYLOADS.items():
+        expected = _dumps_stdlib(payload)
+        assert _dumps_orjson(payload) == expected, f"{name}: los bytes difieren"
+        repeat = 3 if len(expected) > 1_000_000 else 50
+        t_json = bench(_dumps_stdlib, payload, repeat)
+        t_orjson = bench(_dumps_orjson, payload, repeat)
+        print(f"📊 {name}: {len(expected) / 1024:,.0f} KB")
+        print(f"   json    {t_json * 1000:9.2f} ms")
+        print(f"   orjson  {t_orjson * 1000:9.2f} ms  ({t_json / t_orjson:.1f}x)")
+
+    try:
+        _dumps_stdlib({"x": float('nan')})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("json.dumps debería rechazar NaN")
+    for bad in ({"x": float('nan')}, [{"lat": float('inf'), "obs": None}], {"c": [(1.0, float('-inf'))]}):
+        try:
+            _dumps_orjson(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"orjson debería rechazar {bad!r} como json.dumps")
+    print("✅ Mismos bytes en ambos backends")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# api_as400.py es un módulo suelto en as400-api/ (sin paquete instalable)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,158 @@
+"""bucket=30s|1m|5m: fallback en Python (bucket_rows) y SQL de la agregación en DB2 (logcoord_from)"""
+import pytest
+
+from api_as400 import bucket_rows, limit_per_movil, logcoord_from
+
+
+def point(movil_id, fecha, x=-34.9, y=-56.1, origen='GPS', pedido_id=None):
+    return {
+        'identificador': movil_id,
+        'origen': origen,
+        'coordx': x,
+        'coordy': y,
+        'fechainslog': fecha,
+        'pedidoid': pedido_id,
+    }
+
+
+def test_keeps_last_point_per_bucket():
+    rows = [
+        point(1, '2025-10-14 10:01:10'),
+        point(1, '2025-10-14 10:00:59'),
+        point(1, '2025-10-14 10:00:40'),
+        point(1, '2025-10-14 10:00:05'),
+    ]
+    assert bucket_rows(rows, 60) == [rows[0], rows[1]]
+
+
+def test_last_point_does_not_depend_on_input_order():
+    rows = [
+        point(1, '2025-10-14 10:00:05.000000'),
+        point(1, '2025-10-14 10:00:59.000000'),
+        point(1, '2025-10-14 10:00:40.000000'),
+    ]
+    result = bucket_rows(rows, 60)
+    assert result == [rows[1]]
+
+
+def test_centroid_averages_coordinates():
+    rows = [
+        point(1, '2025-10-14 10:04:00', x=-34.90, y=-56.10),
+        point(1, '2025-10-14 10:02:00', x=-34.92, y=-56.14),
+        point(1, '2025-10-14 10:00:00', x=-34.94, y=-56.18),
+    ]
+    (row,) = bucket_rows(rows, 300, centroid=True)
+    assert row['coordx'] == pytest.approx(-34.92)
+    assert row['coordy'] == pytest.approx(-56.14)
+    # El resto de las columnas es la del último punto del bucket, y las filas de entrada no se tocan
+    assert row['fechainslog'] == '2025-10-14 10:04:00'
+    assert rows[0]['coordx'] == -34.90
+
+
+def test_centroid_single_point_bucket_is_unchanged():
+    rows = [point(1, '2025-10-14 10:00:00', x=-34.9, y=-56.1)]
+    assert bucket_rows(rows, 60, centroid=True) == rows
+
+
+def test_event_rows_are_kept_as_is():
+    rows = [
+        point(1, '2025-10-14 10:00:50'),
+        point(1, '2025-10-14 10:00:40', origen='UPDPEDIDOS', x=-34.8),
+        point(1, '2025-10-14 10:00:30', pedido_id=77, x=-34.7),
+        point(1, '2025-10-14 10:00:20', origen='DYLPEDIDOS ', x=-34.6),
+        point(1, '2025-10-14 10:00:10'),
+    ]
+    result = bucket_rows(rows, 60, centroid=True)
+    assert result[1:] == rows[1:4]
+    # Los eventos no entran en el centroide del bucket
+    assert result[0]['coordx'] == pytest.approx(-34.9)
+
+
+def test_buckets_are_per_movil_and_day():
+    rows = [
+        point(2, '2025-10-15 10:00:30'),
+        point(1, '2025-10-15 10:00:20'),
+        point(2, '2025-10-14 10:00:30'),
+        point(1, '2025-10-14 10:00:20'),
+    ]
+    assert bucket_rows(rows, 60) == rows
+
+
+def test_keeps_original_order():
+    rows = [
+        point(1, '2025-10-14 10:05:30'),
+        point(2, '2025-10-14 10:05:10'),
+        point(1, '2025-10-14 10:05:00'),
+        point(1, '2025-10-14 10:04:10', pedido_id=5),
+        point(2, '2025-10-14 10:04:50'),
+        point(2, '2025-10-14 10:04:30'),
+        point(1, '2025-10-14 10:03:00'),
+    ]
+    assert bucket_rows(rows, 60) == [rows[0], rows[1], rows[3], rows[4], rows[6]]
+
+
+def test_rows_without_timestamp_are_kept():
+    rows = [point(1, None), point(1, '2025-10-14 10:00:00')]
+    assert bucket_rows(rows, 30) == rows
+
+
+def test_limit_counts_buckets_per_movil():
+    rows = [point(m, f'2025-10-14 10:{minute:02d}:{second:02d}') for m in (1, 2) for minute in (3, 2, 1, 0) for second in (50, 20)]
+    result = limit_per_movil(bucket_rows(rows, 60), 2)
+    assert [(r['identificador'], r['fechainslog'][11:]) for r in result] == [
+        (1, '10:03:50'), (1, '10:02:50'), (2, '10:03:50'), (2, '10:02:50'),
+    ]
+
+
+EXPECTED_BUCKET_SQL = """
+(
+    SELECT B.LOGCOORDMOVILIDENTIFICADOR, B.LOGCOORDMOVILORIGEN, B.LOGCOORDMOVILCOORDX, B.LOGCOORDMOVILCOORDY,
+           B.LOGCOORDMOVILFCHINSLOG, B.LOGCOORDMOVILAUXIN2, B.LOGCOORDMOVILDISTRECORRIDA, B.LOGCOORDMOVILOBS,
+           B.LOGCOORDMOVILpedid, B.logcoordmovilcoordclix, B.logcoordmovilcoordcliy
+    FROM (
+        SELECT l.*,
+               CASE WHEN (l.LOGCOORDMOVILORIGEN IN ('UPDPEDIDOS', 'DYLPEDIDOS') OR COALESCE(l.LOGCOORDMOVILPEDID, 0) <> 0) THEN 1 ELSE 0 END AS EV,
+               ROW_NUMBER() OVER (
+                   PARTITION BY l.LOGCOORDMOVILIDENTIFICADOR,
+                                CASE WHEN (l.LOGCOORDMOVILORIGEN IN ('UPDPEDIDOS', 'DYLPEDIDOS') OR COALESCE(l.LOGCOORDMOVILPEDID, 0) <> 0) THEN 1 ELSE 0 END,
+                                DATE(l.LOGCOORDMOVILFCHINSLOG), MIDNIGHT_SECONDS(l.LOGCOORDMOVILFCHINSLOG) / 60
+                   ORDER BY l.LOGCOORDMOVILFCHINSLOG DESC
+               ) AS BRN
+        FROM GXICAGEO.LOGCOORDMOVIL l
+        WHERE l.LOGCOORDMOVILFCHINSLOG >= ?
+          AND l.LOGCOORDMOVILIDENTIFICADOR = ?
+    ) B
+    WHERE B.BRN = 1 OR B.EV = 1
+) l
+"""
+
+
+def normalize(sql):
+    return ' '.join(sql.split()).replace('( ', '(').replace(' )', ')')
+
+
+def test_bucket_sql_snapshot():
+    sql = logcoord_from('l', ['l.LOGCOORDMOVILFCHINSLOG >= ?', 'l.LOGCOORDMOVILIDENTIFICADOR = ?'], '', 60)
+    assert normalize(sql) == normalize(EXPECTED_BUCKET_SQL)
+
+
+def test_bucket_sql_centroid():
+    sql = normalize(logcoord_from('L', ['L.LOGCOORDMOVILFCHINSLOG >= ?'], '', 300, centroid=True))
+    partition = (
+        "PARTITION BY L.LOGCOORDMOVILIDENTIFICADOR, CASE WHEN (L.LOGCOORDMOVILORIGEN IN ('UPDPEDIDOS', 'DYLPEDIDOS') "
+        "OR COALESCE(L.LOGCOORDMOVILPEDID, 0) <> 0) THEN 1 ELSE 0 END, DATE(L.LOGCOORDMOVILFCHINSLOG), "
+        "MIDNIGHT_SECONDS(L.LOGCOORDMOVILFCHINSLOG) / 300"
+    )
+    assert f"AVG(L.LOGCOORDMOVILCOORDX) OVER ({partition}) AS CX" in sql
+    assert f"AVG(L.LOGCOORDMOVILCOORDY) OVER ({partition}) AS CY" in sql
+    assert "CASE WHEN B.EV = 1 THEN B.LOGCOORDMOVILCOORDX ELSE B.CX END AS LOGCOORDMOVILCOORDX" in sql
+    assert "CASE WHEN B.EV = 1 THEN B.LOGCOORDMOVILCOORDY ELSE B.CY END AS LOGCOORDMOVILCOORDY" in sql
+    assert sql.endswith("WHERE B.BRN = 1 OR B.EV = 1) L")
+
+
+def test_no_bucket_is_plain_table():
+    sql = logcoord_from('l', ['l.LOGCOORDMOVILFCHINSLOG >= ?'], 'JOIN GXCALDTA.MOVILES m ON l.LOGCOORDMOVILIDENTIFICADOR = m.MOVID')
+    assert normalize(sql) == (
+        "GXICAGEO.LOGCOORDMOVIL l JOIN GXCALDTA.MOVILES m ON l.LOGCOORDMOVILIDENTIFICADOR = m.MOVID "
+        "WHERE l.LOGCOORDMOVILFCHINSLOG >= ?"
+    )
@@ -0,0 +1,101 @@
+"""SpatialIndex.nearest contra un barrido completo con haversine"""
+import random
+
+import pytest
+
+from api_as400 import SpatialIndex, haversine_meters
+
+
+def fleet(rng, n):
+    """Flota con la forma real: densa en Montevideo y dispersa por el resto del país"""
+    rows = []
+    for movil_id in range(n):
+        if movil_id % 4:
+            lat, lng = rng.uniform(-34.95, -34.75), rng.uniform(-56.35, -56.0)
+        else:
+            lat, lng = rng.uniform(-35.0, -30.1), rng.uniform(-58.4, -53.2)
+        rows.append({'identificador': movil_id, 'coordx': lat, 'coordy': lng})
+    return rows
+
+
+def brute_force(rows, lat, lng, k, radius=None, accept=None):
+    latest = {}
+    for row in rows:
+        latest[row['identificador']] = row
+    distances = sorted(
+        (haversine_meters(lat, lng, row['coordx'], row['coordy']), movil_id)
+        for movil_id, row in latest.items()
+        if accept is None or accept(movil_id)
+    )
+    if radius is not None:
+        distances = [(d, movil_id) for d, movil_id in distances if d <= radius]
+    return distances[:k]
+
+
+def assert_same(result, expected):
+    assert [round(d, 6) for d, _ in result] == [round(d, 6) for d, _ in expected]
+    assert {row['identificador'] for _, row in result} == {movil_id for _, movil_id in expected}
+
+
+def queries(rng, n):
+    for _ in range(n):
+        if rng.random() < 0.7:
+            yield rng.uniform(-34.95, -34.75), rng.uniform(-56.35, -56.0)
+        else:
+            yield rng.uniform(-35.2, -29.9), rng.uniform(-58.6, -53.0)
+
+
+@pytest.fixture
+def index_and_rows():
+    rng = random.Random(1234)
+    rows = fleet(rng, 1500)
+    index = SpatialIndex(cell_degrees=0.01, coarse_factor=16, fine_rings=4)
+    index.rebuild(rows)
+    return index, rows, rng
+
+
+@pytest.mark.parametrize('k', [1, 5, 20])
+def test_nearest_k(index_and_rows, k):
+    index, rows, rng = index_and_rows
+    for lat, lng in queries(rng, 150):
+        assert_same(index.nearest(lat, lng, k), brute_force(rows, lat, lng, k))
+    # Las consultas en zonas dispersas pasan por la grilla gruesa
+    assert index.counters['coarse_queries'] > 0
+
+
+@pytest.mark.parametrize('radius', [300, 2_000, 25_000])
+def test_nearest_radius(index_and_rows, radius):
+    index, rows, rng = index_and_rows
+    for lat, lng in queries(rng, 150):
+        assert_same(index.nearest(lat, lng, 50, radius), brute_force(rows, lat, lng, 50, radius))
+
+
+def test_nearest_accept(index_and_rows):
+    index, rows, rng = index_and_rows
+    even = lambda movil_id: movil_id % 2 == 0
+    for lat, lng in queries(rng, 100):
+        assert_same(index.nearest(lat, lng, 5, accept=even), brute_force(rows, lat, lng, 5, accept=even))
+
+
+def test_nearest_after_update(index_and_rows):
+    index, rows, rng = index_and_rows
+    # La mitad de los móviles se mueve (algunos cambian de celda fina y gruesa)
+    moved = [
+        {'identificador': row['identificador'], 'coordx': row['coordx'] + rng.uniform(-0.3, 0.3), 'coordy': row['coordy'] + rng.uniform(-0.3, 0.3)}
+        for row in rows[::2]
+    ]
+    index.update(moved)
+    current = rows + moved
+    for lat, lng in queries(rng, 150):
+        assert_same(index.nearest(lat, lng, 10), brute_force(current, lat, lng, 10))
+        assert_same(index.nearest(lat, lng, 50, 5_000), brute_force(current, lat, lng, 50, 5_000))
+
+
+def test_nearest_empty_and_far_away():
+    index = SpatialIndex(cell_degrees=0.01, coarse_factor=16, fine_rings=4)
+    assert index.nearest(-34.9, -56.1, 5) == []
+    index.rebuild([{'identificador': 1, 'coordx': -30.2, 'coordy': -57.5}])
+    # Un único móvil a cientos de km
+    result = index.nearest(-34.9, -56.1, 5)
+    assert [row['identificador'] for _, row in result] == [1]
+    assert index.nearest(-34.9, -56.1, 5, radius=1_000) == []